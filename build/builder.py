@@ -30,38 +30,78 @@
 
 import os
 import sys
+import re
+import socket
+import subprocess
 import time
+import hashlib
 import platform
 import multiprocessing
 import json
 import pprint
+import threading
 import xsysroot
+import scheduler
+import telemetry
+
+# stages of a release run at the same time, see pipeline.py
+stages_lock=threading.Lock()
 
 class Builder():
 
-    def __init__(self, config_file='qt5-configuration.json', cross=True, release=True, dry_run=True):
+    def __init__(self, config_file='qt5-configuration.json', cross=True, release=True, dry_run=True, offload=False):
         self.config = json.loads(open(config_file, 'r').read())
-        self.sysroot = xsysroot.XSysroot(profile=self.config['xsysroot_profile'])
+        self.profile, self.profile_settings = xsysroot.load_profile(self.config['xsysroot_profile'])
+        self._sysroot=None
         self.cross=cross
         self.release=release
         self.dry_run=dry_run
+        self.offload=offload and not cross
+        self._distcc=None
+        self._job_limits={}
+        self.cpu_budget=None
+        self.ccache_dir=os.path.expanduser(self.config.get('ccache_dir', ''))
+        self.forced_stages=set()
+        self._previous_stage=None
         self._complete_config()
 
+    @property
+    def sysroot(self):
+        '''
+        The xsysroot instance, bound on first use so read-only commands do not pay for it
+        '''
+        if not self._sysroot:
+            self._sysroot = xsysroot.XSysroot(profile=self.config['xsysroot_profile'])
+        return self._sysroot
+
     def _complete_config(self):
-        self.config['sysroot'] = self.sysroot.query('sysroot')
-        self.config['systmp'] = self.sysroot.query('tmp')
+        self.config['sysroot'] = self.profile_settings['sysroot']
+        self.config['systmp'] = self.profile_settings['tmp']
         self.config['num_cpus'] = multiprocessing.cpu_count()
-        self.config['sources_directory'] ='{}/{}'.format(self.sysroot.query('tmp'), self.config['qt5_clone_dir'])
-        self.config['bld_directory'] ='{}/{}'.format(self.sysroot.query('tmp'), self.config['qt5_bld_dir'])
-        self.config['cross_install_dir']='{}{}'.format(self.sysroot.query('sysroot'), self.config['qt5_install_prefix'])
+        self.config['sources_directory'] ='{}/{}'.format(self.profile_settings['tmp'], self.config['qt5_clone_dir'])
+        self.config['bld_directory'] ='{}/{}'.format(self.profile_settings['tmp'], self.config['qt5_bld_dir'])
+        self.config['cross_install_dir']='{}{}'.format(self.profile_settings['sysroot'], self.config['qt5_install_prefix'])
         self.config['qt5_cross_qt_conf']='{sysroot}/{qt5_install_prefix}/{qt5_cross_binaries}/qt.conf'.format(**self.config)
 
+        # Cached and distributed builds compile through wrappers named after the cross tools, see cross_compiler_wrappers
+        self.config['cross_compile'] = '{rpi_tools}/{xgcc_path64}/{xgcc_suffix}'.format(**self.config)
+        self.config['cross_prefix'] = self.config['cross_compile']
+        if self.cross and (self.ccache_dir or self.config.get('distcc_hosts', '').strip()):
+            self.config['cross_compile'] = '{}/xsysroot-cc/bin/{}'.format(self.profile_settings['tmp'], self.config['xgcc_suffix'])
+
+        if self.offload:
+            # Native compilation with the sysroot compilers forwarded to the host cross compiler
+            self.config['offload_prefix'] = '{rpi_tools}/{xgcc_path64}/{xgcc_suffix}'.format(**self.config)
+
         if not self.cross:
             # Native compilation needs to make QT5 believe the cross compiler is the local one
             self.config['rpi_tools'] = ''
             self.config['xgcc_path64'] = ''
             self.config['xgcc_suffix'] = '/usr/bin/'
             self.config['sysroot'] = '/'
+            self.config['cross_compile'] = '/usr/bin/'
+            if self.offload:
+                self.config['cross_compile'] = '/tmp/xsysroot-offload/bin/'
 
         self.config['configure_release'] = self.config['configure_release'].format(**self.config)
         self.config['configure_debug'] = self.config['configure_debug'].format(**self.config)
@@ -70,6 +110,420 @@ class Builder():
 
         self.host_numcpus=multiprocessing.cpu_count()
 
+    def _is_reachable(self, host, port=3632, timeout=1):
+        try:
+            socket.create_connection((host, port), timeout).close()
+            return True
+        except (socket.error, socket.timeout):
+            return False
+
+    def distcc_workers(self):
+        '''
+        Returns the reachable workers from the "distcc_hosts" setting, in DISTCC_HOSTS format,
+        and the total number of jobs they take, i.e. "10.0.0.2/16 127.0.0.1:3633/8,lzo".
+        Workers not answering on their port are left out, ssh workers ("@host") are not checked.
+        Returns (None, num_cpus) to compile locally if there are no workers or distcc is missing.
+        '''
+        if self._distcc:
+            return self._distcc
+
+        self._distcc=(None, self.config['num_cpus'])
+        hosts=self.config.get('distcc_hosts', '').split()
+        if not hosts:
+            return self._distcc
+
+        if os.system('which distcc > /dev/null 2>&1'):
+            print '>>> distcc not found, compiling locally'
+            return self._distcc
+
+        workers=[]
+        jobs=0
+        for host in hosts:
+            if host.startswith('--'):
+                # distcc options such as --randomize
+                workers.append(host)
+                continue
+
+            address=re.split('[/,]', host)[0]
+            limit=re.search('/(\d+)', host)
+            limit=int(limit.group(1)) if limit else (2 if address == 'localhost' else 4)
+            name, _, port=address.partition(':')
+            if address == 'localhost' or address.startswith('@') or self._is_reachable(name, int(port or 3632)):
+                workers.append(host)
+                jobs += limit
+            else:
+                print '>>> distcc worker {} is unreachable, leaving it out'.format(address)
+
+        if jobs:
+            self._distcc=(' '.join(workers), jobs)
+        else:
+            print '>>> no distcc workers reachable, compiling locally'
+
+        return self._distcc
+
+    def cross_compiler_wrappers(self):
+        '''
+        Writes the tools for the CROSS_COMPILE prefix of cached and distributed builds: the compilers
+        run through ccache and distcc, each one only if installed, the other tools are links to the cross
+        toolchain. Only the target compilers are replaced, the host tools built along with QT5 use the host compiler.
+        '''
+        if self.config['cross_compile'] == self.config['cross_prefix']:
+            return True
+
+        wrappers=os.path.dirname(self.config['cross_compile'])
+        if not os.path.isdir(wrappers):
+            os.makedirs(wrappers)
+
+        workers, _=self.distcc_workers()
+        for tool in ('gcc', 'g++', 'cpp', 'c++'):
+            wrapper='{}{}'.format(self.config['cross_compile'], tool)
+            real='{}{}'.format(self.config['cross_prefix'], tool)
+            script=[ '#!/bin/sh' ]
+            if self.ccache_dir:
+                script.append('export CCACHE_DIR="${{CCACHE_DIR:-{}}}"'.format(self.ccache_dir))
+                if workers:
+                    script.append('command -v distcc > /dev/null && export CCACHE_PREFIX=distcc')
+                script.append('command -v ccache > /dev/null && exec ccache {} "$@"'.format(real))
+            if workers:
+                script.append('command -v distcc > /dev/null && exec distcc {} "$@"'.format(real))
+            script.append('exec {} "$@"'.format(real))
+
+            with open(wrapper, 'w') as f:
+                f.write('\n'.join(script) + '\n')
+            os.chmod(wrapper, 0755)
+
+        for tool in ('ar', 'as', 'ld', 'nm', 'objcopy', 'objdump', 'ranlib', 'readelf', 'strip'):
+            wrapper='{}{}'.format(self.config['cross_compile'], tool)
+            if os.path.lexists(wrapper):
+                os.unlink(wrapper)
+            os.symlink('{}{}'.format(self.config['cross_prefix'], tool), wrapper)
+
+        return True
+
+    def _jobs_file(self):
+        return os.path.join(self.config['systmp'], 'xsysroot-jobs.json')
+
+    def job_peaks(self):
+        '''
+        Returns the peak memory in kilobytes of the compile and link jobs measured on the last builds,
+        keyed by component (qt5, qt5-native, webengine), see run_build
+        '''
+        try:
+            with open(self._jobs_file(), 'r') as f:
+                return json.loads(f.read())
+        except (IOError, ValueError):
+            return {}
+
+    def expected_peaks(self, component):
+        '''
+        Peak memory of a compile and a link job of a component, as measured or from "job_memory"
+        '''
+        defaults=self.config.get('job_memory', {})
+        measured=self.job_peaks().get(component, {})
+        return dict((kind, measured.get(kind) or xsysroot.parse_size(defaults.get(kind, size)) / 1024)
+                    for kind, size in (('compile', '1G'), ('link', '4G')))
+
+    def job_limits(self, component):
+        '''
+        Returns the compile jobs, link jobs and load average limit for a build of a component,
+        from the available memory less "memory_reserve", the load and the distcc workers
+        '''
+        cpus=self.cpu_budget or self.host_numcpus
+        if (component, cpus) in self._job_limits:
+            return self._job_limits[(component, cpus)]
+
+        peaks=self.expected_peaks(component)
+        workers, jobs=self.distcc_workers() if self.cross else (None, 0)
+        compile_jobs, link_jobs, load=scheduler.job_limits(cpus, peaks['compile'], peaks['link'],
+                                                           self._memory_reserve(), jobs if workers else 0)
+        print '>>> {} compile jobs, {} link jobs, load limit {}'.format(compile_jobs, link_jobs, load)
+        self._job_limits[(component, cpus)]=(compile_jobs, link_jobs, load)
+        return self._job_limits[(component, cpus)]
+
+    def _memory_reserve(self):
+        return xsysroot.parse_size(self.config.get('memory_reserve', '2G')) / 1024
+
+    def make_environment(self, component='qt5'):
+        '''
+        Returns the environment and the make flags, with the number of jobs scaled to the reachable
+        distcc workers, the memory and the load on the host, see job_limits. Ninja gets the same limits.
+        The compiler cache lives in "ccache_dir", paths under the profile tmp directory are hashed
+        relative to it so they match across clones and build directories.
+        '''
+        environment=[]
+        workers, _=self.distcc_workers()
+        jobs, link_jobs, load=self.job_limits(component)
+        if workers:
+            print '>>> distributed build with {} jobs on {}'.format(jobs, workers)
+            environment.append('DISTCC_HOSTS="{}"'.format(workers))
+
+        if self.ccache_dir:
+            environment.append('CCACHE_DIR="{}" CCACHE_BASEDIR="{}"'.format(self.ccache_dir, self.config['systmp']))
+
+        environment.append('NINJAFLAGS="-j {} -l {}" NINJAJOBS="-j {}" GYP_LINK_CONCURRENCY={}'.format(jobs, load, jobs, link_jobs))
+        return ' '.join(environment), '-j {} -l {}'.format(jobs, load)
+
+    def run_build(self, command, component):
+        '''
+        Runs a make command under the job scheduler, which measures the memory of the compile and link jobs
+        for the next builds and pauses jobs while memory runs short. Returns the exit status.
+        '''
+        _, link_jobs, _=self.job_limits(component)
+        process=subprocess.Popen(command, shell=True)
+        governor=scheduler.JobGovernor(process.pid, link_jobs, self._memory_reserve(), self.expected_peaks(component))
+        governor.start()
+        try:
+            rc=process.wait()
+        finally:
+            governor.stop()
+
+        if governor.peaks:
+            print '>>> peak job memory: {}'.format(', '.join('{} {} MB'.format(kind, peak / 1024)
+                                                             for kind, peak in sorted(governor.peaks.items())))
+            # an incremental build can run a few small links only, the largest peak seen is kept
+            peaks=self.job_peaks()
+            stored=peaks.setdefault(component, {})
+            for kind, peak in governor.peaks.items():
+                if peak:
+                    stored[kind]=max(stored.get(kind, 0), peak)
+            with open(self._jobs_file(), 'w') as f:
+                f.write(json.dumps(peaks, indent=2, sort_keys=True))
+
+        return rc
+
+    def ccache_counters(self):
+        '''
+        Returns the compiler cache hits and misses so far, or None if ccache is not in use.
+        '''
+        if not self.ccache_dir:
+            return None
+
+        environment=dict(os.environ, CCACHE_DIR=self.ccache_dir)
+        try:
+            # ccache 3.7 and newer print machine readable statistics
+            output=subprocess.check_output([ 'ccache', '--print-stats' ], env=environment, stderr=subprocess.STDOUT)
+            values=dict(line.split('\t', 1) for line in output.splitlines() if '\t' in line)
+            return { 'hits': int(values.get('direct_cache_hit', 0)) + int(values.get('preprocessed_cache_hit', 0)),
+                     'misses': int(values.get('cache_miss', 0)) }
+        except (OSError, ValueError):
+            return None
+        except subprocess.CalledProcessError:
+            pass
+
+        try:
+            output=subprocess.check_output([ 'ccache', '-s' ], env=environment)
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+        counter=lambda name: sum(int(n) for n in re.findall(r'^{}\s+(\d+)'.format(name), output, re.MULTILINE))
+        return { 'hits': counter(r'cache hit \((?:direct|preprocessed)\)'), 'misses': counter('cache miss') }
+
+    def start_ccache(self):
+        '''
+        Applies the "ccache_size" limit and returns the counters before a build, see record_ccache
+        '''
+        if self.ccache_dir and not self.dry_run:
+            if not os.path.isdir(self.ccache_dir):
+                os.makedirs(self.ccache_dir)
+            os.system('CCACHE_DIR="{}" ccache -M {} > /dev/null 2>&1'.format(self.ccache_dir, self.config.get('ccache_size', '20G')))
+
+        return self.ccache_counters()
+
+    def record_ccache(self, component, before):
+        '''
+        Keeps the compiler cache hits and misses of a build of a component (qt5, webengine)
+        in the cache directory, for the status report
+        '''
+        after=self.ccache_counters()
+        if not before or not after:
+            return
+
+        stats={ 'hits': after['hits'] - before['hits'], 'misses': after['misses'] - before['misses'], 'time': time.ctime() }
+        print '>>> compiler cache: {hits} hits, {misses} misses'.format(**stats)
+
+        history=self.ccache_history()
+        history[component]=stats
+        with open(os.path.join(self.ccache_dir, 'xsysroot-builds.json'), 'w') as f:
+            f.write(json.dumps(history, indent=2))
+
+    def ccache_history(self):
+        try:
+            with open(os.path.join(self.ccache_dir, 'xsysroot-builds.json'), 'r') as f:
+                return json.loads(f.read())
+        except (IOError, ValueError):
+            return {}
+
+    def submodules(self):
+        '''
+        Returns the QT5 submodules listed in the .gitmodules file of the super-repo, keyed by name,
+        with their path and the modules they depend on ("depends" and "recommends" entries).
+        '''
+        modules={}
+        try:
+            with open(os.path.join(self.config['sources_directory'], '.gitmodules'), 'r') as f:
+                lines=f.read().splitlines()
+        except IOError:
+            return modules
+
+        module=None
+        for line in lines:
+            section=re.match(r'\s*\[submodule\s+"(.+)"\]', line)
+            if section:
+                module=modules.setdefault(section.group(1), { 'path': section.group(1), 'depends': [] })
+                continue
+
+            key, sep, value=line.partition('=')
+            if module is None or not sep:
+                continue
+            key=key.strip()
+            if key == 'path':
+                module['path']=value.strip()
+            elif key in ('depends', 'recommends'):
+                module['depends'] += value.split()
+
+        return modules
+
+    def module_revision(self, module, path=None):
+        '''
+        Fingerprint of the sources of a submodule: its git revision, local changes,
+        and the patch set for it in patches/<module>. None if it is not checked out.
+        '''
+        directory=os.path.join(self.config['sources_directory'], path or module)
+        if not os.path.exists(os.path.join(directory, '.git')):
+            return None
+
+        try:
+            with open(os.devnull, 'w') as devnull:
+                revision=subprocess.check_output([ 'git', 'rev-parse', 'HEAD' ], cwd=directory, stderr=devnull).strip()
+                changes=subprocess.check_output([ 'git', 'diff', 'HEAD' ], cwd=directory, stderr=devnull)
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+        digest=hashlib.sha1(changes)
+        for root, dirs, files in os.walk(os.path.join('patches', module)):
+            dirs.sort()
+            for name in sorted(files):
+                filename=os.path.join(root, name)
+                digest.update(filename)
+                with open(filename, 'rb') as f:
+                    digest.update(f.read())
+
+        return '{}-{}'.format(revision, digest.hexdigest()[:12])
+
+    def _stages_file(self):
+        return os.path.join(self.config['systmp'], 'xsysroot-stages.json')
+
+    def stage_records(self):
+        '''
+        Returns the completion records of the build stages, keyed by stage name, see run_stage
+        '''
+        with stages_lock:
+            return self._read_stages()
+
+    def _read_stages(self):
+        try:
+            with open(self._stages_file(), 'r') as f:
+                return json.loads(f.read())
+        except (IOError, ValueError):
+            return {}
+
+    def _save_stage(self, name, record):
+        with stages_lock:
+            records=self._read_stages()
+            if record:
+                records[name]=record
+            else:
+                records.pop(name, None)
+
+            if not os.path.isdir(self.config['systmp']):
+                os.makedirs(self.config['systmp'])
+
+            # replaced in one go, a build running alongside never reads a partial file
+            temp='{}.{}'.format(self._stages_file(), os.getpid())
+            with open(temp, 'w') as f:
+                f.write(json.dumps(records, indent=2, sort_keys=True))
+            os.rename(temp, self._stages_file())
+
+    def stage_fingerprint(self, inputs, after=()):
+        '''
+        Hash of the inputs of a stage and the fingerprints of the stages it comes after, so a stage
+        whose inputs change invalidates everything built on top of it, a rerun with the same inputs does not
+        '''
+        records=self.stage_records()
+        fingerprints=[ records[name]['fingerprint'] if name in records else None for name in after ]
+        return hashlib.sha1(json.dumps([ inputs, fingerprints ], sort_keys=True)).hexdigest()
+
+    def is_stage_forced(self, name):
+        return bool(self.forced_stages.intersection(('all', name, name.split(':')[-1])))
+
+    def run_stage(self, name, step, inputs=None, after=None, done=None):
+        '''
+        Runs a build stage, named "component:stage", unless its completion record matches the
+        fingerprint of its inputs, and the outputs are still there according to "done".
+        Inputs is a callable returning something json serializable, the stage comes after
+        the previous stage run by this builder unless "after" names the stages.
+        Returns True if the stage is complete, the record is dropped if the step fails.
+        '''
+        if after is None:
+            after=[ self._previous_stage ] if self._previous_stage else []
+        self._previous_stage=name
+
+        fingerprint=self.stage_fingerprint(inputs() if inputs else None, after)
+        record=self.stage_records().get(name)
+        if record and record['fingerprint'] == fingerprint and not self.is_stage_forced(name) \
+                and (not done or done()):
+            print '>>> stage {} is up to date, completed on {}'.format(name, record['time'])
+            self.record_telemetry(name, fingerprint, True, { 'skipped': True })
+            return True
+
+        print '>>> stage {} starting at {}'.format(name, time.ctime())
+        meter=telemetry.StageMeter()
+        meter.start()
+        ok=False
+        try:
+            ok=step()
+        finally:
+            self.record_telemetry(name, fingerprint, ok, meter.stop())
+
+        if not ok:
+            print '>>> stage {} failed'.format(name)
+            if not self.dry_run:
+                self._save_stage(name, None)
+            return False
+
+        if not self.dry_run:
+            # the inputs are taken again, a stage such as clone provides the inputs of the next ones
+            fingerprint=self.stage_fingerprint(inputs() if inputs else None, after)
+            self._save_stage(name, { 'fingerprint': fingerprint, 'time': time.ctime(), 'completed': time.time() })
+        return True
+
+    def _history_file(self):
+        return os.path.expanduser(self.config.get('build_history', '~/.xsysroot-cache/build-history.jsonl'))
+
+    def record_telemetry(self, name, fingerprint, ok, measures):
+        '''
+        Appends the measures of a stage to the run history, see telemetry.StageMeter
+        '''
+        if self.dry_run:
+            return
+
+        record=dict(measures, run=telemetry.run_id, stage=name, fingerprint=fingerprint, ok=bool(ok), time=time.ctime())
+        if not measures.get('skipped'):
+            print '>>> stage {} took {wall:.0f}s, {cpu:.0f}s cpu, peak memory {rss} MB, {read} MB read, {written} MB written'.format(
+                name, cpu=measures['user'] + measures['system'], rss=measures['peak_rss'] / 1024**2,
+                read=measures['read_bytes'] / 1024**2, written=measures['written_bytes'] / 1024**2, **measures)
+        telemetry.append_history(self._history_file(), record)
+
+    def run_stages(self, stages):
+        '''
+        Runs a list of stages, (name, step, inputs, after, done) tuples as in run_stage,
+        up to the first one that fails. Returns True if all of them are complete.
+        '''
+        for stage in stages:
+            if not self.run_stage(*stage):
+                return False
+        return True
+
     def are_sources_cloned(self):
         return os.path.isdir(self.config['sources_directory'])
 
@@ -77,7 +531,7 @@ class Builder():
         return os.path.isdir(self.config['cross_install_dir'])
 
     def is_sysroot_mounted(self):
-        return self.sysroot.is_mounted()
+        return xsysroot.MountIndex().is_mounted(self.profile_settings['sysroot'])
 
     def are_cross_tools_built(self):
         x64bins='{cross_install_dir}/{qt5_cross_binaries}'.format(**self.config)
@@ -86,12 +540,23 @@ class Builder():
     def dump_configuration(self):
         pprint.pprint(self.config, indent=2)
 
-    def status(self):
-        print 'sysroot mounted:', self.sysroot.is_mounted()
+    def status(self, run=None, compare=None):
+        print 'sysroot mounted:', self.is_sysroot_mounted()
         print 'QT5 sources cloned:', self.are_sources_cloned()
         print 'QT5 installed:', self.is_qt5_installed()
         print 'QT5 cross tools built:', self.are_cross_tools_built()
 
+        for name, record in sorted(self.stage_records().items()):
+            print 'stage {} completed on {}'.format(name, record['time'])
+
+        if self.ccache_dir:
+            for component, stats in sorted(self.ccache_history().items()):
+                total=stats['hits'] + stats['misses']
+                print 'compiler cache, last {} build: {:.1f}% hits ({} of {}) on {}'.format(
+                    component, 100.0 * stats['hits'] / total if total else 0, stats['hits'], total, stats['time'])
+
+        telemetry.report(telemetry.read_history(self._history_file()), run, compare)
+
     def purge(self):
         clean_sources='sudo rm -rf {sources_directory}'.format(**self.config)
         clean_binaries='sudo rm -rf {cross_install_dir}'.format(**self.config)
@@ -104,15 +569,17 @@ class Builder():
             return True
         #this is the directory clone source files.
         os.system(clean_sources)
+        if os.path.isfile(self._stages_file()):
+            os.unlink(self._stages_file())
 
-        if self.sysroot.is_mounted():
+        if self.is_sysroot_mounted():
             print "ssyroot is mounted"
             os.system(clean_binaries)
         else:
             print 'Warning: sysroot is not mounted - cannot delete binaries'
 
     def qcow_file_exists(self):
-        qcow_file = self.sysroot.query('qcow_image')
+        qcow_file = self.profile_settings['qcow_image']
         if os.path.exists(qcow_file):
             return True
         else:
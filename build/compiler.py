@@ -29,10 +29,28 @@
 #
 
 import os
+import json
+import xsysroot
 from builder import Builder
 
 class CompilerQt5(Builder):
-    
+
+    # cached qcow2 layer with the sysroot dependencies installed, see dependency_layer_key()
+    dependency_layer=None
+
+    # bump when the fix-up steps done on the sysroot change, so cached dependency layers are rebuilt
+    fixup_version=1
+    relink_directories=('/usr/lib',)
+
+    # submodule revisions of the last successful cross build, kept in the build directory
+    modules_record='xsysroot-modules.json'
+
+    # modules to rebuild in build order, None for the whole super-repo, see plan_modules()
+    rebuild_modules=None
+    module_revisions=None
+    module_paths={}
+    configure_options=None
+
     def clone_repos(self):
         if self.are_sources_cloned():
             print 'QT5 sources already cloned, continuing'
@@ -68,9 +86,27 @@ class CompilerQt5(Builder):
         print '>>> baptizing image'
         if self.dry_run:
             return True
+
+        # an existing qcow is kept, it can hold an installed QT5 build. Only without one
+        # a new scratch overlay starts from the dependencies layer, if built for this setup
+        layer=self.sysroot.find_layer(self.dependency_layer_key())
         if self.qcow_file_exists():
             print "since qcow is there, don't do renew."
+            if layer and self.sysroot.uses_layer(layer):
+                self.dependency_layer=layer
+            elif layer:
+                print '>>> WARNING: qcow image is not on top of the cached dependencies layer {}, ' \
+                    'remove {} to start from it'.format(layer, self.profile_settings['qcow_image'])
             return self.sysroot.mount()
+
+        if layer:
+            print '>>> using cached dependencies layer', layer
+            self.dependency_layer=layer
+            if self.sysroot.is_mounted():
+                if not self.sysroot.umount():
+                    return False
+            return self.sysroot.renew(layer=layer)
+
         # make sure the image is not currently in use
         if self.sysroot.is_mounted():
             if not self.sysroot.umount():
@@ -89,6 +125,17 @@ class CompilerQt5(Builder):
         #here, mount again.
         return self.sysroot.mount()
 
+    def dependency_layer_key(self):
+        '''
+        Key of the qcow2 layer holding the expanded sysroot with dependencies installed and paths fixed.
+        It changes with the backing image, the dependency list, the image size and the fix-up steps,
+        through the directories they relink and fixup_version.
+        '''
+        return self.sysroot.layer_key(self.config['sysroot_dependencies'],
+                                      self.profile_settings.get('qcow_size', ''),
+                                      ' '.join(self.relink_directories),
+                                      self.fixup_version)
+
     def install_dependencies(self):
         # Put the system up to date and install QT5 build dependencies
         # We might need more, for example TLS and further backends
@@ -98,49 +145,190 @@ class CompilerQt5(Builder):
             print '>>>', command
             return True
 
-        # if self.sysroot.execute('dpkg -l libc6-de1') == 0:
-        #     print ">>> dependencies have been installed."
-        #     return True
+        if self.dependency_layer:
+            print '>>> dependencies already installed in layer', self.dependency_layer
+            return True
 
-        if self.sysroot.execute('apt-get update'):
-            print ">>> sysroot apt-get update error"
+        # only go through the emulated apt-get if something is missing in the sysroot
+        try:
+            missing=self.sysroot.missing_packages(self.config['sysroot_dependencies'])
+        except ValueError as e:
+            print '>>> sysroot_dependencies: {}'.format(e)
             return False
 
-        if self.sysroot.execute(command):
+        if missing is None:
             return False
+
+        if not missing:
+            print ">>> dependencies have been installed."
+        else:
+            print '>>> missing dependencies:', ' '.join(missing)
+            if self.sysroot.apt_install(missing):
+                print ">>> sysroot apt-get error"
+                return False
         print ">>> fix qualitied path"
         self._fix_qualified_paths()
-        return True
+
+        # keep this state as a layer so the next baptize can start from here, an existing
+        # layer for this setup is left alone, other qcow images can be on top of it
+        if self.sysroot.find_layer(self.dependency_layer_key()):
+            return True
+        self.dependency_layer=self.sysroot.commit_layer(self.dependency_layer_key())
+        return self.dependency_layer is not None
 
     def _fix_qualified_paths(self):
-        # Fix relative symlinks to libdl and libm (so called fixQualifiedPaths in QT jargon)
-        # TODO: Use readlink instead of hardcoded destination to .so versioned filename,
-        #       but no big deal really. This is a development / builder box.
-        self.sysroot.execute('rm -fv /usr/lib/arm-linux-gnueabihf/libdl.so')
-        self.sysroot.execute('cp -fv /lib/arm-linux-gnueabihf/libdl.so.2 /usr/lib/arm-linux-gnueabihf/libdl.so')
-        self.sysroot.execute('rm -fv /usr/lib/arm-linux-gnueabihf/libm.so')
-        self.sysroot.execute('cp -fv /lib/arm-linux-gnueabihf/libm.so.6 /usr/lib/arm-linux-gnueabihf/libm.so')
-        
-        # Fix relative path for libudev library. This fixes plugging HID devices on-the-fly
-        # The reason for this ugly patch is that "configure" seems to have lost the relative sysroot directory
-        self.sysroot.execute('rm -fv /usr/lib/arm-linux-gnueabihf/libudev.so')
-        os.system ('sudo ln -sfv {}/lib/arm-linux-gnueabihf/libudev.so.1.5.0 ' \
-                   '{}/usr/lib/arm-linux-gnueabihf/libudev.so'.format(
-                       self.sysroot.query('sysroot'),
-                       self.sysroot.query('sysroot')))
+        # Make absolute library symlinks relative to the sysroot (so called fixQualifiedPaths in QT jargon),
+        # otherwise the cross linker follows them into the host libraries, i.e. libdl, libm and libudev.
+        self.sysroot.relink_libraries(self.relink_directories)
+
+    def offload_compilers(self):
+        '''
+        In offload mode, forwards the compilers in the sysroot to the host cross compiler for native builds.
+        It needs to be in place for configure, make and install, bindings are gone once the sysroot is unmounted.
+        '''
+        if not self.offload or self.dry_run:
+            return True
 
+        return self.sysroot.offload_compilers(self.config['offload_prefix']) is not None
 
-    def configure(self, core_tools=False):
+    def _modules_record_file(self):
+        return os.path.join(self.config['bld_directory'], self.modules_record)
+
+    def read_modules_record(self):
+        try:
+            with open(self._modules_record_file(), 'r') as f:
+                return json.loads(f.read())
+        except (IOError, ValueError):
+            return {}
+
+    def configured_modules(self, configure_opts):
+        '''
+        Returns the submodules configure builds, all but those given to -skip. A skipped module
+        can still have a build tree of its own, like qtwebengine built as root by CompilerWebengine.
+        '''
+        options=configure_opts.split()
+        skipped=set(options[index + 1] for index, option in enumerate(options[:-1]) if option == '-skip')
+        return dict((name, module) for name, module in self.submodules().items()
+                    if name not in skipped and module['path'] not in skipped)
+
+    def configured_revisions(self):
+        '''
+        The inputs of the make and install stages: the fingerprints of the configured submodules,
+        so patching a skipped one such as qtwebengine does not rebuild QT5
+        '''
+        return dict((name, self.module_revision(name, module['path']))
+                    for name, module in self.configured_modules(self.configure_options or '').items())
+
+    def plan_modules(self, configure_opts):
+        '''
+        Decides what the cross build has to go through, comparing the submodule revisions against
+        the record of the last successful build. Sets rebuild_modules to the modules whose sources
+        or patches changed along with the modules depending on them, in build order, or to None
+        if the whole super-repo needs configure and make: no record, a different configuration,
+        or a sysroot without QT5 installed, i.e. renewed since the record was taken.
+        '''
+        self.rebuild_modules=None
+        self.module_revisions=None
+
+        # only the modules configured in the build directory are built
+        modules=dict((name, module) for name, module in self.configured_modules(configure_opts).items()
+                     if os.path.isfile(os.path.join(self.config['bld_directory'], module['path'], 'Makefile')))
+        self.module_paths=dict((name, module['path']) for name, module in modules.items())
+        revisions=dict((name, self.module_revision(name, module['path'])) for name, module in modules.items())
+        self.module_revisions=dict((name, revision) for name, revision in revisions.items() if revision)
+
+        record=self.read_modules_record()
+        if not self.is_qt5_installed():
+            print '>>> QT5 is not installed in the sysroot, building all modules'
+            return None
+
+        if not record or record.get('configure') != configure_opts or not modules \
+                or not os.path.isfile(os.path.join(self.config['bld_directory'], 'Makefile')):
+            return None
+
+        changed=set(name for name, revision in revisions.items()
+                    if not revision or record.get('modules', {}).get(name) != revision)
+
+        # the modules depending on a changed one are rebuilt as well
+        dependents={}
+        for name, module in modules.items():
+            for dependency in module['depends']:
+                dependents.setdefault(dependency, set()).add(name)
+
+        pending=list(changed)
+        while pending:
+            for name in dependents.get(pending.pop(), ()):
+                if name not in changed:
+                    changed.add(name)
+                    pending.append(name)
+
+        ordered=[]
+        while changed:
+            ready=sorted(name for name in changed if not changed.intersection(modules[name]['depends']))
+            if not ready:
+                # dependency loop in .gitmodules, build the rest in name order
+                ready=sorted(changed)
+            ordered += ready
+            changed.difference_update(ready)
+
+        self.rebuild_modules=ordered
+        return ordered
+
+    def record_modules(self):
+        '''
+        Saves the submodule revisions once the cross build is installed, see plan_modules
+        '''
+        if not self.module_revisions or self.dry_run:
+            return
+
+        with open(self._modules_record_file(), 'w') as f:
+            f.write(json.dumps({ 'configure': self.configure_options, 'modules': self.module_revisions }, indent=2))
+
+    def configure_options_for(self, core_tools=False):
         if core_tools:
-            configure_opts=self.config['configure_core_tools']
-        else:
-            configure_opts=self.config['configure_release'] if self.release else self.config['configure_debug']
+            return self.config['configure_core_tools']
+        return self.config['configure_release'] if self.release else self.config['configure_debug']
+
+    def stages(self, baptize=False, core_tools=False):
+        '''
+        The build stages for run_stages: clone, the sysroot ones when baptizing, then configure, make and install.
+        Configure depends on the sysroot dependencies even when they come from an earlier build.
+        '''
+        kind='qt5-cross' if self.cross else 'qt5-native'
+        build_directory=self.config['bld_directory'] if self.cross else \
+            '{}/{}'.format(self.config['systmp'], self.config['qt5_bld_dir_native'])
+        self.configure_options=self.configure_options_for(core_tools)
+
+        stages=[ ('{}:clone'.format(kind), self.clone_repos,
+                  lambda: [ self.config['qt5_repo_url'], self.config['qt5_version'] ], [], self.are_sources_cloned) ]
+        if baptize:
+            stages += [ ('sysroot:baptize', self.baptize_image,
+                         lambda: [ self.profile_settings.get(key) for key in ('backing_image', 'qcow_image', 'qcow_size') ],
+                         [], self.is_sysroot_mounted),
+                        ('sysroot:dependencies', self.install_dependencies,
+                         lambda: [ self.config['sysroot_dependencies'] ], [ 'sysroot:baptize' ], None) ]
+
+        stages += [ ('{}:configure'.format(kind), lambda: self.configure(core_tools=core_tools),
+                     lambda: [ self.configure_options, self.config['cross_compile'] ],
+                     [ '{}:clone'.format(kind), 'sysroot:dependencies' ],
+                     lambda: os.path.isfile(os.path.join(build_directory, 'Makefile'))),
+                    ('{}:make'.format(kind), self.make, self.configured_revisions, None, None),
+                    ('{}:install'.format(kind), self.install, self.configured_revisions, None, self.is_qt5_installed) ]
+        return stages
+
+    def configure(self, core_tools=False):
+        configure_opts=self.configure_options_for(core_tools)
 
+        self.configure_options=configure_opts
         if self.cross:
             command='mkdir -p {} ; cd {} && {}/configure {}'.format(self.config['bld_directory'], self.config['bld_directory'],
                                                                     self.config['sources_directory'], configure_opts)
             print "configure command cmd: {0} in configure".format(command)
 
+            if self.plan_modules(configure_opts) is not None:
+                print '>>> configuration unchanged since the last build, modules to rebuild:', ' '.join(self.rebuild_modules) or 'none'
+                return self.dry_run or self.cross_compiler_wrappers()
+
         else:
             command='xsysroot -x "/bin/bash -c \'mkdir -p /tmp/{}; cd /tmp/{} && /tmp/{}/configure {}\'"'.format(
                                         self.config['qt5_bld_dir_native'],
@@ -154,22 +342,47 @@ class CompilerQt5(Builder):
             print '>>>', command
             return True
 
+        if not self.offload_compilers() or not self.cross_compiler_wrappers():
+            return False
+
+        if self.cross and os.path.isfile(self._modules_record_file()):
+            # the record is only valid for the configuration it was built with
+            os.unlink(self._modules_record_file())
+
         rc = os.system(command)
         return os.WEXITSTATUS(rc) == 0
 
 
     def make(self):
+        if self.cross and self.module_revisions is None and self.configure_options:
+            # configure was up to date, find out what changed since the last build
+            self.plan_modules(self.configure_options)
+
         if self.cross:
-            command='cd {bld_directory} && make -j {num_cpus}'.format(**self.config)
+            environment, jobs=self.make_environment('qt5')
+            if self.rebuild_modules is None:
+                command='cd {} && {} make {}'.format(self.config['bld_directory'], environment, jobs)
+            elif not self.rebuild_modules:
+                print '>>> all QT5 modules are up to date'
+                return True
+            else:
+                command=' && '.join('cd {}/{} && {} make {}'.format(self.config['bld_directory'], self.module_paths[name], environment, jobs)
+                                    for name in self.rebuild_modules)
         else:
-            command='xsysroot -x "/bin/bash -c \'cd /tmp/{qt5_bld_dir_native} && make -j {num_cpus}\'"'.format(**self.config)
+            jobs, _, load=self.job_limits('qt5-native')
+            command='xsysroot -x "/bin/bash -c \'cd /tmp/{} && make -j {} -l {}\'"'.format(self.config['qt5_bld_dir_native'], jobs, load)
 
         if self.dry_run:
             print '>>>', command
             return True
 
-        rc = os.system(command)
-        return os.WEXITSTATUS(rc) == 0
+        if not self.offload_compilers():
+            return False
+
+        ccache=self.start_ccache() if self.cross else None
+        rc = self.run_build(command, 'qt5' if self.cross else 'qt5-native')
+        self.record_ccache('qt5', ccache)
+        return rc == 0
 
     def install(self):
         # TODO create a qt.conf file
@@ -180,8 +393,20 @@ class CompilerQt5(Builder):
             'HostBinaries = {qt5_install_prefix}/{qt5_cross_binaries}\n'.format(**self.config)
 
         if self.cross:
-            command='cd {bld_directory} && sudo make install && ' \
-                'sudo mv -fv {cross_install_dir}/bin {cross_install_dir}/{qt5_cross_binaries}'.format(**self.config)
+            if self.rebuild_modules is None:
+                install='cd {bld_directory} && sudo make install'.format(**self.config)
+            elif not self.rebuild_modules:
+                print '>>> nothing to install, all QT5 modules are up to date'
+                return True
+            else:
+                install=' && '.join('cd {}/{} && sudo make install'.format(self.config['bld_directory'], self.module_paths[name])
+                                    for name in self.rebuild_modules)
+
+            # host tools are merged into the cross binaries, which are already there on a rebuild
+            command='{} && if [ -d {cross_install_dir}/bin ]; then ' \
+                'sudo mkdir -p {cross_install_dir}/{qt5_cross_binaries} && ' \
+                'sudo cp -a {cross_install_dir}/bin/. {cross_install_dir}/{qt5_cross_binaries}/ && ' \
+                'sudo rm -rf {cross_install_dir}/bin; fi'.format(install, **self.config)
         else:
             command='xsysroot -x "/bin/bash -c \'cd /tmp/{qt5_bld_dir_native} && make install\'"'.format(**self.config)
 
@@ -189,7 +414,14 @@ class CompilerQt5(Builder):
             print '>>>', command
             return True
 
+        if not self.offload_compilers():
+            return False
+
         rc = os.system(command)
+        if not rc and self.cross and self.config['cross_compile'] != self.config['cross_prefix']:
+            # do not leave the distributed build wrappers in the installed device spec
+            os.system('sudo sed -i "s|{cross_compile}|{cross_prefix}|g" {cross_install_dir}/mkspecs/qdevice.pri'.format(**self.config))
+
         if not rc and self.cross:
             # TODO: Make this simpler
             qtconfig_file='{qt5_cross_qt_conf}'.format(**self.config)
@@ -198,12 +430,23 @@ class CompilerQt5(Builder):
                 f.write(qtconfig)
 
             os.system('sudo cp -fv qt.conf {qt5_cross_qt_conf}'.format(**self.config))
+            self.record_modules()
 
         return os.WEXITSTATUS(rc) == 0
 
 
 class CompilerWebengine(Builder):
 
+    def stages(self):
+        '''
+        The build stages for run_stages, on top of the QT5 cross build
+        '''
+        return [ ('webengine:patches', self.apply_patches, lambda: self.module_revision('qtwebengine'), [ 'qt5-cross:install' ], None),
+                 ('webengine:qmake', self.qmake, lambda: [ self.release, self.config['qmake_env'] ], None,
+                  lambda: os.path.isfile('{bld_directory}/qtwebengine/Makefile'.format(**self.config))),
+                 ('webengine:make', self.make, lambda: self.module_revision('qtwebengine'), None, None),
+                 ('webengine:install', self.install, lambda: self.module_revision('qtwebengine'), None, None) ]
+
     def apply_patches(self):
         patches_dir='patches/qtwebengine'
         if os.path.isdir('patches/qtwebengine'):
@@ -213,29 +456,54 @@ class CompilerWebengine(Builder):
                 print '>>>', cmd
                 return True
             else:
-                return os.WEXITSTATUS(os.system(cmd))
+                return os.WEXITSTATUS(os.system(cmd)) == 0
+        return True
+
+    def _uses_ccache(self):
+        # unlike the QT5 wrappers gyp runs the wrapper unchecked, it has to be there
+        return bool(self.ccache_dir and xsysroot.find_program('ccache'))
 
     def qmake(self):
-        qmake_cmd='{}; cd {}/qtwebengine && qmake ' \
+        # gyp puts the target compilers behind ccache or distcc when asked through CC_wrapper,
+        # host compilers are left alone. ccache hands over to distcc through CCACHE_PREFIX.
+        workers, _=self.distcc_workers()
+        # the ninja link pool is sized when gyp runs, to the link jobs the host memory takes
+        wrapper='ccache' if self._uses_ccache() else 'distcc' if workers else None
+        _, link_jobs, _=self.job_limits('webengine')
+        qmake_cmd='{}; cd {}/qtwebengine && GYP_LINK_CONCURRENCY={} {}qmake ' \
             'WEBENGINE_CONFIG+=use_proprietary_codecs CONFIG+={}'.format(
                 self.config['qmake_env'],
                 self.config['bld_directory'],
+                link_jobs,
+                'CC_wrapper={} CXX_wrapper={} '.format(wrapper, wrapper) if wrapper else '',
                 'release' if self.release else 'debug')
         print "amqke_cmd: ", qmake_cmd
         if self.dry_run:
             print 'qmake >>>', qmake_cmd
             return True
         else:
-            return os.WEXITSTATUS(os.system(qmake_cmd))
+            return os.WEXITSTATUS(os.system(qmake_cmd)) == 0
 
     def make(self):
-        make_cmd='{qmake_env}; cd {bld_directory}/qtwebengine && sudo make -j {num_cpus}'.format(**self.config)
+        environment, jobs=self.make_environment('webengine')
+        workers, _=self.distcc_workers()
+        if self._uses_ccache() and workers:
+            environment='{} CCACHE_PREFIX=distcc'.format(environment)
+        if self._uses_ccache():
+            # make runs as root here, keep the cache entries usable by the builds that do not
+            environment='{} CCACHE_UMASK=000'.format(environment)
+
+        make_cmd='{}; cd {}/qtwebengine && sudo {} make {}'.format(
+            self.config['qmake_env'], self.config['bld_directory'], environment, jobs)
         if self.dry_run:
             print 'make command: >>>', make_cmd
             return True
         else:
             print 'make command: >>>', make_cmd
-            return os.WEXITSTATUS(os.system(make_cmd))
+            ccache=self.start_ccache()
+            rc=self.run_build(make_cmd, 'webengine')
+            self.record_ccache('webengine', ccache)
+            return rc == 0
 
     def install(self):
         install_cmd='{qmake_env}; cd {bld_directory}/qtwebengine && sudo make install'.format(**self.config)
@@ -244,6 +512,6 @@ class CompilerWebengine(Builder):
             return True
         else:
             print 'install webengine: ', install_cmd
-            return os.WEXITSTATUS(os.system(install_cmd))
+            return os.WEXITSTATUS(os.system(install_cmd)) == 0
 
 
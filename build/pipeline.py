@@ -0,0 +1,186 @@
+#
+#  The MIT License (MIT)
+#
+#  Copyright (c) 2016-2017 Albert Casals - skarbat@gmail.com
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#  THE SOFTWARE.
+#
+#  pipeline.py
+#
+#  Runs the compile and package stages of a full release as a dependency graph
+#
+#  See the README file for details.
+#
+
+import time
+import threading
+import Queue
+import collections
+
+from builder import Builder
+from compiler import CompilerQt5, CompilerWebengine
+from pack import qt5, webengine, cross_tools, native_tools
+
+class Pipeline():
+    '''
+    Runs build steps as a dependency graph. A step starts once the steps it comes after are complete
+    and the cores it takes fit in the budget, so independent steps run at the same time.
+    Steps after a failed one are skipped, the others carry on.
+    '''
+    def __init__(self, budget):
+        self.budget=budget
+        self.steps=collections.OrderedDict()
+
+    def add(self, name, run, after=(), cpus=1):
+        '''
+        Adds a step, run is called with the number of cores given to it and returns True on success
+        '''
+        self.steps[name]={ 'run': run, 'after': [ step for step in after if step ], 'cpus': max(1, min(cpus, self.budget)) }
+
+    def run(self):
+        '''
+        Returns the result of each step: True if complete, False if failed, None if skipped
+        '''
+        results={}
+        running={}
+        finished=Queue.Queue()
+        used=0
+        started=time.time()
+
+        def work(name, cpus):
+            ok=False
+            start=time.time()
+            try:
+                ok=self.steps[name]['run'](cpus)
+            finally:
+                finished.put((name, bool(ok), time.time() - start))
+
+        times={}
+        while len(results) < len(self.steps):
+            for name, step in self.steps.items():
+                if name in results or name in running:
+                    continue
+
+                after=[ dependency for dependency in step['after'] if dependency in self.steps ]
+                if any(results.get(dependency, True) is not True for dependency in after):
+                    print '>>> skipping {}, it comes after a failed step'.format(name)
+                    results[name]=None
+                elif all(dependency in results for dependency in after) and (not running or used + step['cpus'] <= self.budget):
+                    print '>>> {} starting with {} cores at {}'.format(name, step['cpus'], time.ctime())
+                    running[name]=step['cpus']
+                    used += step['cpus']
+                    thread=threading.Thread(target=work, args=(name, step['cpus']))
+                    thread.daemon=True
+                    thread.start()
+
+            if not running:
+                if len(results) < len(self.steps):
+                    # only a dependency loop leaves steps waiting on nothing
+                    for name in self.steps:
+                        if name not in results:
+                            print '>>> skipping {}, dependency loop'.format(name)
+                            results[name]=None
+                break
+
+            name, ok, elapsed=finished.get()
+            used -= running.pop(name)
+            results[name]=ok
+            times[name]=elapsed
+            print '>>> {} {} after {:.0f} seconds'.format(name, 'complete' if ok else 'FAILED', elapsed)
+
+        wall=time.time() - started
+        print '>>> {} steps in {:.0f} seconds, {:.0f} seconds one after another'.format(len(times), wall, sum(times.values()))
+        return results
+
+def package_stage(packager, package):
+    '''
+    Returns the stage, as in Builder.run_stage, for a package: qt5, webengine, cross-tools or native-tools
+    '''
+    config=packager.config
+    version=lambda: [ config['qt5_debian_version'] ]
+    if package == 'qt5':
+        return ('package:qt5',
+                lambda: qt5.pack_qt5(config['sysroot'], config['qt5_install_prefix'], config['qt5_debian_version'],
+                                     dry_run=packager.dry_run),
+                version, [ 'qt5-cross:install' ], None)
+    elif package == 'webengine':
+        return ('package:webengine',
+                lambda: webengine.pack_webengine(config['sysroot'], config['qt5_install_prefix'], config['qt5_debian_version'],
+                                                 dry_run=packager.dry_run),
+                version, [ 'webengine:install' ], None)
+    elif package == 'cross-tools':
+        return ('package:cross-tools',
+                lambda: cross_tools.pack_tools(config['sysroot'], config['qt5_install_prefix'], config['qt5_debian_version'],
+                                               config['qt5_cross_binaries'],
+                                               '{rpi_tools}/{xgcc_path64}'.format(**config).rstrip('/bin'),
+                                               dry_run=packager.dry_run),
+                version, [ 'qt5-cross:install' ], None)
+    elif package == 'native-tools':
+        return ('package:native-tools',
+                lambda: native_tools.pack_tools(config['sysroot'], config['qt5_install_prefix'], config['qt5_debian_version'],
+                                                'bin', dry_run=packager.dry_run),
+                version, [ 'qt5-native:install' ], None)
+
+def release_pipeline(release=True, baptize=False, offload=False, dry_run=False, forced_stages=(), budget=None):
+    '''
+    The steps of buildall.sh cross and native as one graph: the QT5 cross build, then Webengine and the QT5
+    and cross tools packages at the same time, while the emulated native core tools build runs on a share
+    of the cores. The native install goes last, it would otherwise change the files being packaged.
+    '''
+    cross=CompilerQt5(cross=True, release=release, dry_run=dry_run)
+    native=CompilerQt5(cross=False, release=release, dry_run=dry_run, offload=offload)
+    engine=CompilerWebengine(release=release, dry_run=dry_run)
+    packager=Builder(dry_run=dry_run)
+    for builder in (cross, native, engine, packager):
+        builder.forced_stages=set(forced_stages)
+
+    budget=budget or cross.host_numcpus
+    native_cores=max(1, budget / 4)
+    pipeline=Pipeline(budget)
+
+    def add(builder, stage, after=(), cpus=1):
+        def run(cores):
+            builder.cpu_budget=cores
+            return builder.run_stage(*stage)
+        pipeline.add(stage[0], run, after, cpus)
+
+    # stages of one builder follow each other, unless they name the stages they come after
+    def add_stages(builder, stages, after=(), cpus={}):
+        previous=None
+        for stage in stages:
+            kind=stage[0].split(':')[-1]
+            add(builder, stage, (list(after) if not previous else []) + (stage[3] if stage[3] is not None else [ previous ]),
+                cpus.get(kind, 1))
+            previous=stage[0]
+
+    add_stages(cross, cross.stages(baptize=baptize), cpus={ 'make': budget - native_cores })
+
+    native_stages=native.stages(core_tools=True)
+    add_stages(native, native_stages[:-1], [ 'qt5-cross:clone' ], cpus={ 'make': native_cores })
+    add_stages(engine, engine.stages(), cpus={ 'make': budget - native_cores })
+
+    for package in ('qt5', 'cross-tools', 'webengine'):
+        stage=package_stage(packager, package)
+        add(packager, stage, stage[3])
+
+    add(native, native_stages[-1], [ native_stages[-2][0], 'package:qt5', 'package:cross-tools', 'package:webengine' ])
+    stage=package_stage(packager, 'native-tools')
+    add(packager, stage, stage[3])
+
+    return pipeline
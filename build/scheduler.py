@@ -0,0 +1,221 @@
+#
+#  The MIT License (MIT)
+#
+#  Copyright (c) 2016-2017 Albert Casals - skarbat@gmail.com
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#  THE SOFTWARE.
+#
+#  scheduler.py
+#
+#  Memory and load aware concurrency for the make and ninja builds
+#
+#  See the README file for details.
+#
+
+import os
+import errno
+import signal
+import threading
+
+# Process names of the compile and link jobs, as they show in /proc/<pid>/stat
+compile_tools=('cc1', 'cc1plus', 'cc1obj')
+link_tools=('ld', 'ld.bfd', 'ld.gold', 'collect2', 'lto1')
+
+def memory_info():
+    '''
+    Returns /proc/meminfo in kilobytes, keyed by name, i.e. "MemTotal" and "MemAvailable"
+    '''
+    info={}
+    with open('/proc/meminfo', 'r') as f:
+        for line in f:
+            name, _, value=line.partition(':')
+            if value.split():
+                info[name]=int(value.split()[0])
+
+    if 'MemAvailable' not in info:
+        # kernels older than 3.14
+        info['MemAvailable']=info.get('MemFree', 0) + info.get('Cached', 0) + info.get('Buffers', 0)
+    return info
+
+def job_limits(cpus, compile_kb, link_kb, reserve_kb, distributed_jobs=0):
+    '''
+    Returns the number of compile and link jobs the host can take, from the available memory
+    and the expected peak memory of each job type, along with the load average make and ninja
+    should stay under. Distributed compile jobs only preprocess locally, their count is kept.
+    '''
+    available=max(0, memory_info()['MemAvailable'] - reserve_kb)
+    load=os.getloadavg()[0]
+
+    if distributed_jobs:
+        compile_jobs=distributed_jobs
+    else:
+        # leave out the cores other work on the host is keeping busy
+        compile_jobs=max(1, min(cpus - int(load), available / max(compile_kb, 1)))
+
+    link_jobs=max(1, min(compile_jobs, available / max(link_kb, 1)))
+    return compile_jobs, link_jobs, cpus
+
+def _processes():
+    '''
+    Returns the running processes as { pid: (name, parent pid, start time, state) }
+    '''
+    processes={}
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(pid), 'r') as f:
+                stat=f.read()
+        except IOError:
+            continue
+
+        # the name is in brackets and can have spaces
+        name=stat[stat.find('(') + 1:stat.rfind(')')]
+        fields=stat[stat.rfind(')') + 2:].split()
+        processes[int(pid)]=(name, int(fields[1]), int(fields[19]), fields[0])
+
+    return processes
+
+def descendants(pid):
+    '''
+    Returns the pids of the processes below a process
+    '''
+    children={}
+    for child, (name, parent, start, state) in _processes().items():
+        children.setdefault(parent, []).append(child)
+
+    found=[]
+    pending=list(children.get(pid, []))
+    while pending:
+        child=pending.pop()
+        found.append(child)
+        pending += children.get(child, [])
+    return found
+
+def resident_memory(pid, peak=False):
+    '''
+    Resident memory of a process in kilobytes, or its peak so far, 0 if it is gone
+    '''
+    field='VmHWM:' if peak else 'VmRSS:'
+    try:
+        with open('/proc/{}/status'.format(pid), 'r') as f:
+            for line in f:
+                if line.startswith(field):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return 0
+
+class JobGovernor(threading.Thread):
+    '''
+    Watches the compile and link jobs below a build process while it runs. It keeps their peak memory,
+    and lowers the parallelism when memory runs short or more links run than allowed, by stopping
+    the most recent jobs, which are resumed once there is room again. The oldest job always runs.
+    '''
+    def __init__(self, pid, link_jobs, reserve_kb, peaks=None, interval=1.0):
+        threading.Thread.__init__(self)
+        self.daemon=True
+        self.pid=pid
+        self.link_jobs=link_jobs
+        self.reserve_kb=reserve_kb
+        self.interval=interval
+        self.expected=dict(peaks or {})
+        self.peaks={}
+        self.stopped={}
+        self.finished=threading.Event()
+        self._sudo=False
+
+    def _signal(self, pid, number):
+        try:
+            os.kill(pid, number)
+        except OSError as e:
+            if e.errno == errno.EPERM:
+                # jobs of builds running through sudo
+                if not self._sudo:
+                    print '>>> job scheduler signalling root build jobs through sudo'
+                    self._sudo=True
+                os.system('sudo -n kill -{} {} > /dev/null 2>&1'.format(number, pid))
+
+    def jobs(self):
+        '''
+        Returns the compile and link jobs below the build process, oldest first, as (start, pid, kind) tuples
+        '''
+        processes=_processes()
+        children={}
+        for pid, (name, parent, start, state) in processes.items():
+            children.setdefault(parent, []).append(pid)
+
+        jobs=[]
+        pending=list(children.get(self.pid, []))
+        while pending:
+            pid=pending.pop()
+            pending += children.get(pid, [])
+            name, parent, start, state=processes[pid]
+            kind='compile' if name in compile_tools else 'link' if name in link_tools else None
+            if kind and state != 'Z':
+                jobs.append((start, pid, kind))
+
+        return sorted(jobs)
+
+    def sample(self):
+        jobs=self.jobs()
+        for start, pid, kind in jobs:
+            self.peaks[kind]=max(self.peaks.get(kind, 0), resident_memory(pid, peak=True))
+
+        alive=set(pid for start, pid, kind in jobs)
+        for pid in list(self.stopped):
+            if pid not in alive:
+                del self.stopped[pid]
+
+        running=[ job for job in jobs if job[1] not in self.stopped ]
+        links=[ job for job in running if job[2] == 'link' ]
+        available=memory_info()['MemAvailable']
+
+        if len(running) > 1 and (available < self.reserve_kb or len(links) > self.link_jobs):
+            # one job at a time, a paused job keeps its memory but stops growing, and
+            # the next sample sees whether that and the jobs finishing meanwhile are enough
+            start, pid, kind=links[-1] if len(links) > self.link_jobs and links[-1] != running[0] else running[-1]
+            self._signal(pid, signal.SIGSTOP)
+            self.stopped[pid]=kind
+            print '>>> job scheduler: {} MB available, pausing {} job {}'.format(available / 1024, kind, pid)
+        elif self.stopped:
+            paused=[ job for job in jobs if job[1] in self.stopped ]
+            start, pid, kind=paused[0]
+            needed=self.reserve_kb + self.peaks.get(kind, self.expected.get(kind, 0))
+            # with no job running the oldest paused one goes on regardless, the memory
+            # it holds itself might never leave enough room and the build would hang
+            if not running or (available > needed and (kind != 'link' or len(links) < self.link_jobs)):
+                self._signal(pid, signal.SIGCONT)
+                del self.stopped[pid]
+                print '>>> job scheduler: {} MB available, resuming {} job {}'.format(available / 1024, kind, pid)
+
+    def run(self):
+        while not self.finished.wait(self.interval):
+            try:
+                self.sample()
+            except (IOError, OSError, IndexError, ValueError):
+                # processes come and go while /proc is read
+                pass
+
+    def stop(self):
+        self.finished.set()
+        self.join()
+        for pid in self.stopped:
+            self._signal(pid, signal.SIGCONT)
+        self.stopped={}
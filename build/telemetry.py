@@ -0,0 +1,190 @@
+#
+#  The MIT License (MIT)
+#
+#  Copyright (c) 2016-2017 Albert Casals - skarbat@gmail.com
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#  THE SOFTWARE.
+#
+#  telemetry.py
+#
+#  Time, CPU, memory and disk usage of the build stages, kept as a run history
+#
+#  See the README file for details.
+#
+
+import os
+import json
+import time
+import resource
+import threading
+import collections
+
+import scheduler
+
+# all the stages of one qt5-build invocation, or of one buildall.sh run which sets QT5_BUILD_RUN
+run_id=os.environ.get('QT5_BUILD_RUN') or time.strftime('%Y%m%d-%H%M%S')
+
+# stages measured right now, those running along each other share the process counters
+_meters_lock=threading.Lock()
+_meters=set()
+
+class StageMeter(threading.Thread):
+    '''
+    Measures a build stage: wall time, CPU time and disk blocks read and written by the processes
+    it waited for, and the peak resident memory of the process tree below this one, sampled.
+    '''
+    def __init__(self, interval=1.0):
+        threading.Thread.__init__(self)
+        self.daemon=True
+        self.interval=interval
+        self.peak_rss=0
+        self.concurrent=0
+        self.finished=threading.Event()
+
+    def _sample(self):
+        memory=sum(scheduler.resident_memory(pid) for pid in scheduler.descendants(os.getpid()))
+        self.peak_rss=max(self.peak_rss, memory)
+
+    def run(self):
+        while not self.finished.wait(self.interval):
+            try:
+                self._sample()
+            except (IOError, OSError, IndexError, ValueError):
+                pass
+
+    def start(self):
+        with _meters_lock:
+            for meter in _meters:
+                meter.concurrent += 1
+                self.concurrent += 1
+            _meters.add(self)
+
+        self.started=time.time()
+        self.usage=resource.getrusage(resource.RUSAGE_CHILDREN)
+        threading.Thread.start(self)
+
+    def stop(self):
+        '''
+        Returns the measures, the counters of stages running at the same time are shared
+        '''
+        self.finished.set()
+        self.join()
+        with _meters_lock:
+            _meters.discard(self)
+
+        usage=resource.getrusage(resource.RUSAGE_CHILDREN)
+        return { 'wall': round(time.time() - self.started, 1),
+                 'user': round(usage.ru_utime - self.usage.ru_utime, 1),
+                 'system': round(usage.ru_stime - self.usage.ru_stime, 1),
+                 'peak_rss': self.peak_rss * 1024,
+                 'read_bytes': (usage.ru_inblock - self.usage.ru_inblock) * 512,
+                 'written_bytes': (usage.ru_oublock - self.usage.ru_oublock) * 512,
+                 'concurrent': self.concurrent }
+
+def append_history(filename, record):
+    '''
+    Appends a stage record to the run history, one json record per line
+    '''
+    directory=os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    line=json.dumps(record, sort_keys=True) + '\n'
+    with _meters_lock:
+        with open(filename, 'a') as f:
+            f.write(line)
+
+def read_history(filename):
+    '''
+    Returns the stage records of each run, keyed by run id in the order they ran,
+    the last record of a stage in a run wins
+    '''
+    runs=collections.OrderedDict()
+    try:
+        with open(filename, 'r') as f:
+            for line in f:
+                try:
+                    record=json.loads(line)
+                except ValueError:
+                    continue
+                runs.setdefault(record['run'], collections.OrderedDict())[record['stage']]=record
+    except IOError:
+        pass
+    return runs
+
+def _size(value):
+    return '{:.1f}G'.format(value / 1024.0**3) if value >= 1024**3 else '{:.0f}M'.format(value / 1024.0**2)
+
+def _change(now, before):
+    if not before:
+        return ''
+    return '{:+.0f}%'.format(100.0 * (now - before) / before)
+
+def report(runs, run=None, compare=None):
+    '''
+    Prints the stages of a run, the last one by default, next to the same stages
+    of a previous run: the one given, or the last earlier one that ran any of them
+    '''
+    if not runs:
+        print 'no build runs recorded'
+        return
+
+    ids=list(runs)
+    run=run if run in runs else ids[-1]
+    stages=runs[run]
+    if compare not in runs:
+        compare=None
+        for earlier in reversed(ids[:ids.index(run)]):
+            if any(name in runs[earlier] and not runs[earlier][name].get('skipped') for name in stages):
+                compare=earlier
+                break
+    previous=runs.get(compare, {})
+
+    print 'build run {}{}'.format(run, ', compared to run {}'.format(compare) if compare else '')
+    print '  {:28} {:>8} {:>8} {:>7} {:>7} {:>7}  {}'.format('stage', 'wall', 'cpu', 'rss', 'read', 'written', 'change')
+    totals=[ 0, 0, 0, 0 ]
+    for name, record in stages.items():
+        if record.get('skipped'):
+            print '  {:28} {:>8}'.format(name, 'up to date')
+            continue
+
+        cpu=record['user'] + record['system']
+        change=[]
+        before=previous.get(name)
+        if before and not before.get('skipped'):
+            change.append('wall {} cpu {}'.format(_change(record['wall'], before['wall']),
+                                                  _change(cpu, before['user'] + before['system'])))
+            if before.get('fingerprint') != record.get('fingerprint'):
+                change.append('inputs changed')
+        if not record['ok']:
+            change.append('FAILED')
+        if record.get('concurrent'):
+            change.append('shared with {} stages'.format(record['concurrent']))
+
+        print '  {:28} {:>7.0f}s {:>7.0f}s {:>7} {:>7} {:>7}  {}'.format(
+            name, record['wall'], cpu, _size(record['peak_rss']), _size(record['read_bytes']),
+            _size(record['written_bytes']), ', '.join(change))
+
+        totals[0] += record['wall']
+        totals[1] += cpu
+        totals[2] += record['read_bytes']
+        totals[3] += record['written_bytes']
+
+    print '  {:28} {:>7.0f}s {:>7.0f}s {:>7} {:>7} {:>7}'.format('total', totals[0], totals[1], '',
+                                                                _size(totals[2]), _size(totals[3]))
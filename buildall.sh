@@ -2,15 +2,22 @@
 #
 #  Build and package everything in 2 separate steps: native and cross
 #
-#  buildall < cross | native>
+#  buildall < cross | native | all >
 #
 # TODO: We might want to build the debug version of QT5 to diagnose problems
 #
 # ./qt5-build purge --yes > $logfile 2>&1
 # ./qt5-build compile qt5 cross debug --baptize --yes >> $logfile 2>&1
 #
+# Stages already completed with the same inputs are skipped, so after a failure
+# running it again resumes where it stopped, see "--force-stage" in qt5-build.
 #
 
+set -e
+
+# the stages of all the qt5-build calls below make a single run in the history, see "qt5-build status"
+export QT5_BUILD_RUN=${QT5_BUILD_RUN:-$(date +%Y%m%d-%H%M%S)}
+
 if [ "$1" == "cross" ]; then
     # takes about 1 hour on a 8 CPU 2GHz host
     echo  "Cross compilation of QT5 and Webengine"
@@ -30,14 +37,20 @@ if [ "$1" == "cross" ]; then
 
     exit 0
 
-else if [ "$1" == "native" ]; then
+elif [ "$1" == "native" ]; then
 	 # takes about 1.5 hours on a 8 CPU 2GHz host
 	 echo "Native compilation of QT5 core tools"
 	 ./qt5-build compile qt5 native release --core-tools --yes
 	 ./qt5-build package native-tools
 	 exit 0
 
-else if [ "$1" == "purge" ]; then
+elif [ "$1" == "all" ]; then
+	 # cross and native stages as one dependency graph, running side by side
+	 echo "Cross compilation of QT5 and Webengine and native compilation of the core tools"
+	 ./qt5-build all release --baptize --yes
+	 exit 0
+
+elif [ "$1" == "purge" ]; then
 
     echo "are you sure to purge all the contents???"
     echo "ctrl+c to change your idea."
@@ -45,6 +58,6 @@ else if [ "$1" == "purge" ]; then
     ./qt5-build purge --yes
     exit 0
 else
-	 echo "unrecognized build mode - please use native or cross"
+	 echo "unrecognized build mode - please use native, cross or all"
 	 exit 1
 fi
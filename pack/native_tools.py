@@ -87,6 +87,7 @@ def pack_tools(root_directory, source_directory, qt5_version, tools_directory, d
         print 'error: path not found', complete_source
         sys.exit(1)
 
+    failed=[]
     for pkg in packages:
 
         pkg['pkg_version'] = qt5_version
@@ -142,3 +143,6 @@ def pack_tools(root_directory, source_directory, qt5_version, tools_directory, d
             print 'Package {} created correctly'.format(versioned_pkg_name)
         else:
             print 'WARNING: Error creating package {}'.format(versioned_pkg_name)
+            failed.append(versioned_pkg_name)
+
+    return not failed
@@ -79,6 +79,7 @@ def pack_webengine(root_directory, source_directory, qt5_version, dry_run=False)
         print 'error: path not found', complete_source
         sys.exit(1)
 
+    failed=[]
     for pkg in packages:
 
         pkg['pkg_version'] = qt5_version
@@ -119,3 +120,6 @@ def pack_webengine(root_directory, source_directory, qt5_version, dry_run=False)
             print 'Package {} created correctly'.format(versioned_pkg_name)
         else:
             print 'WARNING: Error creating package {}'.format(versioned_pkg_name)
+            failed.append(versioned_pkg_name)
+
+    return not failed
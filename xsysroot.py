@@ -30,10 +30,25 @@ __version__ = 1.914
 
 import os
 import sys
+import errno
+import fcntl
 import socket
 import subprocess
 import json
 import re
+import time
+import binascii
+import hashlib
+import zipfile
+import threading
+import shutil
+import struct
+import zlib
+import uuid
+import urllib
+import multiprocessing
+import multiprocessing.pool
+import Queue
 
 from optparse import OptionParser
 
@@ -54,6 +69,1219 @@ default_settings='''
 }
 '''
 
+# Privileged helper run once per mount/umount transaction, or batch of file operations
+# on the sysroot, through a single sudo.
+# It reads a JSON plan from stdin, runs each step, and on failure of a mandatory
+# step undoes the steps already done in reverse order. A JSON report with the
+# return code and elapsed time of each step is written to stdout.
+transaction_helper='''
+import os, sys, json, time, subprocess, shutil, re
+
+def makedirs(path):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+def unlink(path):
+    if os.path.islink(path) or os.path.isfile(path):
+        os.unlink(path)
+
+def relink(root, directories):
+    count=0
+    for directory in directories:
+        for path, dirs, files in os.walk(directory):
+            for name in dirs + files:
+                link=os.path.join(path, name)
+                if not re.search("\\.so(\\.|$)", name) or not os.path.islink(link):
+                    continue
+                target=os.readlink(link)
+                if target.startswith("/"):
+                    os.unlink(link)
+                    os.symlink(os.path.relpath(root + target, path), link)
+                    count += 1
+    sys.stderr.write("relinked {} absolute library symlinks\\n".format(count))
+
+def run(action):
+    kind=action[0]
+    try:
+        if kind == "argv":
+            return subprocess.call(action[1], stdout=sys.stderr)
+        elif kind == "write":
+            makedirs(os.path.dirname(action[1]))
+            with open(action[1], "a" if action[3] else "w") as f:
+                f.write(action[2])
+            return 0
+        elif kind == "symlink":
+            makedirs(os.path.dirname(action[2]))
+            unlink(action[2])
+            os.symlink(action[1], action[2])
+            return 0
+        elif kind == "copy":
+            makedirs(os.path.dirname(action[2]))
+            unlink(action[2])
+            shutil.copy2(action[1], action[2])
+            return 0
+        elif kind == "relink":
+            relink(action[1], action[2])
+            return 0
+        elif kind == "rename":
+            if os.path.exists(action[1]):
+                os.rename(action[1], action[2])
+            return 0
+        elif kind == "rmdir":
+            if os.path.isdir(action[1]):
+                os.rmdir(action[1])
+            return 0
+        elif kind == "wait":
+            deadline=time.time() + action[2]
+            while not os.path.exists(action[1]):
+                if time.time() > deadline:
+                    return 1
+                time.sleep(0.01)
+            return 0
+    except (OSError, IOError) as e:
+        sys.stderr.write("{}\\n".format(e))
+    return 1
+
+plan=json.loads(sys.stdin.read())
+done=[]
+report=[]
+failed=False
+for step in plan["steps"]:
+    requires=step["requires"]
+    if requires is not None and any(name not in done for name in (requires if isinstance(requires, list) else [ requires ])):
+        report.append({"name": step["name"], "rc": None, "elapsed": 0.0})
+        continue
+    start=time.time()
+    rc=run(step["do"])
+    report.append({"name": step["name"], "rc": rc, "elapsed": time.time() - start})
+    if rc == 0:
+        done.append(step["name"])
+    elif not step["optional"]:
+        failed=True
+        break
+
+if failed and plan["rollback"]:
+    for step in reversed(plan["steps"]):
+        if step["name"] in done and step["undo"]:
+            start=time.time()
+            rc=run(step["undo"])
+            report.append({"name": "undo " + step["name"], "rc": rc, "elapsed": time.time() - start})
+
+sys.stdout.write(json.dumps({"failed": failed, "steps": report}))
+'''
+
+# Privileged helper which finds processes pinned inside a directory tree, reading only
+# the /proc root, cwd and exe links, then the open files and the memory maps when those do not match.
+# Reads { "paths": [...], "timeout": seconds } on stdin, waits up to timeout for the
+# processes to go away, and writes the ones still found as JSON on stdout.
+busy_helper='''
+import os, sys, json, time
+
+def inside(path, paths):
+    return any(path == p or path.startswith(p.rstrip("/") + "/") for p in paths)
+
+def pinned(pid, paths):
+    for link in ("root", "cwd", "exe"):
+        try:
+            if inside(os.readlink("/proc/{}/{}".format(pid, link)), paths):
+                return link
+        except OSError:
+            pass
+    try:
+        for fd in os.listdir("/proc/{}/fd".format(pid)):
+            try:
+                if inside(os.readlink("/proc/{}/fd/{}".format(pid, fd)), paths):
+                    return "fd"
+            except OSError:
+                pass
+    except OSError:
+        pass
+    try:
+        with open("/proc/{}/maps".format(pid)) as maps:
+            for line in maps:
+                fields=line.split(None, 5)
+                if len(fields) == 6 and inside(fields[5].rstrip("\\n"), paths):
+                    return "mem"
+    except IOError:
+        pass
+    return None
+
+def scan(paths):
+    found=[]
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        reason=pinned(pid, paths)
+        if reason:
+            try:
+                with open("/proc/{}/cmdline".format(pid)) as f:
+                    cmdline=f.read().replace("\\0", " ").strip()
+            except IOError:
+                continue
+            found.append({"pid": int(pid), "reason": reason, "cmdline": cmdline})
+    return found
+
+request=json.loads(sys.stdin.read())
+paths=[ os.path.realpath(p) for p in request["paths"] ]
+deadline=time.time() + request["timeout"]
+found=scan(paths)
+while found and time.time() < deadline:
+    time.sleep(0.1)
+    found=scan(paths)
+
+sys.stdout.write(json.dumps(found))
+'''
+
+def resolve_in_root(root, path, follow=True):
+    '''
+    Returns the host pathname of a path inside a root directory, resolving symlinks as
+    a chroot would see them: absolute link targets and ".." never leave the root.
+    With follow False the last component is not resolved, to replace a symlink itself.
+    '''
+    root=os.path.realpath(root)
+    pending=[ p for p in reversed(path.split('/')) if p ]
+    resolved=[]
+    links=0
+
+    while pending:
+        part=pending.pop()
+        if part == '.':
+            continue
+        elif part == '..':
+            if resolved:
+                resolved.pop()
+            continue
+
+        candidate=os.path.join(root, *(resolved + [ part ]))
+        if os.path.islink(candidate) and (follow or pending):
+            links += 1
+            if links > 40:
+                raise OSError(errno.ELOOP, 'Too many levels of symbolic links', path)
+
+            target=os.readlink(candidate)
+            if target.startswith('/'):
+                resolved=[]
+            pending.extend(p for p in reversed(target.split('/')) if p)
+        else:
+            resolved.append(part)
+
+    return os.path.join(root, *resolved)
+
+# Profile settings holding pathnames, expanded when a profile is loaded
+expanded_settings=('sysroot', 'tmp', 'backing_image', 'qcow_image', 'apt_cache')
+
+# Parsed configuration files, in the form { filename: (mtime, profiles) }
+settings_cache={}
+
+def find_settings_filename(settings_filename='xsysroot.conf'):
+    '''
+    Finds the system-wide or private user configuration file
+    '''
+    settings_system=os.path.join('/etc', settings_filename)
+    settings_user=os.path.join(os.path.expanduser('~'), settings_filename)
+    if os.path.isfile(settings_system):
+        return settings_system
+    if os.path.isfile(settings_user):
+        return settings_user
+
+    return None
+
+def read_profiles(filename):
+    '''
+    Returns all profiles defined in a configuration file.
+    The parsed file is cached and only read again when its modification time changes.
+    '''
+    mtime=os.path.getmtime(filename)
+    cached=settings_cache.get(filename)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    with open(filename, 'r') as f:
+        profiles=json.load(f)
+
+    settings_cache[filename]=(mtime, profiles)
+    return profiles
+
+def expand_setting(value, commands=False):
+    '''
+    Expands ~ and $VARIABLES in a setting value without spawning a shell.
+    Command substitution such as $(date +%d) is only honoured when commands is True,
+    set "shell_expand": true in the profile to enable it.
+    '''
+    if commands and ('$(' in value or '`' in value):
+        return os.popen('echo {}'.format(value)).read().strip('\n')
+
+    return os.path.expanduser(os.path.expandvars(value))
+
+def load_profile(profile, settings_filename='xsysroot.conf'):
+    '''
+    Returns the profile name and its expanded settings from the configuration file at /etc,
+    your home directory, or embedded in the xsysroot module if there is no configuration file.
+    '''
+    filename=find_settings_filename(settings_filename)
+    try:
+        if filename:
+            settings=read_profiles(filename)[profile]
+        else:
+            filename=__file__
+            profile='default'
+            settings=json.loads(default_settings)[profile]
+    except KeyError:
+        print 'could not find profile "{}" in settings ({})'.format(profile, filename)
+        raise
+    except:
+        print 'could not load settings - please check Json syntax ({})'.format(filename)
+        raise
+
+    return profile, expand_profile(settings)
+
+def expand_profile(settings):
+    '''
+    Returns a copy of a profile settings with all pathnames expanded
+    '''
+    settings=dict(settings)
+    for key in expanded_settings:
+        if settings.has_key(key):
+            settings[key]=expand_setting(settings[key], commands=settings.get('shell_expand', False))
+
+    return settings
+
+class MountIndex():
+    '''
+    A snapshot of the host mount state, built from a single read of /proc/self/mountinfo
+    and the /sys/block/nbd*/pid files. Answers mount questions for any number of profiles
+    without spawning processes.
+    '''
+    def __init__(self, mountinfo='/proc/self/mountinfo', sysblock='/sys/block'):
+        self.mounts={}
+        self.nbd_devices={}
+
+        try:
+            with open(mountinfo, 'r') as f:
+                for line in f:
+                    # id parent major:minor root mountpoint options [optional...] - fstype source superoptions
+                    fields, _, tail=line.strip().partition(' - ')
+                    fields=fields.split(' ')
+                    tail=tail.split(' ')
+                    if len(fields) < 5 or len(tail) < 2:
+                        continue
+
+                    mountpoint=self._unescape(fields[4])
+                    self.mounts[mountpoint]={ 'root': self._unescape(fields[3]),
+                                              'fstype': tail[0],
+                                              'source': self._unescape(tail[1]) }
+        except IOError:
+            pass
+
+        # A connected nbd device exposes the pid of its qemu-nbd server
+        try:
+            for device in os.listdir(sysblock):
+                if device.startswith('nbd'):
+                    try:
+                        with open(os.path.join(sysblock, device, 'pid'), 'r') as f:
+                            self.nbd_devices['/dev/{}'.format(device)]=int(f.read().strip())
+                    except (IOError, ValueError):
+                        pass
+        except OSError:
+            pass
+
+    def _unescape(self, field):
+        '''
+        Decodes the octal escapes used by mountinfo for spaces, tabs and backslashes
+        '''
+        return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), field)
+
+    def is_mounted(self, path):
+        '''
+        Returns True if path is a mount point, same as the "mountpoint" tool
+        '''
+        return os.path.realpath(path) in self.mounts
+
+    def is_connected(self, nbdev):
+        '''
+        Returns True if the nbd device is attached to a qemu-nbd server
+        '''
+        return nbdev in self.nbd_devices
+
+    def state(self, settings):
+        '''
+        Returns the mount state of a profile in the form
+        { 'mounted': bool, 'device': '/dev/nbdXpY', 'connected': bool, 'binds': [ mountpoints ] }
+        '''
+        sysroot=os.path.realpath(settings['sysroot'])
+        root=self.mounts.get(sysroot)
+        binds=sorted(m for m in self.mounts if m.startswith(sysroot + '/'))
+
+        return { 'mounted': root is not None,
+                 'device': root['source'] if root else None,
+                 'connected': self.is_connected(settings.get('nbdev')),
+                 'binds': binds }
+
+# Where nbd device lock files are kept, shared by all users of the host
+nbd_lock_dir='/tmp/xsysroot-locks'
+
+class NbdPool():
+    '''
+    Allocates /dev/nbdN devices to profiles which set "nbdev" to "auto" or leave it out,
+    and guards profiles with a fixed "nbdev" against another profile using the same device.
+
+    Each device in use has a lock file recording the profile, qcow image and pid
+    of the process which took it. The lock outlives that process while the device is connected,
+    a lock whose device is disconnected and whose process is gone is stale and is recovered.
+    '''
+    def __init__(self, lock_dir=nbd_lock_dir, sysblock='/sys/block'):
+        self.lock_dir=lock_dir
+        self.sysblock=sysblock
+
+    def devices(self):
+        '''
+        Returns all nbd devices on the host, in numerical order
+        '''
+        try:
+            numbers=[ int(d[3:]) for d in os.listdir(self.sysblock) if re.match('nbd\d+$', d) ]
+        except OSError:
+            numbers=[]
+
+        return [ '/dev/nbd{}'.format(n) for n in sorted(numbers) ]
+
+    def _lock_file(self, nbdev):
+        return os.path.join(self.lock_dir, '{}.lock'.format(os.path.basename(nbdev)))
+
+    def owner(self, nbdev):
+        '''
+        Returns the lock details of a device in the form
+        { 'nbdev': ..., 'profile': ..., 'qcow_image': ..., 'pid': ... }, or None if it is not locked
+        '''
+        try:
+            with open(self._lock_file(nbdev), 'r') as f:
+                return json.loads(f.read())
+        except (IOError, ValueError):
+            return None
+
+    def is_stale(self, owner, index=None):
+        '''
+        Returns True if the device of a lock is not connected and the process which took it is gone
+        '''
+        if (index or MountIndex()).is_connected(owner.get('nbdev')):
+            return False
+
+        try:
+            os.kill(owner.get('pid', 0), 0)
+        except OSError as e:
+            return e.errno != errno.EPERM
+
+        return False
+
+    def find(self, profile, qcow_image):
+        '''
+        Returns the device locked for a profile and qcow image, or None
+        '''
+        for nbdev in self.devices():
+            owner=self.owner(nbdev)
+            if owner and owner['profile'] == profile and owner['qcow_image'] == qcow_image:
+                return nbdev
+
+        return None
+
+    def acquire(self, nbdev, profile, qcow_image, index=None):
+        '''
+        Locks a device for a profile. Returns True if the profile already held it,
+        or it was free or stale, False if it is in use by another profile.
+        '''
+        self._make_lock_dir()
+        lock={ 'nbdev': nbdev, 'profile': profile, 'qcow_image': qcow_image, 'pid': os.getpid() }
+        lock_file=self._lock_file(nbdev)
+        for attempt in range(3):
+            # the lock appears complete or not at all, an empty lock is never mistaken for a stale one
+            try:
+                temp=self._write_temp(lock_file, lock)
+                try:
+                    os.link(temp, lock_file)
+                    return True
+                finally:
+                    os.unlink(temp)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    print 'could not lock {}: {}'.format(nbdev, e)
+                    return False
+
+            owner=self.owner(nbdev)
+            if owner and owner['profile'] == profile and owner['qcow_image'] == qcow_image:
+                return True
+            elif owner is not None and not self.is_stale(owner, index):
+                return False
+
+            # take over the stale lock, only if nobody else did since it was read
+            try:
+                with self._guard(nbdev):
+                    if not os.path.exists(lock_file):
+                        continue
+                    if self.owner(nbdev) != owner:
+                        continue
+                    os.rename(self._write_temp(lock_file, lock), lock_file)
+                    return True
+            except (IOError, OSError) as e:
+                print 'could not take over the stale lock of {}: {}'.format(nbdev, e)
+                if e.errno == errno.EPERM:
+                    print 'the lock belongs to another user in a sticky directory, remove {} to recover it'.format(lock_file)
+                return False
+
+        return False
+
+    def _make_lock_dir(self):
+        '''
+        Creates the lock directory writable by all users. It is not sticky: root through sudo and normal
+        users share the devices, and must be able to replace and remove each other's stale locks.
+        '''
+        try:
+            if not os.path.isdir(self.lock_dir):
+                os.makedirs(self.lock_dir)
+                os.chmod(self.lock_dir, 0777)
+            elif os.stat(self.lock_dir).st_uid == os.getuid() and os.stat(self.lock_dir).st_mode & 01000:
+                # made sticky by earlier versions
+                os.chmod(self.lock_dir, 0777)
+        except OSError:
+            pass
+
+    def _write_temp(self, lock_file, lock):
+        temp='{}.{}'.format(lock_file, os.getpid())
+        fd=os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+        try:
+            os.write(fd, json.dumps(lock))
+        finally:
+            os.close(fd)
+        return temp
+
+    def _guard(self, nbdev):
+        '''
+        Returns a file holding an exclusive flock to change the lock of a device, closing it releases the flock
+        '''
+        filename='{}.guard'.format(self._lock_file(nbdev))
+        try:
+            fd=os.open(filename, os.O_RDONLY | os.O_CREAT, 0666)
+            try:
+                os.chmod(filename, 0666)
+            except OSError:
+                pass
+        except OSError as e:
+            if e.errno != errno.EACCES:
+                raise
+            # a guard created by another user, fs.protected_regular refuses O_CREAT on it in a sticky directory
+            fd=os.open(filename, os.O_RDONLY)
+
+        guard=os.fdopen(fd, 'r')
+        fcntl.flock(guard, fcntl.LOCK_EX)
+        return guard
+
+    def allocate(self, profile, qcow_image):
+        '''
+        Returns the device locked for the profile, or locks and returns the first free one.
+        Returns None if all devices are in use.
+        '''
+        nbdev=self.find(profile, qcow_image)
+        if nbdev:
+            return nbdev
+
+        index=MountIndex()
+        for nbdev in self.devices():
+            if not index.is_connected(nbdev) and self.acquire(nbdev, profile, qcow_image, index):
+                return nbdev
+
+        return None
+
+    def release(self, nbdev, profile):
+        '''
+        Removes the lock of a device if it belongs to the profile
+        '''
+        if not os.path.isfile(self._lock_file(nbdev)):
+            return
+
+        try:
+            with self._guard(nbdev):
+                owner=self.owner(nbdev)
+                if owner and owner['profile'] == profile:
+                    os.unlink(self._lock_file(nbdev))
+        except (IOError, OSError) as e:
+            print 'could not release the lock of {}: {}'.format(nbdev, e)
+
+    def resolve(self, profile, settings):
+        '''
+        Returns the nbd device a profile uses: the one set in its settings, the one allocated to it,
+        or "auto" if it is not using any at the moment.
+        '''
+        nbdev=settings.get('nbdev', 'auto')
+        if nbdev == 'auto':
+            nbdev=self.find(profile, settings['qcow_image']) or 'auto'
+
+        return nbdev
+
+# Where uncompressed backing images are kept, unless the profile sets "image_cache"
+default_image_cache='~/.xsysroot-cache'
+
+# Command line decompressors for backing images, the first one found on the PATH is used
+decompressors={
+    '.gz': [ [ 'pigz', '-dc' ], [ 'gzip', '-dc' ] ],
+    '.xz': [ [ 'xz', '-T0', '-dc' ] ]
+}
+
+# Multi-threaded compressors to export images, chosen by the exported filename extension
+compressors={
+    '.gz': [ [ 'pigz', '-c' ], [ 'gzip', '-c' ] ],
+    '.xz': [ [ 'xz', '-T0', '-c' ] ],
+    '.zst': [ [ 'zstd', '-T0', '-q', '-c' ] ]
+}
+
+def find_program(name):
+    '''
+    Returns the full pathname of a program found on the PATH, or None
+    '''
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        pathname=os.path.join(directory, name)
+        if os.path.isfile(pathname) and os.access(pathname, os.X_OK):
+            return pathname
+
+    return None
+
+def write_sparse(output, data, block_size=65536):
+    '''
+    Writes data to a file object, seeking over blocks of zeroes instead of writing them
+    '''
+    zeroes='\0' * block_size
+    for offset in xrange(0, len(data), block_size):
+        block=data[offset:offset + block_size]
+        if block == zeroes[:len(block)]:
+            output.seek(len(block), os.SEEK_CUR)
+        else:
+            output.write(block)
+
+def decompress_image(source, target, verbose=True, chunk_size=1024*1024):
+    '''
+    Decompresses a .gz, .xz or .zip disk image into a sparse target file, reporting progress.
+    Gzip and xz images are piped through a multi-threaded decompressor when available (pigz, xz -T0),
+    zip images are decompressed in-process. Returns True on success.
+    '''
+    extension=os.path.splitext(source)[1]
+    partial='{}.part'.format(target)
+    consumed=[0]
+    process=None
+
+    try:
+        if extension == '.zip':
+            archive=zipfile.ZipFile(source)
+            member=archive.infolist()[0]
+            total=member.file_size
+            stream=archive.open(member)
+        elif decompressors.has_key(extension):
+            command=next((c for c in decompressors[extension] if find_program(c[0])), None)
+            if not command:
+                print 'no decompressor found for {} images'.format(extension)
+                return False
+
+            total=os.path.getsize(source)
+            process=subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            stream=process.stdout
+
+            def feed():
+                try:
+                    with open(source, 'rb') as f:
+                        for chunk in iter(lambda: f.read(chunk_size), ''):
+                            process.stdin.write(chunk)
+                            consumed[0] += len(chunk)
+                except IOError:
+                    pass
+                finally:
+                    process.stdin.close()
+
+            feeder=threading.Thread(target=feed)
+            feeder.daemon=True
+            feeder.start()
+        else:
+            print 'unsupported image format: {}'.format(source)
+            return False
+
+        start=last_report=time.time()
+        with open(partial, 'wb') as output:
+            for chunk in iter(lambda: stream.read(chunk_size), ''):
+                write_sparse(output, chunk)
+                if not process:
+                    consumed[0] += len(chunk)
+
+                if verbose and time.time() - last_report > 1:
+                    last_report=time.time()
+                    sys.stdout.write('\r uncompressing {:>3}% {:.1f} MiB/s'.format(
+                            consumed[0] * 100 / max(total, 1),
+                            output.tell() / (1024.0 * 1024) / (last_report - start)))
+                    sys.stdout.flush()
+
+            # make sure trailing zeroes skipped by write_sparse are part of the file size
+            output.truncate(output.tell())
+
+        if process and process.wait():
+            print '\nerror uncompressing {} rc={}'.format(source, process.returncode)
+            os.remove(partial)
+            return False
+
+        os.rename(partial, target)
+        if verbose:
+            print '\r uncompressed {} in {:.1f} seconds'.format(source, time.time() - start)
+        return True
+
+    except (IOError, OSError, zipfile.BadZipfile) as e:
+        print '\nerror uncompressing {}: {}'.format(source, e)
+        if os.path.isfile(partial):
+            os.remove(partial)
+        return False
+
+def export_image(source, target, verbose=True, chunk_size=4*1024*1024):
+    '''
+    Streams the guest contents of a raw or qcow2 image, including its backing chain, into target.
+    The target is compressed on the fly if its extension is found in compressors,
+    or written as a sparse raw image otherwise. Returns True on success.
+    '''
+    extension=os.path.splitext(target)[1]
+    partial='{}.part'.format(target)
+    process=None
+    command=None
+
+    # pick the compressor before anything is written, so no partial file is left behind without one
+    if compressors.has_key(extension):
+        command=next((c for c in compressors[extension] if find_program(c[0])), None)
+        if not command:
+            print 'no compressor found for {} images'.format(extension)
+            return False
+
+    try:
+        image=DiskImage(source)
+        with open(partial, 'wb') as output:
+            if command:
+                process=subprocess.Popen(command, stdin=subprocess.PIPE, stdout=output)
+
+            start=last_report=time.time()
+            for offset in xrange(0, image.virtual_size, chunk_size):
+                chunk=image.read(offset, min(chunk_size, image.virtual_size - offset))
+                if process:
+                    process.stdin.write(chunk)
+                else:
+                    write_sparse(output, chunk)
+
+                if verbose and time.time() - last_report > 1:
+                    last_report=time.time()
+                    sys.stdout.write('\r exporting {:>3}% {:.1f} MiB/s'.format(
+                            offset * 100 / image.virtual_size,
+                            offset / (1024.0 * 1024) / (last_report - start)))
+                    sys.stdout.flush()
+
+            if process:
+                process.stdin.close()
+                if process.wait():
+                    print '\nerror compressing {} rc={}'.format(target, process.returncode)
+                    os.remove(partial)
+                    return False
+            else:
+                output.truncate(image.virtual_size)
+
+        image.close()
+        os.rename(partial, target)
+        if verbose:
+            print '\r exported {} bytes into {} in {:.1f} seconds'.format(
+                image.virtual_size, target, time.time() - start)
+        return True
+
+    except (IOError, OSError, ValueError, struct.error) as e:
+        print '\nerror exporting {}: {}'.format(source, e)
+        if os.path.isfile(partial):
+            os.remove(partial)
+        return False
+
+class ImageCache():
+    '''
+    A content-addressed store of uncompressed backing images.
+    Images are named after the SHA1 of the compressed file. The hash of each compressed
+    file is remembered along with its size and mtime, so it is only computed again when the file changes.
+    '''
+    def __init__(self, directory=default_image_cache):
+        self.directory=expand_setting(directory)
+        self.index_file=os.path.join(self.directory, 'index.json')
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def _read_index(self):
+        try:
+            with open(self.index_file, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _write_index(self, index):
+        with open('{}.tmp'.format(self.index_file), 'w') as f:
+            json.dump(index, f, indent=2)
+        os.rename('{}.tmp'.format(self.index_file), self.index_file)
+
+    def digest(self, filename):
+        '''
+        Returns the SHA1 hex digest of a file, computed only if the file changed since last time
+        '''
+        filename=os.path.realpath(filename)
+        info=os.stat(filename)
+        index=self._read_index()
+        entry=index.get(filename)
+        if entry and entry['size'] == info.st_size and entry['mtime'] == info.st_mtime:
+            return entry['digest']
+
+        sha1=hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024*1024), ''):
+                sha1.update(chunk)
+
+        index[filename]={ 'size': info.st_size, 'mtime': info.st_mtime, 'digest': sha1.hexdigest() }
+        self._write_index(index)
+        return sha1.hexdigest()
+
+    def path(self, key, extension='.img'):
+        '''
+        Returns the pathname of a cached entry
+        '''
+        return os.path.join(self.directory, '{}{}'.format(key, extension))
+
+    def uncompressed(self, source, verbose=True):
+        '''
+        Returns the pathname of the uncompressed version of the source image,
+        decompressing it only if it is not cached yet. Returns None on errors.
+        '''
+        cached=self.path(self.digest(source))
+        if os.path.isfile(cached):
+            print 'Using cached uncompressed image {}'.format(cached)
+            return cached
+
+        print 'Uncompressing image {} into {}'.format(source, cached)
+        if not decompress_image(source, cached, verbose=verbose):
+            return None
+
+        return cached
+
+# MBR partition ids of extended partitions, which hold the logical partitions
+mbr_extended_types=(0x05, 0x0f, 0x85)
+
+def parse_size(size):
+    '''
+    Converts a qemu-img style size such as "4G", "3.5G" or "512M" into bytes
+    '''
+    units={ 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4 }
+    size=str(size).strip().upper()
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+
+    return int(size)
+
+class DiskImage():
+    '''
+    In-process reader for raw and qcow2 disk images, no nbd device, sudo or parted needed.
+    Gives the qcow2 header details (virtual size, cluster size, backing chain),
+    reads guest data through the qcow2 cluster tables and the backing chain,
+    and lists MBR or GPT partitions along with the file system found in each of them.
+    '''
+    qcow2_magic='QFI\xfb'
+
+    def __init__(self, filename):
+        self.filename=filename
+        self.f=open(filename, 'rb')
+        self.backing=None
+        self.backing_file=None
+        self.backing_format=None
+
+        header=self.f.read(72)
+        if header[:4] != self.qcow2_magic:
+            self.format='raw'
+            self.version=None
+            self.cluster_size=None
+            self.virtual_size=os.fstat(self.f.fileno()).st_size
+            return
+
+        self.format='qcow2'
+        (_, self.version, backing_offset, backing_size, self.cluster_bits, self.virtual_size,
+         self.crypt_method, self.l1_size, self.l1_offset)=struct.unpack('>4sIQIIQIIQ', header[:48])
+        self.cluster_size=1 << self.cluster_bits
+        self.l2_bits=self.cluster_bits - 3
+        self.l2_cache={}
+
+        if self.crypt_method:
+            raise ValueError('encrypted qcow2 images are not supported: {}'.format(filename))
+
+        self.f.seek(self.l1_offset)
+        self.l1_table=struct.unpack('>{}Q'.format(self.l1_size), self.f.read(self.l1_size * 8))
+
+        if backing_offset:
+            self.f.seek(backing_offset)
+            self.backing_file=self.f.read(backing_size)
+            self.backing_format=self._backing_format_extension()
+
+            # relative backing filenames are relative to the image directory
+            backing_path=os.path.join(os.path.dirname(os.path.abspath(filename)), self.backing_file)
+            if os.path.isfile(backing_path):
+                self.backing=DiskImage(backing_path)
+
+    def _backing_format_extension(self):
+        '''
+        Returns the backing file format from the header extensions, or None
+        '''
+        header_length=72 if self.version < 3 else struct.unpack('>I', self._pread(100, 4))[0]
+        offset=header_length
+        while True:
+            kind, length=struct.unpack('>II', self._pread(offset, 8))
+            if kind == 0:
+                return None
+            if kind == 0xe2792aca:
+                return self._pread(offset + 8, length)
+            offset += 8 + ((length + 7) & ~7)
+
+    def _pread(self, offset, length):
+        self.f.seek(offset)
+        return self.f.read(length)
+
+    def backing_chain(self):
+        '''
+        Returns the list of image filenames from this one down to the base image.
+        A backing file which cannot be found is listed anyway, as the last element.
+        '''
+        chain=[ self.filename ]
+        if self.backing:
+            chain += self.backing.backing_chain()
+        elif self.backing_file:
+            chain.append(self.backing_file)
+        return chain
+
+    def close(self):
+        self.f.close()
+        if self.backing:
+            self.backing.close()
+
+    def _read_cluster(self, cluster_index, offset, length):
+        '''
+        Reads length bytes at offset within a guest cluster
+        '''
+        l1_index=cluster_index >> self.l2_bits
+        l2_index=cluster_index & ((1 << self.l2_bits) - 1)
+        l2_offset=(self.l1_table[l1_index] if l1_index < self.l1_size else 0) & 0x00fffffffffffe00
+
+        entry=0
+        if l2_offset:
+            if not self.l2_cache.has_key(l2_offset):
+                self.l2_cache[l2_offset]=struct.unpack('>{}Q'.format(1 << self.l2_bits),
+                                                       self._pread(l2_offset, self.cluster_size))
+            entry=self.l2_cache[l2_offset][l2_index]
+
+        if entry & (1 << 62):
+            # compressed cluster: raw deflate stream at a sector granular host offset
+            bits=62 - (self.cluster_bits - 8)
+            host_offset=entry & ((1 << bits) - 1)
+            sectors=((entry >> bits) & ((1 << (self.cluster_bits - 8)) - 1)) + 1
+            data=self._pread(host_offset, sectors * 512 - (host_offset & 511))
+            return zlib.decompressobj(-12).decompress(data)[offset:offset + length]
+
+        if entry & 1 and self.version >= 3:
+            return '\0' * length
+
+        host_offset=entry & 0x00fffffffffffe00
+        if host_offset:
+            return self._pread(host_offset + offset, length)
+
+        # not allocated in this layer, it comes from the backing chain
+        guest_offset=(cluster_index << self.cluster_bits) + offset
+        if self.backing and guest_offset < self.backing.virtual_size:
+            return self.backing.read(guest_offset, length)
+
+        return '\0' * length
+
+    def read(self, offset, length):
+        '''
+        Reads guest data from the image, as seen by a virtual machine
+        '''
+        if self.format == 'raw':
+            return self._pread(offset, length).ljust(length, '\0')
+
+        data=[]
+        while length > 0:
+            cluster_index, cluster_offset=divmod(offset, self.cluster_size)
+            chunk=min(length, self.cluster_size - cluster_offset)
+            data.append(self._read_cluster(cluster_index, cluster_offset, chunk))
+            offset += chunk
+            length -= chunk
+
+        return ''.join(data)
+
+    def _fstype(self, start):
+        '''
+        Returns the file system found at a guest byte offset: ext2, ext3, ext4, fat, or None
+        '''
+        superblock=self.read(start + 1024, 104)
+        if struct.unpack('<H', superblock[56:58])[0] == 0xef53:
+            compat, incompat=struct.unpack('<II', superblock[92:100])
+            if incompat & 0x40 or incompat & 0x200:
+                return 'ext4'
+            elif compat & 0x4:
+                return 'ext3'
+            return 'ext2'
+
+        boot=self.read(start, 512)
+        if boot[54:57] == 'FAT' or boot[82:85] == 'FAT':
+            return 'fat32' if boot[82:87] == 'FAT32' else 'fat16'
+
+        return None
+
+    def partitions(self, sector_size=512):
+        '''
+        Returns the list of partitions in the form
+        { 'number': n, 'table': 'mbr' or 'gpt', 'type': id or guid, 'start': bytes, 'size': bytes, 'fstype': name }
+        An empty list is returned if the image has no partition table.
+        '''
+        mbr=self.read(0, 512)
+        if mbr[510:512] != '\x55\xaa':
+            return []
+
+        partitions=[]
+        entries=[ struct.unpack('<B3sB3sII', mbr[446 + i*16:462 + i*16]) for i in range(4) ]
+        if any(entry[2] == 0xee for entry in entries):
+            return self._gpt_partitions(sector_size)
+
+        for number, (_, _, part_type, _, lba, sectors) in enumerate(entries, 1):
+            if not part_type or not sectors:
+                continue
+            if part_type in mbr_extended_types:
+                partitions += self._logical_partitions(lba, sector_size)
+                continue
+            partitions.append({ 'number': number, 'table': 'mbr', 'type': part_type,
+                                'start': lba * sector_size, 'size': sectors * sector_size })
+
+        for partition in partitions:
+            partition['fstype']=self._fstype(partition['start'])
+
+        return sorted(partitions, key=lambda p: p['start'])
+
+    def _logical_partitions(self, extended_lba, sector_size):
+        '''
+        Follows the chain of extended boot records, logical partitions are numbered from 5
+        '''
+        partitions=[]
+        ebr_lba=extended_lba
+        number=5
+        while number < 64:
+            ebr=self.read(ebr_lba * sector_size, 512)
+            if ebr[510:512] != '\x55\xaa':
+                break
+
+            _, _, part_type, _, lba, sectors=struct.unpack('<B3sB3sII', ebr[446:462])
+            if part_type and sectors:
+                partitions.append({ 'number': number, 'table': 'mbr', 'type': part_type,
+                                    'start': (ebr_lba + lba) * sector_size, 'size': sectors * sector_size })
+
+            _, _, next_type, _, next_lba, _=struct.unpack('<B3sB3sII', ebr[462:478])
+            if not next_type:
+                break
+            ebr_lba=extended_lba + next_lba
+            number += 1
+
+        return partitions
+
+    def _gpt_partitions(self, sector_size):
+        header=self.read(sector_size, 92)
+        if header[:8] != 'EFI PART':
+            return []
+
+        entries_lba, entries_count, entry_size=struct.unpack('<QII', header[72:88])
+        table=self.read(entries_lba * sector_size, entries_count * entry_size)
+
+        partitions=[]
+        for number in range(entries_count):
+            entry=table[number * entry_size:(number + 1) * entry_size]
+            type_guid, first_lba, last_lba=entry[:16], struct.unpack('<Q', entry[32:40])[0], struct.unpack('<Q', entry[40:48])[0]
+            if type_guid == '\0' * 16:
+                continue
+            partitions.append({ 'number': number + 1, 'table': 'gpt', 'type': str(uuid.UUID(bytes_le=type_guid)),
+                                'start': first_lba * sector_size, 'size': (last_lba - first_lba + 1) * sector_size,
+                                'fstype': self._fstype(first_lba * sector_size) })
+
+        return sorted(partitions, key=lambda p: p['start'])
+
+def compare_debian_versions(a, b):
+    '''
+    Compares two Debian package versions as dpkg does, returns -1, 0 or 1
+    '''
+    def order(c):
+        if c == '~':
+            return -1
+        if c.isdigit():
+            return 0
+        if c.isalpha():
+            return ord(c)
+        return ord(c) + 256
+
+    def compare_part(x, y):
+        while x or y:
+            # non digit prefixes compare with letters before symbols and ~ before anything
+            while (x and not x[0].isdigit()) or (y and not y[0].isdigit()):
+                cx=order(x[0]) if x and not x[0].isdigit() else 0
+                cy=order(y[0]) if y and not y[0].isdigit() else 0
+                if cx != cy:
+                    return cmp(cx, cy)
+                x, y=x[1:], y[1:]
+
+            dx=re.match(r'\d*', x).group()
+            dy=re.match(r'\d*', y).group()
+            if int(dx or 0) != int(dy or 0):
+                return cmp(int(dx or 0), int(dy or 0))
+            x, y=x[len(dx):], y[len(dy):]
+
+        return 0
+
+    def split(version):
+        epoch, _, rest=version.partition(':') if ':' in version else ('0', '', version)
+        upstream, _, revision=rest.rpartition('-') if '-' in rest else (rest, '', '0')
+        return int(epoch or 0), upstream, revision
+
+    ea, ua, ra=split(a)
+    eb, ub, rb=split(b)
+    return cmp(ea, eb) or compare_part(ua, ub) or compare_part(ra, rb)
+
+def parse_relations(text):
+    '''
+    Parses a Debian relationship field such as "a (>= 1.0), b | c [armhf]" into a list
+    of alternatives, each one a list of (package, operator, version) tuples.
+    A plain whitespace separated list of package names is accepted too.
+    '''
+    relation=re.compile(r'^([a-z0-9][a-z0-9+.\-]*)(?::[a-z0-9\-]+)?\s*'
+                        r'(?:\(\s*(<<|<=|=|>=|>>|<|>)\s*([^)\s]+)\s*\))?\s*(?:\[[^\]]*\]\s*)?(?:<[^>]*>\s*)*$')
+
+    text=' '.join(text.split())
+    if ',' in text or '|' in text or '(' in text:
+        groups=[ g for g in text.split(',') if g.strip() ]
+    else:
+        groups=text.split()
+
+    relations=[]
+    for group in groups:
+        alternatives=[]
+        for alternative in group.split('|'):
+            match=relation.match(alternative.strip())
+            if not match:
+                raise ValueError('cannot parse dependency: {}'.format(alternative.strip()))
+            alternatives.append(match.groups())
+        relations.append(alternatives)
+
+    return relations
+
+def read_control_fields(filename):
+    '''
+    Returns the stanzas of a Debian control style file as a list of dictionaries.
+    Continuation lines are joined into their field.
+    '''
+    stanzas=[]
+    fields={}
+    field=None
+    with open(filename, 'r') as f:
+        for line in f:
+            if not line.strip():
+                if fields:
+                    stanzas.append(fields)
+                fields={}
+                field=None
+            elif line[0] in ' \t':
+                if field:
+                    fields[field] += '\n' + line.strip()
+            elif ':' in line and not line.startswith('#'):
+                field, _, value=line.partition(':')
+                field=field.strip()
+                fields[field]=value.strip()
+
+    if fields:
+        stanzas.append(fields)
+
+    return stanzas
+
+class DpkgStatus():
+    '''
+    The packages installed in a sysroot, read from its dpkg database without any emulation.
+    Checks dependency lists, including version constraints and virtual packages.
+    '''
+    def __init__(self, root='/'):
+        self.installed={}
+        self.provided={}
+
+        for package in read_control_fields(os.path.join(root, 'var/lib/dpkg/status')):
+            if not package.get('Status', '').endswith(' installed'):
+                continue
+
+            name=package['Package']
+            self.installed.setdefault(name, []).append(package.get('Version', ''))
+            for provided in parse_relations(package.get('Provides', '')):
+                name, _, version=provided[0]
+                self.provided.setdefault(name, []).append(version)
+
+    def satisfies(self, package, operator=None, version=None):
+        '''
+        Returns True if an installed package, or one providing it, satisfies the relation
+        '''
+        tests={ '<<': lambda r: r < 0, '<': lambda r: r <= 0, '<=': lambda r: r <= 0, '=': lambda r: r == 0,
+                '>=': lambda r: r >= 0, '>': lambda r: r >= 0, '>>': lambda r: r > 0 }
+
+        if not operator:
+            return self.installed.has_key(package) or self.provided.has_key(package)
+
+        candidates=self.installed.get(package, []) + [ v for v in self.provided.get(package, []) if v ]
+        return any(tests[operator](compare_debian_versions(candidate, version)) for candidate in candidates)
+
+    def missing(self, dependencies):
+        '''
+        Returns the list of relations not satisfied, as the package names apt-get should install.
+        For alternatives ("a | b") the first one is returned.
+        '''
+        missing=[]
+        for alternatives in parse_relations(dependencies):
+            if not any(self.satisfies(*alternative) for alternative in alternatives):
+                missing.append(alternatives[0][0])
+
+        return missing
+
+# XWD header fields, all big endian 32 bit words. Used by Xvfb framebuffer files and xwd
+xwd_header_fields=('header_size', 'file_version', 'pixmap_format', 'pixmap_depth', 'pixmap_width',
+                   'pixmap_height', 'xoffset', 'byte_order', 'bitmap_unit', 'bitmap_bit_order',
+                   'bitmap_pad', 'bits_per_pixel', 'bytes_per_line', 'visual_class', 'red_mask',
+                   'green_mask', 'blue_mask', 'bits_per_rgb', 'colormap_entries', 'ncolors',
+                   'window_width', 'window_height', 'window_x', 'window_y', 'window_bdrwidth')
+
+def read_xwd_header(data):
+    '''
+    Parses the header of an XWD dump, returns it as a dictionary with the offset
+    where the pixels start, or None if the data is not a version 7 XWD dump.
+    '''
+    size=len(xwd_header_fields) * 4
+    if len(data) < size:
+        return None
+
+    header=dict(zip(xwd_header_fields, struct.unpack('>{}I'.format(len(xwd_header_fields)), data[:size])))
+    if header['file_version'] != 7 or header['header_size'] < size:
+        return None
+
+    # the window name follows the header, then one 12 byte XWDColor entry per color
+    header['pixels_offset']=header['header_size'] + header['ncolors'] * 12
+    header['pixels_size']=header['bytes_per_line'] * header['pixmap_height']
+    return header
+
+def percentiles(values, points=(50, 90, 99)):
+    '''
+    Returns a dictionary of nearest-rank percentiles from a list of numbers,
+    along with the minimum and maximum. Empty lists give an empty dictionary.
+    '''
+    if not values:
+        return {}
+
+    ordered=sorted(values)
+    result={ 'min': ordered[0], 'max': ordered[-1] }
+    for point in points:
+        rank=max(1, int(-(-point * len(ordered) // 100)))
+        result['p{}'.format(point)]=ordered[rank - 1]
+
+    return result
+
 class XSysroot():
     '''
     A class which encapsulates a mount based access to a ARM sysroot image
@@ -69,8 +1297,18 @@ class XSysroot():
         self.ld_so_preload_backup='{}-disabled'.format(self.ld_so_preload)
 
         # In order to allow your sysroot access to private network data
-        # a custom DNS setting is specified here.
+        # a custom DNS can be set with "dns_server", "host" copies the host resolv.conf.
         self.dns_server='8.8.8.8'
+
+        # apt configuration for local mirrors and proxies, written to the tmp directory and given
+        # to apt in the sysroot via APT_CONFIG, so nothing is changed in the image itself
+        self.apt_config='xsysroot-apt.conf'
+        self.apt_archives='var/cache/apt/archives'
+        self.last_apt_stats=None
+
+        # Host directories bound into the sysroot to run a host cross toolchain, see offload_compilers
+        self.offload_dir='xsysroot-offload'
+        self.offload_libraries=('/lib64', '/lib/x86_64-linux-gnu', '/usr/lib/x86_64-linux-gnu')
         print "profile ", profile
         # choose a settings profile, or set to last used
         if not profile:
@@ -85,16 +1323,7 @@ class XSysroot():
         '''
         Finds the system-wide or private user configuration file
         '''
-        settings_system=os.path.join(os.path.expanduser('/etc'), self.settings_filename)
-        settings_user=os.path.join(os.path.expanduser('~'), self.settings_filename)
-        if os.path.isfile(settings_system):
-            # print "settings_system ", settings_system
-            return settings_system
-        if os.path.isfile(settings_user):
-            # print "settings_user", settings_user
-            return settings_user
-
-        return None
+        return find_settings_filename(self.settings_filename)
 
     def _get_active_profile(self):
         '''
@@ -158,68 +1387,60 @@ class XSysroot():
         Loads your current working profile from the configuration file at /etc,
         your home directory, or embedded in the xsysroot module.
         '''
-        self.settings=None
-        try:
-            filename=self._get_settings_filename()
-            if filename:
-                with open(filename, 'r') as f:
-                    self.settings=json.load(f)[self.profile]
-                    print self.settings 
-            else:
-                filename=__file__
-                self.profile='default'
-                self.settings=json.loads(default_settings)[self.profile]
-                print self.settings 
-        except:
-            # FIXME: when no self.profile found it does raise exception
-            print 'could not load settings - please check Json syntax ({})'.format(filename)
-            raise
-
+        self.profile, self.settings=load_profile(self.profile, self.settings_filename)
         self._set_active_profile(self.profile)
 
-        # Expand shell macros, this allows to embed things like (date +%d) and ~ homedir.
-        self.settings['sysroot'] = os.popen(
-            'echo {}'.format(self.settings['sysroot'])).read().strip('\n')
-        self.settings['tmp'] = os.popen(
-            'echo {}'.format(self.settings['tmp'])).read().strip('\n')
-        self.settings['backing_image'] = os.popen(
-            'echo {}'.format(self.settings['backing_image'])).read().strip('\n')
-        self.settings['qcow_image'] = os.popen(
-            'echo {}'.format(self.settings['qcow_image'])).read().strip('\n')
+        # "nbdev" set to "auto" or not set at all takes a device from the pool when needed
+        self.nbd_pool=NbdPool()
+        self.nbdev_auto=(self.settings.get('nbdev', 'auto') == 'auto')
+        self.settings['nbdev']=self.nbd_pool.resolve(self.profile, self.settings)
+
+    def _acquire_nbdev(self):
+        '''
+        Locks the profile nbd device, allocating a free one from the pool if it is "auto".
+        Returns False if no device is available.
+        '''
+        nbdev=self.settings['nbdev']
+        if nbdev == 'auto':
+            nbdev=self.nbd_pool.allocate(self.profile, self.settings['qcow_image'])
+            if not nbdev:
+                print 'all nbd devices are in use - aborting'
+                return False
+
+            self.settings['nbdev']=nbdev
+        elif not self.nbd_pool.acquire(nbdev, self.profile, self.settings['qcow_image']):
+            owner=self.nbd_pool.owner(nbdev) or {}
+            print 'nbd device {} is in use by profile {} - aborting'.format(nbdev, owner.get('profile'))
+            return False
+
+        return True
+
+    def _release_nbdev(self):
+        '''
+        Unlocks the profile nbd device, an allocated one goes back to the pool
+        '''
+        self.nbd_pool.release(self.settings['nbdev'], self.profile)
+        if self.nbdev_auto:
+            self.settings['nbdev']='auto'
 
     def _uncompress_backing_image(self):
         '''
-        Uncompress the backing image if necessary, returns the raw image filename
+        Uncompress the backing image if necessary, returns the raw image filename.
+        Uncompressed images are kept in the "image_cache" directory, keyed on the hash
+        of the compressed image, so they are reused until the compressed image changes.
         '''
         if not os.path.isfile(self.settings['backing_image']):
             return None
 
         file_pathname, extension=os.path.splitext(self.settings['backing_image'])
         if extension in ('.gz', '.zip', '.xz'):
-            uncompressed=self.settings['qcow_image'].replace('.qcow', '.img')
-            if os.path.isfile(uncompressed):
-                print 'Removing uncompressed backing image {}'.format(uncompressed)
-                rc=self._run_cmd('rm {}'.format(uncompressed))
-
-            if extension=='.gz':
-                uncompress='gunzip -c'
-            elif extension=='.zip':
-                uncompress='unzip -p'
-            elif extension=='xz':
-                uncompress='xz --decompress --stdout'
-            else:
-                return None
-
-            # Uncompress again to get the latest version of the backing image
-            print 'Uncompressing image {} into {}'.format(self.settings['backing_image'], uncompressed)
-            p=self._run_cmd('{} {} > {}'.format(uncompress, self.settings['backing_image'], uncompressed))
-        elif extension in ('.img'):
+            cache=ImageCache(self.settings.get('image_cache', default_image_cache))
+            return cache.uncompressed(self.settings['backing_image'], verbose=self.verbose)
+        elif extension == '.img':
             # backing file is in raw format, no need to uncompress
-            uncompressed=self.settings['backing_image']
-        else:
-            return None
+            return self.settings['backing_image']
 
-        return uncompressed
+        return None
 
     def _prepare_sysroot(self):
         if not self.is_mounted():
@@ -229,13 +1450,22 @@ class XSysroot():
         # Copy ARM emulator, setup a default DNS, and remove libcofi.so preload
         print 'Preparing sysroot for chroot to function correctly'
 
-        self._run_cmd('sudo mkdir -p {sysroot}/usr/bin'.format(**self.settings))
-        self._run_cmd('sudo cp $(which qemu-arm-static) ' \
-                          '{sysroot}/usr/bin'.format(**self.settings))
+        operations=[]
+        emulator=find_program('qemu-arm-static')
+        if emulator:
+            operations.append(('copy_host', emulator, '/usr/bin/qemu-arm-static'))
+        else:
+            print 'qemu-arm-static not found on the host'
+
+        dns_server=self.settings.get('dns_server', self.dns_server)
+        if dns_server == 'host':
+            operations.append(('copy_host', '/etc/resolv.conf', '/etc/resolv.conf'))
+        else:
+            operations.append(('write', '/etc/resolv.conf', 'nameserver {}\n'.format(dns_server)))
 
-        self.edfile('/etc/resolv.conf', 'nameserver {}'.format(self.dns_server), verbose=True)
+        success=self.edit_files(operations)
         print 'Preparation done'
-        return True
+        return success
 
     def _run_cmd(self, command):
         '''
@@ -244,6 +1474,40 @@ class XSysroot():
         rc=os.system(command)
         return os.WEXITSTATUS(rc)
 
+    def _step(self, name, do, undo=None, optional=False, requires=None):
+        '''
+        Returns a planned transaction step. "do" and "undo" are actions in the form
+        ('argv', [ program, args... ]), ('rename', src, dst), ('rmdir', path) or ('wait', path, timeout).
+        Optional steps do not trigger a rollback on failure, "requires" names a previous step,
+        or a list of them, which must have succeeded for this one to run.
+        '''
+        return { 'name': name, 'do': do, 'undo': undo, 'optional': optional, 'requires': requires }
+
+    def _run_transaction(self, steps, rollback=True):
+        '''
+        Runs all planned steps in one single privileged helper invocation.
+        If a mandatory step fails and rollback is True, the steps already done are undone.
+        The per-step report is kept in self.last_transaction, returns True on success.
+        '''
+        plan=json.dumps({ 'steps': steps, 'rollback': rollback })
+        try:
+            helper=subprocess.Popen(['sudo', sys.executable, '-c', transaction_helper],
+                                    stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            output, _=helper.communicate(plan)
+            report=json.loads(output)
+        except (OSError, ValueError) as e:
+            print 'error running privileged helper: {}'.format(e)
+            self.last_transaction=[]
+            return False
+
+        self.last_transaction=report['steps']
+        if self.verbose or report['failed']:
+            for step in report['steps']:
+                status='skipped' if step['rc'] is None else 'rc={}'.format(step['rc'])
+                print ' {:<40} {:>8.3f}s {}'.format(step['name'], step['elapsed'], status)
+
+        return not report['failed']
+
     def _xrun_cmd(self, environment='LC_ALL=C', command='/bin/bash', as_user=None):
         '''
         Runs a command inside the sysroot.
@@ -255,6 +1519,10 @@ class XSysroot():
         if display:
             environment='"{}" "{}"'.format(environment, 'DISPLAY=:{}'.format(display))
 
+        apt_config=self._apt_environment()
+        if apt_config:
+            environment='{} "{}"'.format(environment, apt_config)
+
         if as_user:
             userspec='-c "su - {}"'.format(as_user)
 
@@ -270,14 +1538,16 @@ class XSysroot():
             print 'Available profiles (* means mounted)'
             filename=self._get_settings_filename()
             if filename:
-                with open(filename, 'r') as f:
-                    settings=json.load(f)
-                    for profile in settings:
-                        mounted=' '
-                        if self.is_mounted(settings=settings[profile]):
-                            mounted = '*'
-
-                        print ' {} {} ({})'.format(mounted, profile, settings[profile]['description'])
+                settings=read_profiles(filename)
+                index=MountIndex()
+                for profile in settings:
+                    mounted=' '
+                    state=index.state(expand_profile(settings[profile]))
+                    if state['mounted']:
+                        mounted = '*'
+
+                    print ' {} {} ({}){}'.format(mounted, profile, settings[profile]['description'],
+                                                 ' on {}'.format(state['device']) if state['mounted'] else '')
             else:
                 print 'could not find settings file: {}'.format(self.settings_filename)
         except:
@@ -309,18 +1579,28 @@ class XSysroot():
         '''
         Displays a message to say if the sysroot is mounted
         '''
-        ismounted=self.is_mounted()
-        print 'sysroot mounted?', ismounted
-        return ismounted
+        state=self.mount_state()
+        print 'sysroot mounted?', state['mounted']
+        if state['mounted']:
+            print 'root device: {}, bind mounts: {}'.format(state['device'], ' '.join(state['binds']))
+        return state['mounted']
 
-    def is_mounted(self, settings=None):
+    def mount_state(self, settings=None, index=None):
         '''
-        Returns True if the current profile sysroot is mounted
+        Returns the mount state of the current profile, or the given settings,
+        see MountIndex.state(). Pass an index to query many profiles from one snapshot.
         '''
         if not settings:
             settings=self.settings
-        rc=self._run_cmd('mountpoint {sysroot} > /dev/null 2>&1'.format(**settings))
-        return (rc == 0)
+        if not index:
+            index=MountIndex()
+        return index.state(settings)
+
+    def is_mounted(self, settings=None, index=None):
+        '''
+        Returns True if the current profile sysroot is mounted
+        '''
+        return self.mount_state(settings, index)['mounted']
 
     def status(self):
         '''
@@ -338,18 +1618,235 @@ class XSysroot():
         '''
         return self.settings[variable]
 
-    def running(self):
+    def busy_processes(self, timeout=0):
+        '''
+        Returns the processes running inside or holding files of the sysroot, as a list
+        of dictionaries with pid, cmdline and reason (root, cwd, exe, fd or mem).
+        Waits up to timeout seconds for them to finish. Returns None if they cannot be scanned.
+        '''
+        request=json.dumps({ 'paths': [ self.settings['sysroot'] ], 'timeout': timeout })
+        try:
+            helper=subprocess.Popen(['sudo', sys.executable, '-c', busy_helper],
+                                    stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            output, _=helper.communicate(request)
+            return json.loads(output)
+        except (OSError, ValueError) as e:
+            print 'error scanning processes: {}'.format(e)
+            return None
+
+    def running(self, timeout=0):
         '''
-        Finds and reports any processes currently running on the sysroot
+        Finds and reports any processes currently running on the sysroot,
+        waiting up to timeout seconds for them to finish.
         Returns True if processes were found, False otherwise
         '''
         if not self.is_mounted():
             print 'sysroot not mounted'
             return False
 
-        rc=self._run_cmd('sudo lsof -l {sysroot}'.format(**self.settings))
-        return (rc == 0)
-        
+        if timeout:
+            print 'waiting up to {} seconds for processes on the sysroot to finish'.format(timeout)
+
+        processes=self.busy_processes(timeout)
+        if processes is None:
+            return True
+
+        for process in processes:
+            print ' {:>7} {:<4} {}'.format(process['pid'], process['reason'], process['cmdline'])
+
+        return (len(processes) > 0)
+
+    def _mount_directories(self):
+        '''
+        Returns the host directories that need to exist before mounting,
+        they are created as the calling user so they stay writable.
+        '''
+        directories=[ self.settings['sysroot'], self.settings['tmp'] ]
+        if self.settings.has_key('boot_part') and self.settings.has_key('sysboot'):
+            directories.append(self.settings['sysboot'])
+
+        for extra_mount in self._get_add_mounts():
+            directories.append(extra_mount['mount'])
+
+        if self._apt_cache_dir():
+            directories.append(self._apt_cache_dir())
+
+        return directories
+
+    def _apt_cache_dir(self):
+        '''
+        Returns the host directory bind mounted on the sysroot apt archives, so downloaded
+        packages survive renew. Set "apt_cache" to an empty string to disable it.
+        '''
+        default=os.path.join(os.path.expanduser(self.settings.get('image_cache', default_image_cache)), 'apt-archives')
+        return self.settings.get('apt_cache', default) or None
+
+    def _write_apt_config(self):
+        '''
+        Writes the apt configuration for the "apt_proxy" and "apt_sources" settings to the tmp directory.
+        apt_sources replaces the sysroot sources lists, as one "deb ..." line or a list of them,
+        i.e. a local mirror to provision offline. Returns True if there is a configuration to use.
+        '''
+        config_file=os.path.join(self.settings['tmp'], self.apt_config)
+        lines=[]
+
+        if self.settings.get('apt_proxy'):
+            lines.append('Acquire::http::Proxy "{}";'.format(self.settings['apt_proxy']))
+
+        sources=self.settings.get('apt_sources')
+        if sources:
+            if isinstance(sources, basestring):
+                sources=[ sources ]
+
+            sources_dir=os.path.join(self.settings['tmp'], 'xsysroot-apt')
+            if not os.path.isdir(os.path.join(sources_dir, 'sources.list.d')):
+                os.makedirs(os.path.join(sources_dir, 'sources.list.d'))
+
+            with open(os.path.join(sources_dir, 'sources.list'), 'w') as f:
+                f.write('\n'.join(sources) + '\n')
+
+            lines.append('Dir::Etc::SourceList "/tmp/xsysroot-apt/sources.list";')
+            lines.append('Dir::Etc::SourceParts "/tmp/xsysroot-apt/sources.list.d";')
+
+        if not lines:
+            if os.path.isfile(config_file):
+                os.unlink(config_file)
+            return False
+
+        with open(config_file, 'w') as f:
+            f.write('// written by xsysroot for profile {}\n{}\n'.format(self.profile, '\n'.join(lines)))
+
+        return True
+
+    def _apt_environment(self):
+        '''
+        Returns the APT_CONFIG variable for commands in the sysroot, or None if there is no apt configuration
+        '''
+        if os.path.isfile(os.path.join(self.settings['tmp'], self.apt_config)):
+            return 'APT_CONFIG=/tmp/{}'.format(self.apt_config)
+
+        return None
+
+    def _plan_mount(self):
+        '''
+        Returns the list of transaction steps needed to mount the sysroot
+        '''
+        sysroot=self.settings['sysroot']
+        nbdev=self.settings['nbdev']
+        steps=[]
+
+        # Connect the image and mount the "nbdev" root partition
+        steps.append(self._step('connect {}'.format(nbdev),
+                                ('argv', [ 'qemu-nbd', '-c', nbdev, self.settings['qcow_image'] ]),
+                                ('argv', [ 'qemu-nbd', '-d', nbdev ])))
+        steps.append(self._step('wait {}{}'.format(nbdev, self.settings['nbdev_part']),
+                                ('wait', '{nbdev}{nbdev_part}'.format(**self.settings), 10)))
+        steps.append(self._step('mount {}'.format(sysroot),
+                                ('argv', [ 'mount', '{nbdev}{nbdev_part}'.format(**self.settings), sysroot ]),
+                                ('argv', [ 'umount', sysroot ])))
+
+        # Disable ld.so.preload from dragging QEMU unsupported syscalls (restored on umount)
+        preload=os.path.join(sysroot, self.ld_so_preload)
+        preload_backup=os.path.join(sysroot, self.ld_so_preload_backup)
+        steps.append(self._step('disable {}'.format(self.ld_so_preload),
+                                ('rename', preload, preload_backup),
+                                ('rename', preload_backup, preload)))
+
+        # Map linux virtual file systems into the host
+        for source, target in (('/dev', 'dev'), ('/proc', 'proc'), ('/sys', 'sys'), (self.settings['tmp'], 'tmp')):
+            target=os.path.join(sysroot, target)
+            steps.append(self._step('bind {}'.format(target),
+                                    ('argv', [ 'mount', '--bind', source, target ]),
+                                    ('argv', [ 'umount', target ])))
+
+        # Keep downloaded packages on the host
+        if self._apt_cache_dir():
+            target=os.path.join(sysroot, self.apt_archives)
+            steps.append(self._step('bind {}'.format(target),
+                                    ('argv', [ 'mount', '--bind', self._apt_cache_dir(), target ]),
+                                    ('argv', [ 'umount', target ]), optional=True))
+
+        # try to mount the boot partition if specified
+        if self.settings.has_key('boot_part') and self.settings.has_key('sysboot'):
+            boot_step='mount {}'.format(self.settings['sysboot'])
+            steps.append(self._step(boot_step,
+                                    ('argv', [ 'mount', '{nbdev}{boot_part}'.format(**self.settings), self.settings['sysboot'] ]),
+                                    ('argv', [ 'umount', self.settings['sysboot'] ]), optional=True))
+
+            # Create a bind mount so the boot partition is accesible from the root
+            target=os.path.join(sysroot, 'boot')
+            steps.append(self._step('bind {}'.format(target),
+                                    ('argv', [ 'mount', '--bind', self.settings['sysboot'], target ]),
+                                    ('argv', [ 'umount', target ]), optional=True, requires=boot_step))
+
+        # mount additional partitions if specified
+        for extra_mount in self._get_add_mounts():
+            steps.append(self._step('mount {mount}'.format(**extra_mount),
+                                    ('argv', [ 'mount', extra_mount['device'], extra_mount['mount'] ]),
+                                    ('argv', [ 'umount', extra_mount['mount'] ]), optional=True))
+
+        return steps
+
+    def _plan_umount(self):
+        '''
+        Returns the list of transaction steps needed to unmount the sysroot,
+        which is the reverse of the mount plan plus removal of the mount directories.
+        '''
+        sysroot=self.settings['sysroot']
+        steps=[]
+        index=MountIndex()
+
+        # the device is only disconnected once the file systems on it are unmounted
+        disconnect_requires=[]
+
+        # Unbind the host directories of an offloaded toolchain, deepest first
+        binds=[ os.path.realpath(os.path.join(sysroot, d.lstrip('/'))) for d in self._offload_binds() ]
+        for target in sorted(index.state(self.settings)['binds'], reverse=True):
+            if target in binds:
+                steps.append(self._step('umount {}'.format(target), ('argv', [ 'umount', target ]), optional=True))
+
+        # and remove the directories created for them, deepest first, only those left empty go
+        for directory in sorted(self._offload_binds('created.json'), reverse=True):
+            target=os.path.join(sysroot, directory.lstrip('/'))
+            steps.append(self._step('rmdir {}'.format(target), ('rmdir', target), optional=True))
+
+        # Restore ld.so.preload to its original state (QEMU syscalls safeguard)
+        steps.append(self._step('restore {}'.format(self.ld_so_preload),
+                                ('rename', os.path.join(sysroot, self.ld_so_preload_backup),
+                                 os.path.join(sysroot, self.ld_so_preload)), optional=True))
+
+        for target in (self.apt_archives, 'tmp', 'sys', 'proc', 'dev'):
+            target=os.path.join(sysroot, target)
+            steps.append(self._step('umount {}'.format(target), ('argv', [ 'umount', target ]), optional=True))
+
+        # try to unmount the boot partition if mounted
+        if self.settings.has_key('boot_part') and self.settings.has_key('sysboot'):
+            target=os.path.join(sysroot, 'boot')
+            steps.append(self._step('umount {}'.format(target), ('argv', [ 'umount', target ]), optional=True))
+            steps.append(self._step('umount {sysboot}'.format(**self.settings),
+                                    ('argv', [ 'umount', self.settings['sysboot'] ]), optional=True))
+            steps.append(self._step('rmdir {sysboot}'.format(**self.settings),
+                                    ('rmdir', self.settings['sysboot']), optional=True))
+
+        steps.append(self._step('umount {}'.format(sysroot), ('argv', [ 'umount', sysroot ]), optional=True))
+        steps.append(self._step('rmdir {}'.format(sysroot), ('rmdir', sysroot), optional=True))
+        if index.is_mounted(sysroot):
+            disconnect_requires.append('umount {}'.format(sysroot))
+
+        # unmount any additional partitions specified
+        for extra_mount in self._get_add_mounts():
+            steps.append(self._step('umount {mount}'.format(**extra_mount),
+                                    ('argv', [ 'umount', extra_mount['mount'] ]), optional=True))
+            steps.append(self._step('rmdir {mount}'.format(**extra_mount),
+                                    ('rmdir', extra_mount['mount']), optional=True))
+            if index.is_mounted(extra_mount['mount']):
+                disconnect_requires.append('umount {mount}'.format(**extra_mount))
+
+        steps.append(self._step('disconnect {nbdev}'.format(**self.settings),
+                                ('argv', [ 'qemu-nbd', '-d', self.settings['nbdev'] ]), optional=True,
+                                requires=disconnect_requires or None))
+        return steps
+
     def mount(self):
         '''
         Mounts the sysroot image to get ready for use
@@ -363,46 +1860,23 @@ class XSysroot():
                 return mounted
         else:
             print 'binding qcow image:', self.settings['qcow_image']
-            p=self._run_cmd('mkdir -p {}'.format(self.settings['sysroot']))
-            p=self._run_cmd('mkdir -p {}'.format(self.settings['tmp']))
+            for directory in self._mount_directories():
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+
+            self._write_apt_config()
+
+            if not self._acquire_nbdev():
+                return mounted
 
-            # Connect the image and mount the "nbdev" root partition
-            p=self._run_cmd('sudo qemu-nbd -c {nbdev} {qcow_image}; sync'.format(**self.settings))
+            # Connect, mount, bind and preload safeguard in one privileged transaction
             print 'mounting root partition {nbdev}{nbdev_part} -> {sysroot}'.format(**self.settings)
-            p=self._run_cmd('sudo mount {nbdev}{nbdev_part} {sysroot}'.format(**self.settings))
-
-            # Disable ld.so.preload from dragging QEMU unsupported syscalls (restored on umount)
-            if os.path.isfile('{}/{}'.format(self.query('sysroot'), self.ld_so_preload)):
-                self._run_cmd('sudo mv -fv {}/{} {}/{}'.format(
-                        self.query('sysroot'), self.ld_so_preload,
-                        self.query('sysroot'), self.ld_so_preload_backup))
-
-            # Map linux virtual file systems into the host
-
-            p=self._run_cmd('sudo mount --bind /dev {sysroot}/dev'.format(**self.settings))
-            p=self._run_cmd('sudo mount --bind /proc {sysroot}/proc'.format(**self.settings))
-            p=self._run_cmd('sudo mount --bind /sys {sysroot}/sys'.format(**self.settings))
-            p=self._run_cmd('sudo mount --bind {tmp} {sysroot}/tmp'.format(**self.settings))
-
-            # try to mount the boot partition if specified
-            if self.settings.has_key('boot_part') and self.settings.has_key('sysboot'):
-                p=self._run_cmd('mkdir -p {}'.format(self.settings['sysboot']))
-                print 'mounting boot partition {nbdev}{boot_part} -> {sysboot}'.format(**self.settings)
-                rc=self._run_cmd('sudo mount {nbdev}{boot_part} {sysboot}'.format(**self.settings))
-                if not rc:
-                    # Create a bind mount so the boot partition is accesible from the root
-                    self._run_cmd('sudo mount --bind {sysboot} {sysroot}/boot'.format(**self.settings))
-
-            # mount additional partitions if specified
-            add_mounts = self._get_add_mounts()
-            if len(add_mounts):
-                print 'mounting additional partitions'
-                for extra_mount in add_mounts:
-                    rc=self._run_cmd('mkdir {mount} ; sudo mount {device} {mount}'.format(**extra_mount))
-                    print 'mounted {} => {} rc={}'.format(
-                        extra_mount['device'], extra_mount['mount'], rc)
+            if not self._run_transaction(self._plan_mount()):
+                print 'Error mounting sysroot - all steps have been rolled back'
 
             mounted=self.is_mounted()
+            if not mounted:
+                self._release_nbdev()
             print 'Mount done'
 
         # Start a virtual display server, bound to a tcp endpoint so the sysroot can connect to it
@@ -410,8 +1884,10 @@ class XSysroot():
         if mounted and display_number and resolution and win_manager:
 
             # Start a Frame Buffer headless X server.
-            cmdline='xvfb-run --server-args="-screen 0 {} -shmem" --xauth-protocol="127.0.0.1:{}" ' \
-                '--server-num {} {} > /dev/null 2>&1 &'.format(resolution, display_number, display_number, win_manager)
+            # The framebuffer is mapped to a file in the tmp directory, so frames can be captured by reading it.
+            cmdline='xvfb-run --server-args="-screen 0 {} -fbdir {}" --xauth-protocol="127.0.0.1:{}" ' \
+                '--server-num {} {} > /dev/null 2>&1 &'.format(resolution, self.settings['tmp'],
+                                                              display_number, display_number, win_manager)
 
             rc=self._run_cmd(cmdline)
             if rc == 0:
@@ -424,15 +1900,12 @@ class XSysroot():
                 print 'attached a VNC server to display :{} network address {}:{}'.format(
                     display_number, socket.gethostname(), int(display_number)+self.vnc_start_port)
 
-        if not mounted:
-            # if problems mounting, tell Qemu to free the image
-            p=self._run_cmd('sudo qemu-nbd -d {nbdev}; sync'.format(**self.settings))
-
         return mounted
 
-    def umount(self):
+    def umount(self, timeout=0):
         '''
-        Unmounts the sysroot image and releases associated resources
+        Unmounts the sysroot image and releases associated resources.
+        Waits up to timeout seconds for processes still running on the sysroot.
         '''
         mounted=self.is_mounted()
         if not mounted:
@@ -440,37 +1913,12 @@ class XSysroot():
             return True
         else:
             # sanity check
-            if self.running() == True:
+            if self.running(timeout) == True:
                 print 'ERROR - there seem to be processes working on this sysroot, umount aborted'
                 return False
 
-            # Restore ld.so.preload to its original state (QEMU syscalls safeguard)
-            if os.path.isfile('{}/{}'.format(self.query('sysroot'), self.ld_so_preload_backup)):
-                self._run_cmd('sudo mv -fv {}/{} {}/{}'.format(
-                        self.query('sysroot'), self.ld_so_preload_backup,
-                        self.query('sysroot'), self.ld_so_preload))
-            
             print 'unbinding {qcow_image}'.format(**self.settings)
-            p=self._run_cmd('sudo umount {sysroot}/tmp'.format(**self.settings))
-            p=self._run_cmd('sudo umount {sysroot}/sys'.format(**self.settings))
-            p=self._run_cmd('sudo umount {sysroot}/proc'.format(**self.settings))
-            p=self._run_cmd('sudo umount {sysroot}/dev'.format(**self.settings))
-
-            # try to unmount the boot partition if mounted
-            if self.settings.has_key('boot_part') and self.settings.has_key('sysboot'):
-                p=self._run_cmd('sudo umount {sysboot}'.format(**self.settings))
-                p=self._run_cmd('rmdir {sysboot}'.format(**self.settings))
-                p=self._run_cmd('sudo umount {sysroot}/boot'.format(**self.settings))
-
-            p=self._run_cmd('sudo umount {sysroot} ; rmdir {sysroot}'.format(**self.settings))
-
-            # unmount any additional partitions specified
-            add_mounts = self._get_add_mounts()
-            if len(add_mounts):
-                for extra_mount in add_mounts:
-                    rc=self._run_cmd('sudo umount {mount} ; rmdir {mount}'.format(**extra_mount))
-
-            p=self._run_cmd('sudo qemu-nbd -d {nbdev}; sync'.format(**self.settings))
+            self._run_transaction(self._plan_umount(), rollback=False)
             mounted=self.is_mounted()
 
         # Stop the virtual display
@@ -479,12 +1927,17 @@ class XSysroot():
             print 'Disconnecting Display number {} and window manager {}'.format(display_number, win_manager)
             self._run_cmd('pkill -f "Xvfb :{}"'.format(display_number))
 
+        if not mounted:
+            self._release_nbdev()
+
         print 'Unmount done'
         return (mounted == False)
 
-    def renew(self):
+    def renew(self, layer=None):
         '''
-        Recreates the sysroot from scratch unfolding the original backing image
+        Recreates the sysroot from scratch unfolding the original backing image.
+        If a layer is given, the new qcow image is a scratch overlay on top of that
+        cached layer instead (see commit_layer), which is already prepared and expanded.
         '''
         if self.is_mounted():
             print 'sysroot is mounted, please unmount first'
@@ -500,6 +1953,21 @@ class XSysroot():
             print 'Removing qcow image {qcow_image}'.format(**self.settings)
             rc=self._run_cmd('rm {qcow_image}'.format(**self.settings))
 
+        if layer:
+            print 'Creating qcow image {} on top of layer {}'.format(self.settings['qcow_image'], layer)
+            rc=self._run_cmd('qemu-img create -f qcow2 -F qcow2 -b {} {}'.format(
+                    os.path.abspath(layer), self.settings['qcow_image']))
+            if rc:
+                print 'Error creating qcow image {} rc={}'.format(self.settings['qcow_image'], rc)
+                return False
+
+            if self.mount():
+                print 'Renew done'
+                return True
+
+            print 'Error renewing sysroot'
+            return False
+
         # Get the original backing image, which means uncompress it if necessary
         uncompressed=self._uncompress_backing_image()
         if not uncompressed:
@@ -509,15 +1977,26 @@ class XSysroot():
         # Qcow image size can match the original backing image,
         # or be forced to be larger which allows to expand the filesystem (--expand option)
         # A smaller value will not work and the mount will likely fail to proceed.
-        qcow_size=''
-        try:
-            qcow_size=self.settings['qcow_size']
+        qcow_size=self.settings.get('qcow_size', '')
+        if qcow_size:
+            image=DiskImage(uncompressed)
+            if parse_size(qcow_size) < image.virtual_size:
+                print 'qcow_size {} is smaller than the backing image ({} bytes), ignoring it'.format(
+                    qcow_size, image.virtual_size)
+                qcow_size=''
+            image.close()
+
+        if qcow_size:
             print 'Creating qcow image {qcow_image} of new forced size {qcow_size}'.format(**self.settings)
-        except:
+        else:
             print 'Creating qcow image {qcow_image} of original size'.format(**self.settings)
 
-        p=self._run_cmd('qemu-img create -f qcow2 -b {} {} {}'.format(
-                uncompressed, self.settings['qcow_image'], qcow_size))
+        # The backing pathname is absolute so the qcow image can be moved into a layer
+        rc=self._run_cmd('qemu-img create -f qcow2 -b {} {} {}'.format(
+                os.path.abspath(uncompressed), self.settings['qcow_image'], qcow_size))
+        if rc:
+            print 'Error creating qcow image {} rc={}'.format(self.settings['qcow_image'], rc)
+            return False
 
         if self.mount():
             # Prepare image settings to chroot and access network
@@ -528,11 +2007,81 @@ class XSysroot():
             print 'Error renewing sysroot'
             return False
 
+    def layer_key(self, *inputs):
+        '''
+        Returns a key for a qcow2 layer built on top of the backing image, made from
+        the hash of the backing image and the given inputs (packages installed, fix-up steps, ...)
+        '''
+        cache=ImageCache(self.settings.get('image_cache', default_image_cache))
+        sha1=hashlib.sha1(cache.digest(self.settings['backing_image']))
+        for data in inputs:
+            sha1.update('\0{}'.format(data))
+
+        return sha1.hexdigest()
+
+    def find_layer(self, key):
+        '''
+        Returns the pathname of the cached layer for the given key, or None if not built yet
+        '''
+        cache=ImageCache(self.settings.get('image_cache', default_image_cache))
+        layer=cache.path(key, '.qcow')
+        if os.path.isfile(layer):
+            return layer
+
+        return None
+
+    def uses_layer(self, layer):
+        '''
+        Returns True if the qcow image is stacked on top of the given layer
+        '''
+        try:
+            image=DiskImage(self.settings['qcow_image'])
+            chain=image.backing_chain()
+            image.close()
+        except (IOError, ValueError, struct.error):
+            return False
+
+        return os.path.realpath(layer) in [ os.path.realpath(filename) for filename in chain[1:] ]
+
+    def commit_layer(self, key):
+        '''
+        Freezes the current qcow image into a read-only cached layer for the given key,
+        and renews the sysroot as a new scratch overlay on top of it.
+        The chain becomes: backing image -> layer -> qcow image.
+        Returns the layer pathname, or None on failure.
+        '''
+        if self.is_mounted() and not self.umount():
+            return None
+
+        cache=ImageCache(self.settings.get('image_cache', default_image_cache))
+        layer=cache.path(key, '.qcow')
+        print 'Committing qcow image {} into layer {}'.format(self.settings['qcow_image'], layer)
+        try:
+            shutil.move(self.settings['qcow_image'], layer)
+            os.chmod(layer, 0444)
+        except (IOError, OSError) as e:
+            print 'error committing layer: {}'.format(e)
+            return None
+
+        if not self.renew(layer=layer):
+            return None
+
+        return layer
+
+    def _print_partitions(self, partitions):
+        for partition in partitions:
+            print 'Partition number: {} start: {} end: {} size: {} type: {}'.format(
+                partition['number'], partition['start'], partition['start'] + partition['size'],
+                partition['size'], partition['fstype'])
+
     def expand(self):
         '''
         Expands the last ext2/ext4/ext4 partition to fit the image size
         as specified by the "qcow_size" setting. The image has to be unmounted.
         Use this function with care, i.e. assume "qcow_image" is volatile.
+
+        The partition table is inspected in-process, the image is only connected
+        to the nbd device when the partition actually needs to be resized.
         '''
         expanded=False
         modified=False
@@ -541,105 +2090,140 @@ class XSysroot():
             print 'sysroot is mounted, please unmount before expanding'
             return False
 
+        try:
+            image=DiskImage(self.settings['qcow_image'])
+            partitions=image.partitions()
+            image_size=image.virtual_size
+            image.close()
+        except (IOError, ValueError, struct.error) as e:
+            print 'Could not inspect image {}: {}'.format(self.settings['qcow_image'], e)
+            return False
+
+        # find last partition details and recreate it to fit image size extension
+        if not partitions:
+            print 'Could not find partition details, aborting'
+            return False
+
+        last=partitions[-1]
+        self._print_partitions([ last ])
+        if last['fstype'] not in ('ext2', 'ext3', 'ext4'):
+            print 'Could not expand partition number {} of type {}'.format(last['number'], last['fstype'])
+            return False
+
+        # partitions are aligned, so allow for up to 1MiB unused at the end of the image
+        if image_size - (last['start'] + last['size']) < 1024 * 1024:
+            print 'Partition number {} already fills the image size {}'.format(last['number'], image_size)
+            return True
+
         # connect the image to a disk device
-        disk_device='{nbdev}'.format(**self.settings)
-        part_device='{nbdev}{nbdev_part}'.format(**self.settings)
-        print 'Connecting image {qcow_image} to find and expand last partition'.format(**self.settings)
-        rc=self._run_cmd('sudo qemu-nbd -c {nbdev} {qcow_image}; sync'.format(**self.settings))
-        qcow_image = self.settings['qcow_image']
-        if qcow_image[-1]=='G':
-            qcow_image = int(qcow_image[0:-1])*1024
-        elif qcow_image[-1]=='K':
-            qcow_image = int(qcow_image[0:-1]) / 1024.0
+        if not self._acquire_nbdev():
+            return False
 
+        disk_device='{nbdev}'.format(**self.settings)
+        part_device='{}p{}'.format(disk_device, last['number'])
+        print 'Connecting image {qcow_image} to expand last partition'.format(**self.settings)
+        rc=self._run_cmd('sudo qemu-nbd -c {nbdev} {qcow_image}'.format(**self.settings))
         if rc:
             print 'error connecting image rc={}'.format(rc)
+            self._release_nbdev()
             return False
 
-        def print_partition_info():
-            try:
-                # parse details reported by "parted"
-                info_partition=os.popen('sudo parted --script --machine {nbdev} print'.format(**self.settings)).readlines()
-                part_num, part_start, part_end, part_size, part_type, unknown1, unknown2=info_partition[len(info_partition)-1].strip().split(':')
-                print 'Partition number: {} start: {} end: {} size: {} type: {}'.format(part_num, part_start, part_end, part_size, part_type)
-                return part_num, part_start, part_end, part_size, part_type
-            except:
-                return None, None, None, None, None
-
-        # find last partition details and recreate it to fit image size extension
-        part_num, part_start, part_end, part_size, part_type=print_partition_info()
-        if not part_num:
-            print 'Could not find partition details, aborting'
+        rc=self._run_cmd('sudo parted --script {} rm {}'.format(disk_device, last['number']))
+        modified=True
+        if rc:
+            print 'Error removing partition number {}'.format(last['number'])
         else:
-            if part_type not in ('ext2', 'ext3', 'ext4'):
-                print 'Could not expand partition number {} of type {}'.format(part_num, part_type)
+            rc=self._run_cmd('sudo parted --script {} mkpart primary {} {}B 100%'.format(
+                    disk_device, last['fstype'], last['start']))
+            if rc:
+                print 'Error creating new partition at offset {}'.format(last['start'])
             else:
-                part_size = int(part_size[0:-1])
-                if abs(part_size - qcow_image) < 1:
-                    expanded = True
-                    print "OK, got here expanded."
-                    return expanded
-
-                rc=self._run_cmd('sudo parted --script {} rm {}'.format(disk_device, part_num))
-                modified=True
+                rc=self._run_cmd('sudo e2fsck -p -f {}; sudo resize2fs {}; sync'.format(part_device, part_device))
                 if rc:
-                    print 'Error removing partition number {}'.format(part_num)
+                    print 'Error checking and resizing new partition {}'.format(part_device)
                 else:
-                    rc=self._run_cmd('sudo parted --script {} mkpart primary {} {} 100%'.format(disk_device, part_type, part_start))
-                    if rc:
-                        print 'Error creating new partition at offset {}'.format(part_start)
-                    else:
-                        rc=self._run_cmd('sudo e2fsck -p -f {}; sudo resize2fs {}; sync'.format(part_device, part_device))
-                        if rc:
-                            print 'Error checking and resizing new partition {}'.format(part_device)
-                        else:
-                            print 'Image partition expanded successfully, new layout:'
-                            print_partition_info()
-                            expanded=True
-    
+                    expanded=True
+
         # report results and disconnect image from disk device
-        if not expanded:
+        rc=self._run_cmd('sudo qemu-nbd -d {nbdev}'.format(**self.settings))
+        self._release_nbdev()
+        if expanded:
+            print 'Image partition expanded successfully, new layout:'
+            image=DiskImage(self.settings['qcow_image'])
+            self._print_partitions(image.partitions())
+            image.close()
+        else:
             print 'Errors were found and the partition was not expanded'
             if modified:
                 print 'The image integrity might be compromised - you should run "renew"'
 
-        rc=self._run_cmd('sudo qemu-nbd -d {nbdev}; sync'.format(**self.settings))
         return expanded
 
     def zerofree(self, partition='all', verbose=True):
         '''
         Fills up a partition free space with zeroes. Increases final image compression ratio.
-        partition is the NBDEV device name, by default it will zero sysroot partition (nbdev_part variable).
+        partition is the NBDEV partition name (p1, p2, ..), by default all ext2/ext3/ext4 partitions
+        found in the image are zeroed, through one single nbd connection.
         The image needs to be unmounted for this function to work.
         '''
-        success=False
-
         if self.is_mounted():
             print 'sysroot is mounted - aborting'
-        elif partition=='all':
-            rc=self.zerofree(self.query('nbdev_part'))
-            success = (rc==0)
+            return False
+
+        if partition=='all':
+            try:
+                image=DiskImage(self.settings['qcow_image'])
+                partitions=[ 'p{}'.format(p['number']) for p in image.partitions()
+                             if p['fstype'] in ('ext2', 'ext3', 'ext4') ]
+                image.close()
+            except (IOError, ValueError, struct.error) as e:
+                print 'Could not inspect image {}: {}'.format(self.settings['qcow_image'], e)
+                return False
         elif not re.match('(p\d+)$', partition):
             print 'Partition name not recognized, must be p1, p2, .. {}'.format(partition)
+            return False
         else:
-            print 'connecting image {} to zerofree partition {}'.format(self.query('qcow_image'), partition)
-            rc_connect=self._run_cmd('sudo qemu-nbd -c {nbdev} {qcow_image}; sync'.format(**self.settings))
-            if rc_connect:
-                print 'error connecting image'
-            else:
-                zero_device='{}{}'.format(self.query('nbdev'), partition)
-                print 'zero free', zero_device
-                cmdline='sudo zerofree {}'.format(zero_device)
-                if verbose:
-                    cmdline += ' -v'
-                rc=self._run_cmd(cmdline)
+            partitions=[ partition ]
 
-            print 'disconnecting image'
-            rc_disconnect=self._run_cmd('sudo qemu-nbd -d {nbdev}; sync'.format(**self.settings))
-            success = (rc_connect==0)
+        if not self._acquire_nbdev():
+            return False
 
+        print 'connecting image {} to zerofree partitions {}'.format(self.query('qcow_image'), ' '.join(partitions))
+        nbdev=self.settings['nbdev']
+        steps=[ self._step('connect {}'.format(nbdev),
+                           ('argv', [ 'qemu-nbd', '-c', nbdev, self.settings['qcow_image'] ]),
+                           ('argv', [ 'qemu-nbd', '-d', nbdev ])) ]
+
+        for zero_partition in partitions:
+            zero_device='{}{}'.format(nbdev, zero_partition)
+            steps.append(self._step('wait {}'.format(zero_device), ('wait', zero_device, 10)))
+            steps.append(self._step('zerofree {}'.format(zero_device),
+                                    ('argv', [ 'zerofree', zero_device ] + ([ '-v' ] if verbose else []))))
+
+        steps.append(self._step('disconnect {}'.format(nbdev), ('argv', [ 'qemu-nbd', '-d', nbdev ])))
+        success=self._run_transaction(steps)
+        self._release_nbdev()
         return success
 
+    def export(self, filename, zerofree=True):
+        '''
+        Exports the qcow image as a flashable raw disk image, flattening its whole backing chain.
+        Depending on the filename extension (.gz, .xz, .zst) the image is compressed on the fly,
+        otherwise a sparse raw image is written. No intermediate full size file is created.
+        With zerofree, free space of ext partitions is zeroed first to improve compression.
+        The image needs to be unmounted for this function to work.
+        '''
+        if self.is_mounted():
+            print 'sysroot is mounted - aborting'
+            return False
+
+        if zerofree and not self.zerofree():
+            print 'Error zeroing free space, image not exported'
+            return False
+
+        print 'Exporting {} into {}'.format(self.settings['qcow_image'], filename)
+        return export_image(self.settings['qcow_image'], filename, verbose=self.verbose)
+
     def execute(self, command, verbose=True, pipes=False, as_user=None):
         '''
         Executes a command inside the sysroot.
@@ -668,15 +2252,212 @@ class XSysroot():
 
     def edfile(self, filename, literal, append=False, verbose=True):
         '''
-        Dumps a literal into a file, appending at the end if specified.
-        If you need to pass quotation marks, make sure to escape them.
+        Dumps a literal line into a file, appending at the end if specified.
+        The file is written from the host, the literal is not interpreted by a shell.
+        Returns 0 on success, as the errorlevel of a command would.
+        '''
+        if verbose:
+            print 'sysroot {} {}: {}'.format('appending to' if append else 'writing', filename, literal)
+
+        return 0 if self.edit_files([ ('append' if append else 'write', filename, literal + '\n') ]) else 1
+
+    def sysroot_path(self, path, follow=True):
+        '''
+        Returns the host pathname of a path inside the sysroot, resolving symlinks
+        relative to the sysroot, see resolve_in_root.
+        '''
+        return resolve_in_root(self.settings['sysroot'], path, follow)
+
+    def edit_files(self, operations):
+        '''
+        Edits files inside the mounted sysroot from the host, without emulation.
+        All operations run in order through one privileged helper, stopping at the first failure.
+        Pathnames are relative to the sysroot root, operations are tuples in the form:
+
+          ('write', path, content)       replace a file contents
+          ('append', path, content)      append to a file
+          ('symlink', target, path)      create or replace a symlink, target is kept as given
+          ('copy', source, path)         copy a file within the sysroot
+          ('copy_host', source, path)    copy a file from the host into the sysroot
+          ('relink', directory)          make absolute .so symlinks under a directory sysroot-relative
+
+        Returns True if all operations succeeded.
+        '''
+        if not self.is_mounted():
+            print 'sysroot not mounted - aborting'
+            return False
+
+        root=os.path.realpath(self.settings['sysroot'])
+        steps=[]
+        for operation in operations:
+            kind=operation[0]
+            if kind in ('write', 'append'):
+                action=('write', self.sysroot_path(operation[1]), operation[2], kind == 'append')
+            elif kind == 'symlink':
+                action=('symlink', operation[1], self.sysroot_path(operation[2], follow=False))
+            elif kind == 'copy':
+                action=('copy', self.sysroot_path(operation[1]), self.sysroot_path(operation[2], follow=False))
+            elif kind == 'copy_host':
+                action=('copy', operation[1], self.sysroot_path(operation[2], follow=False))
+            elif kind == 'relink':
+                action=('relink', root, [ self.sysroot_path(operation[1]) ])
+            else:
+                raise ValueError('unknown file operation: {}'.format(kind))
+
+            target=operation[2] if kind in ('symlink', 'copy', 'copy_host') else operation[1]
+            steps.append(self._step('{} {}'.format(kind, target), action))
+
+        return self._run_transaction(steps, rollback=False)
+
+    def write_file(self, path, content):
+        return self.edit_files([ ('write', path, content) ])
+
+    def append_file(self, path, content):
+        return self.edit_files([ ('append', path, content) ])
+
+    def symlink(self, target, path):
+        return self.edit_files([ ('symlink', target, path) ])
+
+    def copy_file(self, source, path, from_host=False):
+        return self.edit_files([ ('copy_host' if from_host else 'copy', source, path) ])
+
+    def relink_libraries(self, directories=('/usr/lib',)):
+        '''
+        Converts the absolute .so symlinks under the sysroot directories into relative ones,
+        so they resolve the same from the host when cross compiling against the sysroot.
+        '''
+        return self.edit_files([ ('relink', directory) for directory in directories ])
+
+    def _offload_binds(self, record='binds.json'):
+        '''
+        Returns the host directories bound into the sysroot by offload_compilers,
+        or with record "created.json", the directories it created in the image for them
+        '''
+        try:
+            with open(os.path.join(self.settings['tmp'], self.offload_dir, record), 'r') as f:
+                return json.loads(f.read())
+        except (IOError, ValueError):
+            return []
+
+    def offload_compilers(self, prefix):
+        '''
+        Forwards compiler and binutils invocations inside the sysroot to a host cross toolchain,
+        so native builds keep running make, perl and configure tests emulated but compile at host speed.
+        prefix is the host cross toolchain, i.e. "/opt/rpi-tools/.../bin/arm-linux-gnueabihf-".
+
+        The toolchain and the host x86-64 libraries are bound at the same paths in the sysroot, where
+        the toolchain runs natively, until the sysroot is unmounted, which also removes the directories
+        created in the image to bind them. Wrappers named after each tool are
+        written to /tmp/xsysroot-offload/bin in the sysroot. Compilers get --sysroot=/ so they use the
+        sysroot headers and libraries, as seen from the chroot. Use that directory as CROSS_COMPILE.
+        Returns the wrappers directory inside the sysroot, or None on failure.
+        '''
+        if not self.is_mounted():
+            print 'sysroot not mounted - aborting'
+            return None
+
+        prefix=os.path.abspath(prefix)
+        if not os.path.isfile(prefix + 'gcc'):
+            print 'cross toolchain not found: {}gcc'.format(prefix)
+            return None
+
+        # the toolchain finds its programs and libraries relative to its bin directory
+        toolchain=os.path.dirname(os.path.dirname(prefix))
+        sysroot=self.settings['sysroot']
+        index=MountIndex()
+        binds=[]
+        created=[]
+        steps=[]
+        for source in [ toolchain ] + [ d for d in self.offload_libraries if os.path.isdir(d) ]:
+            target=os.path.join(sysroot, source.lstrip('/'))
+            binds.append(source)
+            if index.is_mounted(target):
+                continue
+            elif os.path.isdir(target) and os.listdir(target):
+                print 'cannot bind {} into the sysroot, it would hide its contents'.format(source)
+                return None
+
+            # the mount points are removed on umount, they would stay in the image otherwise
+            directory=source
+            while directory != '/' and not os.path.isdir(os.path.join(sysroot, directory.lstrip('/'))):
+                created.append(directory)
+                directory=os.path.dirname(directory)
+
+            steps.append(self._step('mkdir {}'.format(target), ('argv', [ 'mkdir', '-p', target ])))
+            steps.append(self._step('bind {}'.format(target),
+                                    ('argv', [ 'mount', '--bind', source, target ]),
+                                    ('argv', [ 'umount', target ])))
+
+        # wrappers live in the tmp directory, so nothing is written to the image
+        wrappers=os.path.join(self.settings['tmp'], self.offload_dir, 'bin')
+        if not os.path.isdir(wrappers):
+            os.makedirs(wrappers)
+
+        with open(os.path.join(self.settings['tmp'], self.offload_dir, 'binds.json'), 'w') as f:
+            f.write(json.dumps(sorted(set(binds + self._offload_binds()))))
+        with open(os.path.join(self.settings['tmp'], self.offload_dir, 'created.json'), 'w') as f:
+            f.write(json.dumps(sorted(set(created + self._offload_binds('created.json')))))
+
+        if steps and not self._run_transaction(steps):
+            print 'Error binding the host toolchain into the sysroot'
+            return None
+
+        compilers={ 'gcc': 'gcc', 'cc': 'gcc', 'g++': 'g++', 'c++': 'g++', 'cpp': 'cpp' }
+        for tool, program in compilers.items():
+            wrapper=os.path.join(wrappers, tool)
+            with open(wrapper, 'w') as f:
+                f.write('#!/bin/sh\nexec {}{} --sysroot=/ "$@"\n'.format(prefix, program))
+            os.chmod(wrapper, 0755)
+
+        for tool in ('ar', 'as', 'ld', 'nm', 'objcopy', 'objdump', 'ranlib', 'readelf', 'strip'):
+            wrapper=os.path.join(wrappers, tool)
+            if os.path.lexists(wrapper):
+                os.unlink(wrapper)
+            os.symlink(prefix + tool, wrapper)
+
+        print 'compilers in the sysroot forwarded to {}'.format(prefix)
+        return '/tmp/{}/bin'.format(self.offload_dir)
+
+    def _sysroot_which(self, program, paths=('/usr/local/sbin', '/usr/local/bin', '/usr/sbin', '/usr/bin', '/sbin', '/bin')):
+        '''
+        Returns the pathname of a program inside the sysroot, as "which" would find it there, or None
+        '''
+        for path in paths:
+            candidate=os.path.join(path, program)
+            if os.path.lexists(self.sysroot_path(candidate, follow=False)):
+                return candidate
+
+        return None
+
+    def session(self, verbose=True):
+        '''
+        Returns a persistent shell session inside the sysroot, see SysrootSession.
+        Returns None if the sysroot is not mounted.
+        '''
+        if not self.is_mounted():
+            print 'sysroot not mounted - aborting'
+            return None
+
+        return SysrootSession(self, verbose=verbose)
+
+    def execute_batch(self, commands, verbose=True, stop_on_error=False):
         '''
-        redirection = '>'
-        if append:
-            redirection += '>'
+        Executes a list of commands inside the sysroot through one single shell session.
+        Returns a list of dictionaries with keys command, rc, output and elapsed,
+        or None if the sysroot is not mounted.
+        '''
+        session=self.session(verbose=verbose)
+        if not session:
+            return None
+
+        with session:
+            results=session.batch(commands, stop_on_error=stop_on_error)
+
+        if verbose:
+            for result in results:
+                print ' {:>8.3f}s rc={} {}'.format(result['elapsed'], result['rc'], result['command'])
 
-        return self.execute('/bin/bash -c "echo \'{}\' {} {}"'.format(
-                literal, redirection, filename), verbose)
+        return results
 
     def screenshot(self, filename='screenshot.png'):
         '''
@@ -700,6 +2481,101 @@ class XSysroot():
 
         return success
 
+    def _framebuffer_file(self):
+        '''
+        Returns the path where Xvfb exposes the virtual display framebuffer as a XWD file
+        '''
+        return os.path.join(self.settings['tmp'], 'Xvfb_screen0')
+
+    def _grab_frame(self, display):
+        '''
+        Returns the contents of the virtual display as a XWD dump.
+        The framebuffer file mapped by Xvfb is read directly, xwd is used for displays started without it.
+        '''
+        framebuffer=self._framebuffer_file()
+        if os.path.isfile(framebuffer):
+            with open(framebuffer, 'rb') as f:
+                return f.read()
+
+        return subprocess.check_output([ 'xwd', '-root', '-silent', '-display', ':{}'.format(display) ])
+
+    def capture(self, duration=5.0, interval=0.0, json_output=False):
+        '''
+        Records frames from the virtual display for a number of seconds, and reports
+        how many were captured, the timing between them and how many changed.
+        The time between changed frames is how often the application really updates the screen.
+        A zero interval captures as fast as the display can be read.
+        '''
+        if not self.is_mounted():
+            print 'sysroot not mounted - aborting'
+            return False
+
+        display, _, _=self._get_virtual_display()
+        if not display:
+            print 'This sysroot does not have a virtual display'
+            return False
+
+        try:
+            frames=[]
+            header=None
+            last_checksum=None
+            started=time.time()
+            while True:
+                now=time.time()
+                if now - started >= duration:
+                    break
+
+                data=self._grab_frame(display)
+                header=read_xwd_header(data)
+                if not header:
+                    print 'Error reading a frame from display {}'.format(display)
+                    return False
+
+                # only the pixels are compared, Xvfb keeps the header and colormap unchanged
+                pixels=buffer(data, header['pixels_offset'], header['pixels_size'])
+                checksum=zlib.crc32(pixels)
+                frames.append({ 'time': now - started, 'changed': checksum != last_checksum })
+                last_checksum=checksum
+
+                if interval:
+                    time.sleep(max(0, interval - (time.time() - now)))
+        except (OSError, subprocess.CalledProcessError) as e:
+            print 'Error capturing display {}: {}'.format(display, e)
+            return False
+
+        # the first frame is the reference, it is not counted as a change
+        changes=[ frame['time'] for frame in frames[1:] if frame['changed'] ]
+        frame_times=[ b['time'] - a['time'] for a, b in zip(frames, frames[1:]) ]
+        update_times=[ b - a for a, b in zip(changes, changes[1:]) ]
+
+        if not frames:
+            print 'No frames captured from display {}'.format(display)
+            return False
+
+        report={ 'display': display,
+                 'resolution': '{}x{}x{}'.format(header['pixmap_width'], header['pixmap_height'], header['pixmap_depth']),
+                 'duration': frames[-1]['time'],
+                 'frames': len(frames),
+                 'changed_frames': len(changes),
+                 'frame_interval': percentiles(frame_times),
+                 'update_interval': percentiles(update_times) }
+
+        if json_output:
+            print json.dumps(report, indent=2, sort_keys=True)
+            return True
+
+        def describe(timings):
+            if not timings:
+                return 'n/a'
+            return ', '.join('{} {:.1f}ms'.format(k, timings[k] * 1000) for k in ('min', 'p50', 'p90', 'p99', 'max'))
+
+        print 'Display :{} {} captured for {:.2f} seconds'.format(report['display'], report['resolution'], report['duration'])
+        print '          frames: {}'.format(report['frames'])
+        print '  changed frames: {}'.format(report['changed_frames'])
+        print '  frame interval: {}'.format(describe(report['frame_interval']))
+        print ' update interval: {}'.format(describe(report['update_interval']))
+        return True
+
     def jail(self):
         '''
         Protects harmful commands in the sysroot (reboot, shutdown)
@@ -710,21 +2586,23 @@ class XSysroot():
             print 'sysroot not mounted - please mount first with -m'
             return False
 
+        host_hostname=socket.gethostname()
+        true_program=self._sysroot_which('true')
+        operations=[]
+
         # disable reboot tools
-        self.execute('ln -sfv $(which true) $(which reboot)', pipes=True, verbose=False)
-        self.execute('ln -sfv $(which true) $(which poweroff)', pipes=True, verbose=False)
-        self.execute('ln -sfv $(which true) $(which shutdown)', pipes=True, verbose=False)
-        self.execute('ln -sfv $(which true) $(which halt)', pipes=True, verbose=False)
- 
+        for program in ('reboot', 'poweroff', 'shutdown', 'halt'):
+            pathname=self._sysroot_which(program)
+            if pathname and true_program:
+                operations.append(('symlink', true_program, pathname))
+
         # blind sudo - make sure your user belongs to "sudo" group
-        self.edfile('/etc/sudoers', '%sudo   ALL=NOPASSWD: ALL', append=True)
+        operations.append(('append', '/etc/sudoers', '%sudo   ALL=NOPASSWD: ALL\n'))
 
         # fake hostname to match the host system
-        import socket
-        host_hostname=socket.gethostname()
-        self.edfile('/etc/hosts', '127.0.0.1   {}'.format(host_hostname), append=True)
+        operations.append(('append', '/etc/hosts', '127.0.0.1   {}\n'.format(host_hostname)))
 
-        return True
+        return self.edit_files(operations)
 
     def chroot(self, username=None):
         '''
@@ -743,6 +2621,79 @@ class XSysroot():
 
             return self._xrun_cmd(as_user=username)
 
+    def missing_packages(self, dependencies):
+        '''
+        Returns the packages from a dependency list which are not installed in the sysroot,
+        i.e. "libfoo-dev (>= 1.2), libbar-dev | libbaz-dev" or a plain list of names.
+        The sysroot dpkg database is read directly, no emulation is involved.
+        Returns None if the sysroot is not mounted.
+        '''
+        if not self.is_mounted():
+            print 'sysroot not mounted - aborting'
+            return None
+
+        return DpkgStatus(self.settings['sysroot']).missing(dependencies)
+
+    def _archived_packages(self, archives):
+        '''
+        Returns the package files in an apt archives directory, keyed on (name, version)
+        '''
+        packages={}
+        if os.path.isdir(archives):
+            for filename in os.listdir(archives):
+                fields=filename.split('_')
+                if filename.endswith('.deb') and len(fields) == 3:
+                    packages[(fields[0], urllib.unquote(fields[1]))]=filename
+
+        return packages
+
+    def apt_install(self, packages, update=True):
+        '''
+        Installs packages in the sysroot with apt-get, optionally updating the package lists first.
+        Reports how many of the packages installed came from the apt archive cache (hits)
+        and how many had to be downloaded (misses), comparing the sysroot dpkg database and the
+        archive files before and after. Returns the apt-get return code, the statistics are
+        kept in self.last_apt_stats.
+        '''
+        if not self.is_mounted():
+            print 'sysroot not mounted - aborting'
+            return -1
+
+        root=self.settings['sysroot']
+        archives=self._apt_cache_dir() or os.path.join(root, self.apt_archives)
+        installed_before=DpkgStatus(root).installed
+        archived_before=self._archived_packages(archives)
+        started=time.time()
+
+        if update:
+            rc=self.execute('apt-get update')
+            if rc:
+                print 'apt-get update failed rc={}'.format(rc)
+                return rc
+
+        rc=self.execute('apt-get install -y --no-install-recommends {}'.format(' '.join(packages)))
+
+        # packages installed or upgraded by this run, versus the archive files available before it
+        installed=DpkgStatus(root).installed
+        archived=self._archived_packages(archives)
+        stats={ 'packages': 0, 'hits': 0, 'misses': 0, 'downloaded': 0, 'elapsed': time.time() - started }
+        for name, versions in installed.items():
+            for version in versions:
+                if version in installed_before.get(name, []):
+                    continue
+
+                stats['packages'] += 1
+                if archived_before.has_key((name, version)):
+                    stats['hits'] += 1
+                elif archived.has_key((name, version)):
+                    stats['misses'] += 1
+                    stats['downloaded'] += os.path.getsize(os.path.join(archives, archived[(name, version)]))
+
+        self.last_apt_stats=stats
+        print 'apt cache: {packages} packages installed, {hits} hits, {misses} misses, ' \
+            '{0:.1f} MiB downloaded in {elapsed:.1f} seconds'.format(stats['downloaded'] / (1024.0 * 1024), **stats)
+        return rc
+
     def depends(self, repo_dir='.'):
         '''
         Parses a Debian package control file, and install build-depends in the sysroot
@@ -751,31 +2702,33 @@ class XSysroot():
         control_file=os.path.join(repo_dir, 'debian/control')
         if not self.is_mounted():
             print 'sysroot not mounted - aborting'
+        elif not os.path.isfile(control_file):
+            print 'no debian control file found at {}'.format(control_file)
         else:
-            pkgs_install=''
             print 'Checking Build-Dependencies at {}'.format(control_file)
-            output = subprocess.Popen(['dpkg-checkbuilddeps', control_file], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            rc=output.wait()
-            if rc == 1:
-                # Dependencies need to be installed:
-                # Parsing the output of dpkg-checkbuilddeps
-                for item in output.stderr.read().split()[4:]:
-                    if item.find('(') == -1 and item.find(')') == -1:
-                        pkgs_install += '{} '.format(item)
-                        
-                print 'Installing packages in the sysroot:', pkgs_install
-                rc=self._xrun_cmd(command='apt-get --no-install-recommends -y install {}'.format(pkgs_install))
-
-                print 'apt-get completed with rc={}'.format(rc)
-                success=(rc==0)
-            elif rc == 2:
-                print 'dpkg-checkbuilddeps returned with rc={} - no debian control file found'.format(rc)
-            else:
-                print 'dpkg-checkbuilddeps failed with unknown rc={}'.format(rc)
-                
+            source=read_control_fields(control_file)[0]
+            build_depends=', '.join(source[field] for field in ('Build-Depends', 'Build-Depends-Arch', 'Build-Depends-Indep')
+                                    if source.get(field))
+
+            try:
+                pkgs_install=self.missing_packages(build_depends)
+            except ValueError as e:
+                print 'ERROR - {}: {}'.format(control_file, e)
+                return False
+
+            if not pkgs_install:
+                print 'All Build-Dependencies are installed in the sysroot'
+                return True
+
+            print 'Installing packages in the sysroot:', ' '.join(pkgs_install)
+            rc=self.apt_install(pkgs_install, update=False)
+
+            print 'apt-get completed with rc={}'.format(rc)
+            success=(rc==0)
+
         return success
 
-    def build(self, repo_dir='.', debuild_cmd='echo "y" | debuild --preserve-envvar PATH -us -uc -d -aarmhf'):
+    def build(self, repo_dir='.', debuild_cmd='echo "y" | debuild --preserve-envvar PATH -us -uc -d -aarmhf', jobs=None):
         debian_dir=os.path.abspath(os.path.join(repo_dir, 'debian'))
         pkg_dir=os.path.abspath(repo_dir + '/../')
         if not os.path.exists(debian_dir):
@@ -786,6 +2739,9 @@ class XSysroot():
         self.depends(repo_dir=repo_dir)
 
         print 'building package for repo', repo_dir
+        if jobs:
+            debuild_cmd='{} -j{}'.format(debuild_cmd, jobs)
+
         rc=os.system('cd {} && {}'.format(repo_dir, debuild_cmd))
         if rc:
             print 'ERROR - failure building package for repo {}'.format(repo_dir)
@@ -794,6 +2750,263 @@ class XSysroot():
             print 'OK - Debian package built successfuly'
             return True
 
+    def _read_source_package(self, repo_dir):
+        '''
+        Returns the source name, binary package names and Build-Depends relations of a repo debian/control
+        '''
+        stanzas=read_control_fields(os.path.join(repo_dir, 'debian/control'))
+        source=stanzas[0]
+        build_depends=', '.join(source[field] for field in ('Build-Depends', 'Build-Depends-Arch', 'Build-Depends-Indep')
+                                if source.get(field))
+
+        return { 'repo': os.path.abspath(repo_dir),
+                 'source': source.get('Source', os.path.basename(os.path.abspath(repo_dir))),
+                 'binaries': [ stanza['Package'] for stanza in stanzas[1:] if stanza.has_key('Package') ],
+                 'build_depends': parse_relations(build_depends) }
+
+    def _install_built_packages(self, package, started):
+        '''
+        Installs in the sysroot the binary packages just built from a repo,
+        so repos which Build-Depend on them can be built next.
+        '''
+        pkg_dir=os.path.dirname(package['repo'])
+        debs=[ f for f in os.listdir(pkg_dir) if f.endswith('.deb') and f.split('_')[0] in package['binaries']
+               and os.path.getmtime(os.path.join(pkg_dir, f)) >= started ]
+        if not debs:
+            return 0
+
+        staging=os.path.join(self.settings['tmp'], 'xsysroot-build', package['source'])
+        if not os.path.isdir(staging):
+            os.makedirs(staging)
+        for deb in debs:
+            shutil.copy(os.path.join(pkg_dir, deb), staging)
+
+        return self.execute('dpkg -i {}'.format(' '.join(os.path.join('/tmp/xsysroot-build', package['source'], deb)
+                                                         for deb in debs)), verbose=False)
+
+    def build_many(self, repo_dirs, jobs=None, parallel=None,
+                   debuild_cmd='echo "y" | debuild --preserve-envvar PATH -us -uc -d -aarmhf'):
+        '''
+        Cross builds the Debian packages of several repos, in the order given by their Build-Depends.
+        Build-Depends from outside the batch are installed in the sysroot once, upfront.
+        Packages built in the batch are installed in the sysroot before the repos which need them.
+
+        Up to "parallel" independent repos are built at the same time, sharing a budget of "jobs"
+        make jobs passed to debuild (-jN), by default the number of CPUs. Each build is logged to
+        <source>.xsysroot-build.log next to the repo. Returns True if all packages were built.
+        '''
+        if not self.is_mounted():
+            print 'sysroot not mounted - aborting'
+            return False
+
+        jobs=jobs or multiprocessing.cpu_count()
+        parallel=max(1, min(parallel or max(1, jobs / 4), len(repo_dirs)))
+        jobs_each=max(1, jobs / parallel)
+
+        try:
+            packages=[ self._read_source_package(repo_dir) for repo_dir in repo_dirs ]
+        except (IOError, ValueError, IndexError) as e:
+            print 'error reading debian control files: {}'.format(e)
+            return False
+
+        # a repo waits for the repos producing any of its build dependencies, alternatives included
+        producers=dict((binary, package['source']) for package in packages for binary in package['binaries'])
+        external=[]
+        for package in packages:
+            package['waits']=set()
+            for alternatives in package['build_depends']:
+                inside=[ producers[name] for name, _, _ in alternatives if producers.has_key(name) ]
+                if inside:
+                    package['waits'].update(source for source in inside if source != package['source'])
+                elif alternatives not in external:
+                    external.append(alternatives)
+
+        # install what the batch does not build in one apt run
+        relation=lambda name, operator, version: '{} ({} {})'.format(name, operator, version) if operator else name
+        missing=DpkgStatus(self.settings['sysroot']).missing(
+            ', '.join(' | '.join(relation(*alternative) for alternative in alternatives) for alternatives in external))
+        missing=[ name for i, name in enumerate(missing) if name not in missing[:i] ]
+        if missing:
+            print 'Installing Build-Dependencies in the sysroot:', ' '.join(missing)
+            if self.apt_install(missing, update=False):
+                print 'ERROR - could not install Build-Dependencies'
+                return False
+
+        print 'building {} packages, {} at a time with {} jobs each'.format(len(packages), parallel, jobs_each)
+        if jobs_each > 1:
+            debuild_cmd='{} -j{}'.format(debuild_cmd, jobs_each)
+
+        results={}
+        finished=Queue.Queue()
+        install_lock=threading.Lock()
+        pending=list(packages)
+        running=0
+
+        def run(package):
+            log=os.path.join(os.path.dirname(package['repo']), '{}.xsysroot-build.log'.format(package['source']))
+            started=time.time()
+            rc=-1
+            try:
+                with open(log, 'w') as f:
+                    rc=subprocess.call('cd {} && {}'.format(package['repo'], debuild_cmd), shell=True,
+                                       stdout=f, stderr=subprocess.STDOUT)
+
+                # dependent repos build against the installed packages, dpkg runs one at a time
+                if rc == 0 and any(package['source'] in other['waits'] for other in packages):
+                    with install_lock:
+                        if self._install_built_packages(package, started):
+                            print 'ERROR - could not install packages built from {}'.format(package['source'])
+                            rc=-1
+            except Exception as e:
+                # the scheduler waits for a result from every build
+                print 'ERROR - building {}: {}'.format(package['source'], e)
+                rc=-1
+            finally:
+                finished.put((package, rc, time.time() - started, log))
+
+        while pending or running:
+            # skipping a repo can unblock the decision on others, so scan until nothing changes
+            changed=True
+            while changed:
+                changed=False
+                for package in list(pending):
+                    failed=[ source for source in package['waits']
+                             if results.has_key(source) and results[source]['rc'] != 0 ]
+                    if failed:
+                        pending.remove(package)
+                        changed=True
+                        results[package['source']]={ 'rc': None, 'elapsed': 0.0, 'log': None,
+                                                     'status': 'skipped, {} failed'.format(', '.join(sorted(failed))) }
+                    elif running < parallel and all(results.has_key(source) for source in package['waits']):
+                        pending.remove(package)
+                        running += 1
+                        print 'building {} from {}'.format(package['source'], package['repo'])
+                        thread=threading.Thread(target=run, args=(package,))
+                        thread.daemon=True
+                        thread.start()
+
+            if not running:
+                # nothing can start, what is left waits on itself
+                for package in pending:
+                    results[package['source']]={ 'rc': None, 'elapsed': 0.0, 'log': None, 'status': 'dependency cycle' }
+                break
+
+            package, rc, elapsed, log=finished.get()
+            running -= 1
+            results[package['source']]={ 'rc': rc, 'elapsed': elapsed, 'log': log, 'status': 'ok' if rc == 0 else 'FAILED' }
+            print '{} {} in {:.1f} seconds'.format(package['source'], results[package['source']]['status'], elapsed)
+
+        print 'Build report:'
+        for package in packages:
+            result=results[package['source']]
+            print ' {:<30} {:>9.1f}s {}{}'.format(package['source'], result['elapsed'], result['status'],
+                                                  ' => {}'.format(result['log']) if result['log'] else '')
+
+        return all(result['rc'] == 0 for result in results.values())
+
+
+class SysrootSession():
+    '''
+    A persistent shell running inside the sysroot, so a sequence of commands
+    pays for sudo, chroot and the emulated bash startup only once.
+
+    Commands run in the same shell one after another, so working directory and
+    exported variables carry over as in a script. Use it as a context manager:
+
+      with xsys.session() as shell:
+          rc, output, elapsed=shell.run('apt-get update')
+    '''
+    def __init__(self, sysroot, environment='LC_ALL=C', verbose=True):
+        self.verbose=verbose
+        self.marker='__xsysroot_{}__'.format(binascii.hexlify(os.urandom(8)))
+
+        command=[ 'sudo', environment ]
+        display, _, _=sysroot._get_virtual_display()
+        if display:
+            command.append('DISPLAY=:{}'.format(display))
+
+        apt_config=sysroot._apt_environment()
+        if apt_config:
+            command.append(apt_config)
+
+        command += [ 'chroot', sysroot.query('sysroot'), '/bin/bash', '--noprofile', '--norc' ]
+        self.shell=subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def is_alive(self):
+        return self.shell.poll() is None
+
+    def run(self, command, as_user=None):
+        '''
+        Runs a command in the session shell, stderr is merged into the output.
+        Returns a tuple with the exit code, output and elapsed seconds.
+        The exit code is -1 if the session shell is gone.
+        '''
+        if as_user:
+            command='su -l {} -c "{}"'.format(as_user, command)
+
+        if self.verbose:
+            print 'sysroot executing: {}'.format(command)
+
+        if not self.is_alive():
+            return -1, '', 0.0
+
+        start=time.time()
+        self.shell.stdin.write('{{ {}\n}} < /dev/null 2>&1\nprintf "\\n{} %d\\n" $?\n'.format(command, self.marker))
+        self.shell.stdin.flush()
+
+        rc=-1
+        output=[]
+        for line in iter(self.shell.stdout.readline, ''):
+            if line.startswith(self.marker):
+                rc=int(line.split()[1])
+                break
+            output.append(line)
+
+        # the marker is always preceded by a newline, which is not part of the output
+        output=''.join(output)
+        if output.endswith('\n'):
+            output=output[:-1]
+
+        if self.verbose and output:
+            print output.rstrip('\n')
+
+        return rc, output, time.time() - start
+
+    def batch(self, commands, stop_on_error=False):
+        '''
+        Runs a list of commands in the session shell.
+        Returns a list of dictionaries with keys command, rc, output and elapsed.
+        If stop_on_error is True, commands after the first failure are not run.
+        '''
+        results=[]
+        for command in commands:
+            rc, output, elapsed=self.run(command)
+            results.append({ 'command': command, 'rc': rc, 'output': output, 'elapsed': elapsed })
+            if rc and stop_on_error:
+                break
+
+        return results
+
+    def close(self):
+        '''
+        Terminates the session shell, returns its exit code
+        '''
+        if self.is_alive():
+            try:
+                self.shell.stdin.write('exit\n')
+                self.shell.stdin.close()
+            except IOError:
+                pass
+
+        return self.shell.wait()
+
 
 def is_os_platform_supported():
     '''
@@ -851,13 +3064,8 @@ def check_system_tools():
     if rc:
         print 'Error: please install binfmt-support package'
 
-    # The debian packge build-depends tool
-    rc = os.system('which dpkg-checkbuilddeps > /dev/null 2>&1')
-    if rc:
-        print 'Warning: dpkg-checkbuilddeps cannot be found, --depends will not work'
-
-    # The debian packge build-depends tool
-    rc = os.system('which dpkg-checkbuilddeps > /dev/null 2>&1')
+    # The debian package build tool
+    rc = os.system('which debuild > /dev/null 2>&1')
     if rc:
         print 'Warning: debuild not found, please install devscripts package if you want to --build'
 
@@ -871,17 +3079,33 @@ def check_system_tools():
     if rc:
         print 'Warning: X11VNC is not available, install it to connect remotely to virtual displays'
 
+    # xwd captures frames from virtual displays without a framebuffer file
+    rc = os.system('which xwd > /dev/null 2>&1')
+    if rc:
+        print 'Warning: tool "xwd" not found, --frames needs it on displays not started by xsysroot (x11-apps)'
+
     # Imagemagick import for taking screenshots
     rc = os.system('which import > /dev/null 2>&1')
     if rc:
         print 'Warning: tool "import" not found, screenshots will not be available (you need ImageMagick)'
 
-    # Parted tool to generate raw images
+    # Multi-threaded gzip to uncompress backing images
+    rc = os.system('which pigz > /dev/null 2>&1')
+    if rc:
+        print 'Warning: pigz not found, gzip backing images will be uncompressed with a single thread'
+
+    # Parted tool to expand images
     rc1 = os.system('sudo -n -k which parted > /dev/null 2>&1')
     rc2 = os.system('sudo -n -k which resize2fs > /dev/null 2>&1')
     rc3 = os.system('sudo -n -k which e2fsck > /dev/null 2>&1')
     if rc1 or rc2 or rc3:
-        print 'Warning: tools "parted", "resize2fs" or "e2fsck" not found, --geometry option will not be available'
+        print 'Warning: tools "parted", "resize2fs" or "e2fsck" not found, --expand option will not be available'
+
+    # File system tools to generate raw images
+    rc1 = os.system('which mke2fs > /dev/null 2>&1')
+    rc2 = os.system('which mkfs.vfat > /dev/null 2>&1')
+    if rc1 or rc2:
+        print 'Warning: tools "mke2fs" or "mkfs.vfat" not found, --geometry option will not be available'
 
     # If minimal core tools are available, xsysroot is ready to work
     if core_tools_ready >= min_core_tools:
@@ -951,15 +3175,21 @@ Description: A small tool that gives sysroot access to multiple ARM Linux images
     print 'Debian skeleton package created at: {}'.format(debian_directory)
     return True
     
-def create_image(geometry, nbdev='/dev/nbd0'):
+def create_image(geometry, nbdev=None):
     '''
     Builds an empty image file with partitions of given size and file system types
     Geometry specifies the image layout in the form "imagefile.img fstype1:size_mb fstype2:size_mb"
     Currently supported file system types are "fat" and "ext2" to "ext4".
-    '''
 
-    image_size=0
-    part_offset=0
+    The image is allocated sparse, the MBR is written in-process and each partition is formatted
+    directly at its offset in the file, so neither root nor the nbd kernel module are needed.
+    Sizes are in MiB, partitions are aligned to 1MiB. An ext partition can be populated
+    from a host directory with "ext4:200:/path/to/rootfs" (needs mke2fs -d support).
+    The nbdev argument is not used anymore, it is kept for compatibility.
+    '''
+    mib=1024 * 1024
+    sector_size=512
+    part_offset=mib
     partitions=[]
 
     def safe_exec(cmdline, silent=True):
@@ -982,94 +3212,179 @@ def create_image(geometry, nbdev='/dev/nbd0'):
         print 'image file already exists: {}'.format(filename)
         return False
 
+    if not 0 < len(details[1:]) <= 4:
+        print 'geometry needs between 1 and 4 partitions: {}'.format(geometry)
+        return False
+
     for partnum, partition in enumerate(details[1:]):
-        partype, partsize=partition.split(':')
-        partitions.append({ 'partnum' : partnum, 'partype' : partype, 'partsize': partsize })
-        image_size += int(partsize)
+        fields=partition.split(':', 2)
+        partype, partsize=fields[0], int(fields[1])
+        partitions.append({ 'partnum' : partnum, 'partype' : partype, 'partsize': partsize,
+                            'offset': part_offset, 'directory': fields[2] if len(fields) > 2 else None })
+        part_offset += partsize * mib
+
+    image_size=part_offset
+    print 'creating {}MiB image file {}...'.format(image_size / mib, filename)
+    with open(filename, 'wb') as f:
+        f.truncate(image_size)
+
+    # Write the MBR with a random disk signature and one primary partition per geometry entry
+    mbr=bytearray(512)
+    mbr[440:444]=os.urandom(4)
+    for part in partitions:
+        if part['partype'] == 'fat32':
+            type_id=0x0c
+        elif part['partype'].startswith('fat'):
+            type_id=0x0e
+        else:
+            type_id=0x83
 
-    print 'creating {}MB image file {}...'.format(image_size, filename)
-    rc=safe_exec('dd if=/dev/zero of={} bs=1MB count={}'.format(filename, image_size))
-    rc=safe_exec('sudo parted --script {} mklabel msdos'.format(filename))
+        entry=struct.pack('<B3sB3sII', 0, '\xfe\xff\xff', type_id, '\xfe\xff\xff',
+                          part['offset'] / sector_size, part['partsize'] * mib / sector_size)
+        mbr[446 + part['partnum'] * 16:462 + part['partnum'] * 16]=entry
 
-    for part in partitions:
-        print ' partition {} type {} size {}MB'.format(part['partnum'], part['partype'], part['partsize'])
-        if part['partnum'] == 0:
-            # this is the first partition
-            rc=safe_exec('sudo parted --script {} mkpart primary {} -- 1 {}MB'.format(filename, part['partype'], part['partsize']))
-        elif part['partnum'] < len(partitions) -1:
-            # intermediate partition
-            disk_offset=part_offset + int(part['partsize'])
-            rc=safe_exec('sudo parted --script {} mkpart primary {} {}MB {}MB'.format(filename, part['partype'], part_offset, disk_offset))
-        elif part['partnum'] == len(partitions) -1:
-            # this is the last partition
-            rc=safe_exec('sudo parted --script {} mkpart primary {} {}MB 100%'.format(filename, part['partype'], part_offset))
-
-        # keep track of the current partition offset in MB
-        part_offset += int(part['partsize']) + 1
-
-    # Map the image through a disk device so we can format partitions
+    mbr[510:512]='\x55\xaa'
+    with open(filename, 'r+b') as f:
+        f.write(mbr)
+
+    # Format the partitions directly at their offset within the image file
     print 'formatting partitions...',
     sys.stdout.flush()
-    rc=safe_exec('sudo /usr/bin/qemu-nbd -d {}'.format(nbdev))
-    rc=safe_exec('sudo /usr/bin/qemu-nbd -f raw -c {} {}'.format(nbdev, filename))
     for part in partitions:
+        print ' partition {} type {} size {}MiB'.format(part['partnum'], part['partype'], part['partsize'])
         if part['partype'].startswith('fat'):
-            rc=safe_exec('sudo mkfs.vfat -n "xsysroot" -v -F 16 {}p{}'.format(nbdev, part['partnum'] + 1))
+            rc=safe_exec('mkfs.vfat -n "xsysroot" -F {} --offset {} {} {}'.format(
+                    32 if part['partype'] == 'fat32' else 16,
+                    part['offset'] / sector_size, filename, part['partsize'] * 1024))
         elif part['partype'].startswith('ext'):
-            rc=safe_exec('sudo mkfs.{} -q -O ^huge_file {}p{}'.format(part['partype'], nbdev, part['partnum'] + 1))
+            populate='-d {}'.format(part['directory']) if part['directory'] else ''
+            rc=safe_exec('mke2fs -F -q -t {} -O ^huge_file -E offset={} {} {} {}k'.format(
+                    part['partype'], part['offset'], populate, filename, part['partsize'] * 1024))
 
-    rc=safe_exec('sudo /usr/bin/qemu-nbd -d {}'.format(nbdev))
     print 'done!'
     return True
 
-def report_integrity():
+def file_storage(filename):
+    '''
+    Returns the storage used by a file in the form
+    { 'path': name, 'exists': bool, 'apparent': bytes, 'allocated': bytes, 'id': 'device:inode' }
+    Allocated bytes are the blocks really used on disk, which is much less than the
+    apparent size for sparse raw images and qcow2 files.
+    '''
+    try:
+        info=os.stat(filename)
+        return { 'path': os.path.realpath(filename), 'exists': True, 'apparent': info.st_size,
+                 'allocated': info.st_blocks * 512, 'id': '{}:{}'.format(info.st_dev, info.st_ino) }
+    except OSError:
+        return { 'path': filename, 'exists': False, 'apparent': 0, 'allocated': 0, 'id': None }
+
+def profile_storage(settings):
+    '''
+    Returns the storage details of a profile: its backing image, its qcow image
+    and the backing chain recorded in the qcow image header (layers and base image).
+    '''
+    storage={ 'backing_image': file_storage(settings['backing_image']),
+              'qcow_image': file_storage(settings['qcow_image']),
+              'chain': [],
+              'virtual_size': None,
+              'broken_chain': False }
+
+    if storage['qcow_image']['exists']:
+        try:
+            image=DiskImage(settings['qcow_image'])
+            storage['virtual_size']=image.virtual_size
+            storage['chain']=[ file_storage(f) for f in image.backing_chain()[1:] ]
+            image.close()
+        except (IOError, ValueError, struct.error):
+            storage['broken_chain']=True
+
+        storage['broken_chain'] |= any(not f['exists'] for f in storage['chain'])
+
+    return storage
+
+def report_integrity(json_output=False, threads=8):
     '''
     Steps through each xsysroot profile and displays information
     for each backing and qcow image (storage used, broken links)
     Returns False if any backing image cannot be found.
+
+    Sizes are allocated disk blocks. Files shared by several profiles, such as a
+    common backing image or layer, are counted only once in the totals, and the
+    space reclaimable by removing a profile only counts the files no other profile uses.
     '''
-    xsys=XSysroot()
-    total_backing_size = total_qcow_size = 0
     mib_units = (1024 * 1024)
-    broken_backings = 0
 
     # load all profiles
-    filename=xsys._get_settings_filename()
+    filename=find_settings_filename()
     if filename:
-        with open(filename, 'r') as f:
-            all_profiles=json.load(f)
+        all_profiles=read_profiles(filename)
+    else:
+        all_profiles=json.loads(default_settings)
+
+    # gather the details of all images in parallel, reading headers is mostly waiting on disk
+    names=sorted(all_profiles.keys())
+    pool=multiprocessing.pool.ThreadPool(threads)
+    storages=dict(zip(names, pool.map(profile_storage, [ expand_profile(all_profiles[p]) for p in names ])))
+    pool.close()
+
+    # find how many profiles use each file
+    users={}
+    files={}
+    for profile in names:
+        storage=storages[profile]
+        profile_files=[ storage['backing_image'], storage['qcow_image'] ] + storage['chain']
+        storage['files']=set(f['id'] for f in profile_files if f['exists'])
+        for f in profile_files:
+            if f['exists']:
+                files[f['id']]=f
+        for i in storage['files']:
+            users[i]=users.get(i, 0) + 1
+
+    qcow_ids=set(storages[p]['qcow_image']['id'] for p in names if storages[p]['qcow_image']['exists'])
+    broken_backings=0
+    for profile in names:
+        storage=storages[profile]
+        storage['reclaimable']=sum(files[i]['allocated'] for i in storage['files'] if users[i] == 1)
+        storage['broken']=not storage['backing_image']['exists'] or storage['broken_chain']
+        broken_backings += storage['broken']
+        storage['files']=sorted(storage['files'])
+
+    totals={ 'backing': sum(f['allocated'] for i, f in files.items() if i not in qcow_ids),
+             'qcow': sum(files[i]['allocated'] for i in qcow_ids),
+             'broken': broken_backings }
+    totals['total']=totals['backing'] + totals['qcow']
+
+    if json_output:
+        report={ 'profiles': dict((p, dict(storages[p], description=all_profiles[p]['description'])) for p in names),
+                 'totals': totals }
+        print json.dumps(report, indent=2, sort_keys=True)
+        return (broken_backings == 0)
+
+    def describe(f):
+        if not f['exists']:
+            return 'NOT FOUND => {}'.format(f['path'])
+        shared=' (shared by {} profiles)'.format(users[f['id']]) if users[f['id']] > 1 else ''
+        return '{} MiB used of {} MiB{} => {}'.format(
+            f['allocated'] / mib_units, f['apparent'] / mib_units, shared, f['path'])
 
     print 'xsysroot image storage report\n'
-    for profile in all_profiles:
-
-        description = all_profiles[profile]['description']
-        backing = all_profiles[profile]['backing_image']
-        qcow = all_profiles[profile]['qcow_image']
-
-        # expand shell tokens in the image filenames
-        backing = os.popen('echo {}'.format(backing)).read().strip('\n')
-        qcow = os.popen('echo {}'.format(qcow)).read().strip('\n')
-
-        status_backing = 'NOT FOUND'
-        status_qcow    = 'UNRENEWED'
-        if os.path.isfile(backing):
-            bsize = os.path.getsize(backing) / mib_units
-            status_backing = '{} MiB'.format(bsize)
-            total_backing_size += bsize
+    for profile in names:
+        storage=storages[profile]
+        print '{} ({})'.format(profile, all_profiles[profile]['description'])
+        print ' backing image => {}'.format(describe(storage['backing_image']))
+        if storage['qcow_image']['exists']:
+            print '    qcow image => {}'.format(describe(storage['qcow_image']))
+            print '  virtual size => {}'.format(
+                'UNREADABLE' if storage['virtual_size'] is None else '{} MiB'.format(storage['virtual_size'] / mib_units))
+            for layer in storage['chain']:
+                print '    backed by => {}'.format(describe(layer))
         else:
-            broken_backings += 1
-
-        if os.path.isfile(qcow):
-            qsize =os.path.getsize(qcow) / mib_units
-            status_qcow = '{} MiB'.format(qsize)
-            total_qcow_size += qsize
-
-        print '{} ({})\n backing image => {} => {}\n    qcow image => {} => {}'.format( \
-            profile, description, status_backing, backing, status_qcow, qcow)
+            print '    qcow image => UNRENEWED => {}'.format(storage['qcow_image']['path'])
+        print '   reclaimable => {} MiB'.format(storage['reclaimable'] / mib_units)
 
-    print '\nBacking image storage: {} MiB'.format(total_backing_size)
-    print 'Qcow image storage: {} MiB'.format(total_qcow_size)
-    print 'Total disk space: {} MiB'.format(total_backing_size + total_qcow_size)
+    print '\nBacking image storage: {} MiB'.format(totals['backing'] / mib_units)
+    print 'Qcow image storage: {} MiB'.format(totals['qcow'] / mib_units)
+    print 'Total disk space: {} MiB'.format(totals['total'] / mib_units)
     print 'Broken backing image links: {}'.format(broken_backings)
 
     return (broken_backings == 0)
@@ -1192,6 +3507,9 @@ if __name__ == '__main__':
     parser.add_option("-u", "--umount", dest="umount", action="store_true",
                       help='unmount the current qcow image')
 
+    parser.add_option("-W", "--wait", dest="wait", metavar="SECONDS", type="float", default=0,
+                      help='with --umount or --running, wait for processes on the sysroot to finish')
+
     parser.add_option("-j", "--jail", dest="jail", action="store_true",
                       help='Protect xsysroot against reboot harm on the host, give blind sudo')
 
@@ -1204,24 +3522,40 @@ if __name__ == '__main__':
     parser.add_option("-o", "--screenshot", dest="screenshot", metavar="IMAGE_FILE",
                       help='take a screenshot of the virtual display (extension determines format)')
 
+    parser.add_option("-F", "--frames", dest="frames", metavar="SECONDS", type="float",
+                      help='capture the virtual display for some seconds and report frame timing')
+
     parser.add_option("-d", "--depends", dest="depends", action="store_true",
                       help='installs Debian "Build-Depends" on the sysroot')
 
     parser.add_option("-b", "--build", dest="build", action="store_true",
-                      help='performs a Debian "debuild" on the host (cross build a package)')
+                      help='performs a Debian "debuild" on the host (cross build a package), '
+                      'give several repo directories to build them in Build-Depends order')
+
+    parser.add_option("--jobs", dest="jobs", metavar="N", type="int", default=None,
+                      help='with --build, make jobs to share between packages (default number of CPUs)')
+
+    parser.add_option("--parallel", dest="parallel", metavar="N", type="int", default=None,
+                      help='with --build, number of packages to build at the same time')
 
     parser.add_option("-k", "--skeleton", dest="skeleton", metavar="DIRECTORY", default=None,
                       help='gives you a Debian package control directory skeleton')
 
     parser.add_option("-g", "--geometry", dest="image", metavar="GEOMETRY", default=None,
-                      help='create and partition new image using geometry in MB (e.g. "myimage.img fat32:40 ext3:200"')
+                      help='create and partition new image using geometry in MiB (e.g. "myimage.img fat32:40 ext3:200:/rootfs/dir"')
 
     parser.add_option("-z", "--zerofree", dest="zerofree", action="store_true",
                       help='fill all partitions free space with zeroes to increase compression ratio"')
 
+    parser.add_option("-E", "--export", dest="export", metavar="IMAGE_FILE",
+                      help='zerofree and export the image as a flashable raw image, compressed if .gz, .xz or .zst')
+
     parser.add_option("-I", "--integrity", dest="integrity", action="store_true",
                       help='A report of disk images used by xsysroot profiles')
 
+    parser.add_option("-J", "--json", dest="json", action="store_true", default=False,
+                      help='print the --integrity and --frames reports in JSON format')
+
     parser.add_option("-U", "--upgrade", dest="upgrade", action="store_true",
                       help='Upgrade to the latest version of xsysroot')
 
@@ -1256,9 +3590,9 @@ if __name__ == '__main__':
             print value
             success=True
     elif options.integrity:
-        success=report_integrity()
+        success=report_integrity(json_output=options.json)
     elif options.running:
-        success=xsys.running()
+        success=xsys.running(options.wait)
     elif options.ismounted:
         is_mounted=xsys.print_is_mounted()
         sys.exit(is_mounted == True)
@@ -1269,7 +3603,7 @@ if __name__ == '__main__':
     elif options.mount:
         success=xsys.mount()
     elif options.umount:
-        success=xsys.umount()
+        success=xsys.umount(options.wait)
     elif options.jail:
         success=xsys.jail()
     elif options.chroot:
@@ -1290,16 +3624,23 @@ if __name__ == '__main__':
         sys.exit(rc)
     elif options.screenshot:
         success=xsys.screenshot(options.screenshot)
+    elif options.frames:
+        success=xsys.capture(duration=options.frames, json_output=options.json)
     elif options.depends:
         success=xsys.depends()
     elif options.build:
-        success=xsys.build()
+        if args:
+            success=xsys.build_many(args, jobs=options.jobs, parallel=options.parallel)
+        else:
+            success=xsys.build(jobs=options.jobs)
     elif options.skeleton:
         success=create_debian_skeleton(options.skeleton)
     elif options.image:
         success=create_image(options.image)
     elif options.zerofree:
         success=xsys.zerofree()
+    elif options.export:
+        success=xsys.export(options.export)
     elif options.tools:
         if not check_system_tools():
             print 'xsysroot will not run.'